@@ -312,6 +312,32 @@ class ControlLDM(LatentDiffusion):
         self.control_key = control_key
         self.only_mid_control = only_mid_control
         self.control_scales = [1.0] * 13
+        # Opt-in reuse of the ControlNet residuals across sampling steps (see control_step)
+        self.control_refresh = None
+        self.control_cache = {}
+        self.control_calls = 0
+
+    def control_step(self, refresh):
+        """Called by the sampler before each step. refresh=True recomputes the
+        ControlNet residuals at this step, False reuses those of the last
+        refreshed step, None goes back to the exact path and drops the cache.
+        Cached residuals are kept per apply_model call of the step (e.g. the
+        conditional and unconditional branches of CFG)."""
+        self.control_refresh = refresh
+        self.control_calls = 0
+        if refresh is None:
+            self.control_cache = {}
+
+    def get_control(self, x_noisy, t, cond, cond_txt):
+        if self.control_refresh is None:
+            return self.control_model(x=x_noisy, hint=torch.cat(cond['c_concat'], 1), timesteps=t, context=cond_txt)
+        slot = self.control_calls
+        self.control_calls += 1
+        control = self.control_cache.get(slot)
+        if self.control_refresh or control is None or control[0].shape[0] != x_noisy.shape[0]:
+            control = self.control_model(x=x_noisy, hint=torch.cat(cond['c_concat'], 1), timesteps=t, context=cond_txt)
+            self.control_cache[slot] = control
+        return control
 
     @torch.no_grad()
     def get_input(self, batch, k, bs=None, *args, **kwargs):
@@ -334,7 +360,7 @@ class ControlLDM(LatentDiffusion):
         if cond['c_concat'] is None:
             eps = diffusion_model(x=x_noisy, timesteps=t, context=cond_txt, control=None, only_mid_control=self.only_mid_control)
         else:
-            control = self.control_model(x=x_noisy, hint=torch.cat(cond['c_concat'], 1), timesteps=t, context=cond_txt)
+            control = self.get_control(x_noisy, t, cond, cond_txt)
             control = [c * scale for c, scale in zip(control, self.control_scales)]
             eps = diffusion_model(x=x_noisy, timesteps=t, context=cond_txt, control=control, only_mid_control=self.only_mid_control)
         return eps
@@ -1,5 +1,6 @@
 """SAMPLING ONLY."""
 
+import math
 import torch
 import numpy as np
 from tqdm import tqdm
@@ -7,12 +8,49 @@ from tqdm import tqdm
 from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like, extract_into_tensor
 
 
+def cfg_batchable(c, uc):
+    """Whether conditional and unconditional inputs can be stacked into one batch."""
+    if isinstance(c, dict) and isinstance(uc, dict):
+        return c.keys() == uc.keys() and all((c[k] is None) == (uc[k] is None) for k in c)
+    return isinstance(c, torch.Tensor) and isinstance(uc, torch.Tensor)
+
+
+def cat_conditioning(uc, c):
+    """Unconditional and conditional inputs stacked on the batch axis, unconditional first."""
+    if isinstance(c, dict):
+        out = {}
+        for k in c:
+            if c[k] is None:
+                out[k] = None
+            elif isinstance(c[k], list):
+                out[k] = [torch.cat([u, v]) for u, v in zip(uc[k], c[k])]
+            else:
+                out[k] = torch.cat([uc[k], c[k]])
+        return out
+    return torch.cat([uc, c])
+
+
+def control_refresh(i, total_steps, every=1, until=1.0):
+    """Whether step i recomputes the ControlNet residuals: every `every` steps
+    within the first `until` fraction of the steps; the other steps reuse the
+    residuals of the last refreshed step."""
+    return i % every == 0 and i < max(1, math.ceil(until * total_steps))
+
+
 class DDIMSampler(object):
-    def __init__(self, model, schedule="linear", **kwargs):
+    def __init__(self, model, schedule="linear", batch_cfg=False, control_every=1, control_until=1.0, **kwargs):
         super().__init__()
         self.model = model
         self.ddpm_num_timesteps = model.num_timesteps
         self.schedule = schedule
+        # run the conditional and unconditional branches of CFG as one batch
+        self.batch_cfg = batch_cfg
+        # ControlNet residual caching (approximate), off at every=1, until=1.0
+        self.control_every = control_every
+        self.control_until = control_until
+
+    def caches_control(self):
+        return hasattr(self.model, 'control_step') and (self.control_every > 1 or self.control_until < 1.0)
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
@@ -147,10 +185,15 @@ class DDIMSampler(object):
         print(f"Running DDIM Sampling with {total_steps} timesteps")
 
         iterator = tqdm(time_range, desc='DDIM Sampler', total=total_steps)
+        caches_control = self.caches_control()
+        if hasattr(self.model, 'control_step'):
+            self.model.control_step(None)
 
         for i, step in enumerate(iterator):
             index = total_steps - i - 1
             ts = torch.full((b,), step, device=device, dtype=torch.long)
+            if caches_control:
+                self.model.control_step(control_refresh(i, total_steps, self.control_every, self.control_until))
 
             if mask is not None:
                 assert x0 is not None
@@ -176,6 +219,8 @@ class DDIMSampler(object):
                 intermediates['x_inter'].append(img)
                 intermediates['pred_x0'].append(pred_x0)
 
+        if caches_control:
+            self.model.control_step(None)
         return img, intermediates
 
     @torch.no_grad()
@@ -187,6 +232,11 @@ class DDIMSampler(object):
 
         if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
             model_output = self.model.apply_model(x, t, c)
+        elif self.batch_cfg and cfg_batchable(c, unconditional_conditioning):
+            model_out = self.model.apply_model(torch.cat([x] * 2), torch.cat([t] * 2),
+                                               cat_conditioning(unconditional_conditioning, c))
+            model_uncond, model_t = model_out.chunk(2)
+            model_output = model_uncond + unconditional_guidance_scale * (model_t - model_uncond)
         else:
             model_t = self.model.apply_model(x, t, c)
             model_uncond = self.model.apply_model(x, t, unconditional_conditioning)
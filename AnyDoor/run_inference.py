@@ -1,3 +1,4 @@
+import os
 import cv2
 import einops
 import numpy as np
@@ -14,6 +15,15 @@ import albumentations as A
 from omegaconf import OmegaConf
 from PIL import Image
 
+try:
+    # Timing spans when run from the GenArtist agent (agent_trace.py)
+    from agent_trace import span
+except ImportError:
+    from contextlib import nullcontext
+
+    def span(name, **attrs):
+        return nullcontext()
+
 
 def aug_data_mask(image, mask):
     transform = A.Compose([
@@ -130,94 +140,124 @@ def crop_back( pred, tar_image,  extra_sizes, tar_box_yyxx_crop):
     return gen_image
 
 
-def inference_single_image(ref_image, ref_mask, tar_image, tar_mask, guidance_scale = 5.0):
-    save_memory = False
+def load_anydoor_model(config_path='./AnyDoor/configs/inference.yaml'):
     disable_verbosity()
-    if save_memory:
-        enable_sliced_attention()
-
-
     #config = OmegaConf.load('./configs/inference.yaml')
-    config = OmegaConf.load('./AnyDoor/configs/inference.yaml')
+    config = OmegaConf.load(config_path)
     model_ckpt =  config.pretrained_model
     model_config = config.config_file
 
     model = create_model(model_config ).cpu()
     model.load_state_dict(load_state_dict(model_ckpt, location='cuda'))
     model = model.cuda()
-    ddim_sampler = DDIMSampler(model)
-
-
-
-    item = process_pairs(ref_image, ref_mask, tar_image, tar_mask)
-    ref = item['ref'] * 255
-    tar = item['jpg'] * 127.5 + 127.5
-    hint = item['hint'] * 127.5 + 127.5
-
-    hint_image = hint[:,:,:-1]
-    hint_mask = item['hint'][:,:,-1] * 255
-    hint_mask = np.stack([hint_mask,hint_mask,hint_mask],-1)
-    ref = cv2.resize(ref.astype(np.uint8), (512,512))
-
-    seed = random.randint(0, 65535)
-    if save_memory:
-        model.low_vram_shift(is_diffusing=False)
-
-    ref = item['ref']
-    tar = item['jpg'] 
-    hint = item['hint']
-    num_samples = 1
-
-    control = torch.from_numpy(hint.copy()).float().cuda() 
-    control = torch.stack([control for _ in range(num_samples)], dim=0)
-    control = einops.rearrange(control, 'b h w c -> b c h w').clone()
-
-
-    clip_input = torch.from_numpy(ref.copy()).float().cuda() 
-    clip_input = torch.stack([clip_input for _ in range(num_samples)], dim=0)
-    clip_input = einops.rearrange(clip_input, 'b h w c -> b c h w').clone()
-
-    guess_mode = False
-    H,W = 512,512
-
-    cond = {"c_concat": [control], "c_crossattn": [model.get_learned_conditioning( clip_input )]}
-    un_cond = {"c_concat": None if guess_mode else [control], "c_crossattn": [model.get_learned_conditioning([torch.zeros((1,3,224,224))] * num_samples)]}
-    shape = (4, H // 8, W // 8)
-
-    if save_memory:
-        model.low_vram_shift(is_diffusing=True)
-
-    # ====
-    num_samples = 1 #gr.Slider(label="Images", minimum=1, maximum=12, value=1, step=1)
-    image_resolution = 512  #gr.Slider(label="Image Resolution", minimum=256, maximum=768, value=512, step=64)
-    strength = 1  #gr.Slider(label="Control Strength", minimum=0.0, maximum=2.0, value=1.0, step=0.01)
-    guess_mode = False #gr.Checkbox(label='Guess Mode', value=False)
-    #detect_resolution = 512  #gr.Slider(label="Segmentation Resolution", minimum=128, maximum=1024, value=512, step=1)
-    ddim_steps = 50 #gr.Slider(label="Steps", minimum=1, maximum=100, value=20, step=1)
-    scale = guidance_scale  #gr.Slider(label="Guidance Scale", minimum=0.1, maximum=30.0, value=9.0, step=0.1)
-    seed = 1 #-1  #gr.Slider(label="Seed", minimum=-1, maximum=2147483647, step=1, randomize=True)
-    eta = 0.0 #gr.Number(label="eta (DDIM)", value=0.0)
-
-    model.control_scales = [strength * (0.825 ** float(12 - i)) for i in range(13)] if guess_mode else ([strength] * 13)  # Magic number. IDK why. Perhaps because 0.825**12<0.01 but 0.826**12>0.01
-    samples, intermediates = ddim_sampler.sample(ddim_steps, num_samples,
-                                                    shape, cond, verbose=False, eta=eta,
-                                                    unconditional_guidance_scale=scale,
-                                                    unconditional_conditioning=un_cond)
-    if save_memory:
-        model.low_vram_shift(is_diffusing=False)
-
-    x_samples = model.decode_first_stage(samples)
-    x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).cpu().numpy()#.clip(0, 255).astype(np.uint8)
-
-    result = x_samples[0][:,:,::-1]
-    result = np.clip(result,0,255)
-
-    pred = x_samples[0]
-    pred = np.clip(pred,0,255)[1:,:,:]
-    sizes = item['extra_sizes']
-    tar_box_yyxx_crop = item['tar_box_yyxx_crop'] 
-    gen_image = crop_back(pred, tar_image, sizes, tar_box_yyxx_crop) 
-    return gen_image
+    return model
+
+
+class AnyDoorEngine:
+    """AnyDoor loaded once, for many insertions.
+
+    Keeps the ControlLDM, one DDIMSampler whose schedule is only rebuilt when
+    the number of steps or eta change, and the DINOv2 embedding of the empty
+    (all-zeros) reference used as unconditional conditioning. `insert` runs a
+    batch of (ref_image, ref_mask, tar_image, tar_mask) in one sampling run.
+    With batch_cfg, each DDIM step runs the conditional and unconditional
+    branches as one batch. control_every/control_until trade quality for
+    speed by recomputing the ControlNet residuals only every k steps within
+    the first fraction of the steps (exact at 1, 1.0; see run_sampler_check.py).
+    """
+
+    def __init__(self, model=None, config_path='./AnyDoor/configs/inference.yaml', save_memory=False, batch_cfg=True,
+                 control_every=1, control_until=1.0):
+        self.model = model if model is not None else load_anydoor_model(config_path)
+        self.sampler = DDIMSampler(self.model, batch_cfg=batch_cfg, control_every=control_every, control_until=control_until)
+        self.save_memory = save_memory
+        if save_memory:
+            enable_sliced_attention()
+        self.schedule = None
+        self.uncond = None
+
+    @property
+    def components(self):
+        # lets agent_models.ModelRegistry size and offload the engine like a pipeline
+        return {"model": self.model}
+
+    def make_schedule(self, ddim_steps, eta):
+        if self.schedule != (ddim_steps, eta):
+            self.sampler.make_schedule(ddim_num_steps=ddim_steps, ddim_eta=eta, verbose=False)
+            self.schedule = (ddim_steps, eta)
+
+    def uncond_embedding(self):
+        if self.uncond is None or self.uncond.device != self.model.device:
+            self.uncond = self.model.get_learned_conditioning([torch.zeros((1,3,224,224))])
+        return self.uncond
+
+    @torch.no_grad()
+    def conditioning(self, items):
+        """(cond, un_cond) for a batch of `process_pairs` items."""
+        model = self.model
+        n = len(items)
+        control = torch.from_numpy(np.stack([item['hint'] for item in items])).float().cuda()
+        control = einops.rearrange(control, 'b h w c -> b c h w').clone()
+        clip_input = torch.from_numpy(np.stack([item['ref'] for item in items])).float().cuda()
+        clip_input = einops.rearrange(clip_input, 'b h w c -> b c h w').clone()
+
+        if self.save_memory:
+            model.low_vram_shift(is_diffusing=False)
+        guess_mode = False
+        cond = {"c_concat": [control], "c_crossattn": [model.get_learned_conditioning(clip_input)]}
+        uncond = self.uncond_embedding()
+        un_cond = {"c_concat": None if guess_mode else [control], "c_crossattn": [uncond.repeat(n, 1, 1)]}
+        return cond, un_cond
+
+    @torch.no_grad()
+    def insert(self, pairs, guidance_scale=5.0, ddim_steps=50, eta=0.0, strength=1.0):
+        """Generated images, one per (ref_image, ref_mask, tar_image, tar_mask) in `pairs`."""
+        model = self.model
+        items = [process_pairs(*pair) for pair in pairs]
+        n = len(items)
+        H, W = 512, 512
+        guess_mode = False
+        cond, un_cond = self.conditioning(items)
+        shape = (n, 4, H // 8, W // 8)
+
+        if self.save_memory:
+            model.low_vram_shift(is_diffusing=True)
+        model.control_scales = [strength * (0.825 ** float(12 - i)) for i in range(13)] if guess_mode else ([strength] * 13)  # Magic number. IDK why. Perhaps because 0.825**12<0.01 but 0.826**12>0.01
+        self.make_schedule(ddim_steps, eta)
+        with span("denoise", steps=ddim_steps, batch=n):
+            samples, intermediates = self.sampler.ddim_sampling(cond, shape,
+                                                                unconditional_guidance_scale=guidance_scale,
+                                                                unconditional_conditioning=un_cond)
+        if self.save_memory:
+            model.low_vram_shift(is_diffusing=False)
+
+        with span("decode"):
+            x_samples = model.decode_first_stage(samples)
+        x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).cpu().numpy()#.clip(0, 255).astype(np.uint8)
+
+        gen_images = []
+        for (_, _, tar_image, _), item, pred in zip(pairs, items, x_samples):
+            pred = np.clip(pred,0,255)[1:,:,:]
+            gen_images.append(crop_back(pred, tar_image.copy(), item['extra_sizes'], item['tar_box_yyxx_crop']))
+        return gen_images
+
+
+def load_anydoor_engine(config_path='./AnyDoor/configs/inference.yaml'):
+    # GENARTIST_ANYDOOR_CONTROL="every:until", e.g. "2:1.0", turns on ControlNet residual caching
+    every, until = os.getenv('GENARTIST_ANYDOOR_CONTROL', '1:1.0').split(':')
+    return AnyDoorEngine(load_anydoor_model(config_path), control_every=int(every), control_until=float(until))
+
+
+def inference_single_image(ref_image, ref_mask, tar_image, tar_mask, guidance_scale = 5.0, model = None):
+    """`model`: an AnyDoorEngine, a loaded ControlLDM, or None to load one."""
+    if not isinstance(model, AnyDoorEngine):
+        if model is None:
+            model = load_anydoor_model()
+        # one engine per model, so its schedule and unconditional embedding are reused
+        if getattr(model, '_anydoor_engine', None) is None:
+            model._anydoor_engine = AnyDoorEngine(model)
+        model = model._anydoor_engine
+    return model.insert([(ref_image, ref_mask, tar_image, tar_mask)], guidance_scale=guidance_scale)[0]
 
 
 if __name__ == '__main__': 
@@ -0,0 +1,159 @@
+"""Checks of the AnyDoor sampler options against the default path, on the
+TestDreamBooth examples. Run from the GenArtist root:
+
+    python AnyDoor/run_sampler_check.py
+
+batch_cfg: the conditional and unconditional branches of classifier-free
+guidance as one batched apply_model call instead of two. Compares the model
+output of single DDIM steps on identical inputs, then whole insertions with
+the same seed, and times both.
+
+control: ControlNet residuals recomputed on a schedule and reused in between
+(an approximation). Each --control-schedules entry "every:until" is run with
+the same seed as the exact path and reported with its PSNR / mean and max
+pixel difference over the edited region, and its time.
+"""
+import os
+import time
+import argparse
+import cv2
+import numpy as np
+import torch
+os.sys.path.append('./AnyDoor')
+os.sys.path.append('./AnyDoor/dinov2')
+os.sys.path.append('./AnyDoor/dinov2/datasets')
+from run_inference import AnyDoorEngine, process_pairs
+from cldm.ddim_hacked import control_refresh
+
+EXAMPLES = './AnyDoor/examples/TestDreamBooth'
+
+
+def load_examples(n=4):
+    """(ref_image, ref_mask, tar_image, tar_mask) pairs, as in run_inference.py."""
+    backgrounds = ['000000309203', '000000047948']
+    pairs = []
+    for i in range(n):
+        image = cv2.imread('%s/FG/%02d.png' % (EXAMPLES, i), cv2.IMREAD_UNCHANGED)
+        ref_mask = (image[:,:,-1] > 128).astype(np.uint8)
+        ref_image = cv2.cvtColor(image[:,:,:-1].copy(), cv2.COLOR_BGR2RGB)
+        name = backgrounds[i % len(backgrounds)]
+        back_image = cv2.cvtColor(cv2.imread('%s/BG/%s_GT.png' % (EXAMPLES, name)), cv2.COLOR_BGR2RGB).astype(np.uint8)
+        tar_mask = (cv2.imread('%s/BG/%s_mask.png' % (EXAMPLES, name))[:,:,0] > 128).astype(np.uint8)
+        pairs.append((ref_image, ref_mask, back_image, tar_mask))
+    return pairs
+
+
+def edit_region(tar_mask):
+    """Slices of the bounding box of the target mask, where crop_back pastes the generation."""
+    y, x = np.nonzero(tar_mask)
+    return slice(y.min(), y.max() + 1), slice(x.min(), x.max() + 1)
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255. ** 2 / mse)
+
+
+@torch.no_grad()
+def check_step_outputs(engine, pairs, steps=5, guidance_scale=5.0, ddim_steps=50):
+    """Largest difference of x_{t-1} between the two CFG paths, over the first DDIM steps (eta=0)."""
+    sampler = engine.sampler
+    cond, un_cond = engine.conditioning([process_pairs(*pair) for pair in pairs])
+    engine.model.control_scales = [1.0] * 13
+    engine.make_schedule(ddim_steps, 0.0)
+    torch.manual_seed(0)
+    x = torch.randn((len(pairs), 4, 64, 64), device=engine.model.device)
+    timesteps = np.flip(sampler.ddim_timesteps)
+    worst = 0.
+    for i, step in enumerate(timesteps[:steps]):
+        index = len(timesteps) - i - 1
+        t = torch.full((len(pairs),), step, device=x.device, dtype=torch.long)
+        outs = []
+        for batch_cfg in (False, True):
+            sampler.batch_cfg = batch_cfg
+            outs.append(sampler.p_sample_ddim(x, cond, t, index=index, unconditional_guidance_scale=guidance_scale,
+                                              unconditional_conditioning=un_cond)[0])
+        diff = (outs[0] - outs[1]).abs().max().item()
+        print('step %d (t=%d): max |two-call - batched| = %.3e' % (i, step, diff))
+        worst = max(worst, diff)
+        x = outs[0]
+    return worst
+
+
+def run(engine, pairs, repeat=1, **kwargs):
+    """Images of one seeded insertion and its mean wall time."""
+    torch.cuda.synchronize()
+    t0 = time.time()
+    for _ in range(repeat):
+        torch.manual_seed(0)
+        images = engine.insert(pairs, **kwargs)
+    torch.cuda.synchronize()
+    return images, (time.time() - t0) / repeat
+
+
+def check_control_cache(engine, pairs, schedules, steps=50, repeat=1):
+    """Quality and time of each (every, until) ControlNet schedule against the exact path."""
+    sampler = engine.sampler
+    sampler.control_every, sampler.control_until = 1, 1.0
+    exact, exact_time = run(engine, pairs, repeat, ddim_steps=steps)
+    print('exact: %.2fs per batch of %d' % (exact_time, len(pairs)))
+    rows = []
+    for every, until in schedules:
+        sampler.control_every, sampler.control_until = every, until
+        images, seconds = run(engine, pairs, repeat, ddim_steps=steps)
+        scores, diffs, maxs = [], [], []
+        for (_, _, _, tar_mask), a, b in zip(pairs, exact, images):
+            region = edit_region(tar_mask)
+            a, b = a[region].astype(np.float64), b[region].astype(np.float64)
+            scores.append(psnr(a, b))
+            diffs.append(np.abs(a - b).mean())
+            maxs.append(np.abs(a - b).max())
+        refreshed = sum(control_refresh(i, steps, every, until) for i in range(steps))
+        rows.append((every, until, refreshed, np.mean(scores), min(scores), np.mean(diffs), max(maxs), seconds))
+        print('every=%d until=%.2f (%d/%d ControlNet passes): PSNR mean %.2f dB, min %.2f dB, '
+              'mean abs diff %.2f, max %d, %.2fs (%.2fx)' % (every, until, refreshed, steps, np.mean(scores), min(scores),
+                                                             np.mean(diffs), max(maxs), seconds, exact_time / seconds))
+    sampler.control_every, sampler.control_until = 1, 1.0
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="AnyDoor sampler checks")
+    parser.add_argument("--pairs", type=int, default=4, help="examples inserted in one batch")
+    parser.add_argument("--steps", type=int, default=50, help="DDIM steps of the full runs")
+    parser.add_argument("--repeat", type=int, default=2, help="timed runs per mode")
+    parser.add_argument("--atol", type=float, default=1e-3, help="tolerance on the single-step model outputs")
+    parser.add_argument("--checks", type=str, default="batch_cfg,control", help="checks to run")
+    parser.add_argument("--control-schedules", type=str, default="2:1.0,3:1.0,4:1.0,1:0.5,1:0.3,2:0.6",
+                        help="ControlNet schedules every:until to compare with the exact path")
+    args = parser.parse_args()
+    checks = args.checks.split(",")
+
+    engine = AnyDoorEngine()
+    pairs = load_examples(args.pairs)
+
+    if "control" in checks:
+        print('== control: residual caching against the exact path')
+        schedules = [(int(e), float(u)) for e, u in (s.split(":") for s in args.control_schedules.split(",") if s)]
+        check_control_cache(engine, pairs, schedules, args.steps, args.repeat)
+
+    if "batch_cfg" not in checks:
+        raise SystemExit(0)
+
+    print('== batch_cfg: single steps')
+    worst = check_step_outputs(engine, pairs)
+
+    print('== batch_cfg: full runs')
+    results = {}
+    for batch_cfg in (False, True):
+        engine.sampler.batch_cfg = batch_cfg
+        run(engine, pairs, ddim_steps=args.steps)  # warm-up
+        results[batch_cfg] = run(engine, pairs, args.repeat, ddim_steps=args.steps)
+        print('batch_cfg=%s: %.2fs per batch of %d' % (batch_cfg, results[batch_cfg][1], len(pairs)))
+    for k, (a, b) in enumerate(zip(results[False][0], results[True][0])):
+        print('pair %d: PSNR %.2f dB, max pixel diff %d' % (k, psnr(a, b), np.abs(a.astype(int) - b.astype(int)).max()))
+    print('speedup: %.2fx' % (results[False][1] / results[True][1]))
+
+    if worst > args.atol:
+        raise SystemExit('batched CFG differs from the two-call path by %.3e > %.1e' % (worst, args.atol))
+    print('OK')
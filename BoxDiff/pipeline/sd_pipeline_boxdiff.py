@@ -180,6 +180,49 @@ class BoxDiffPipeline(StableDiffusionPipeline):
 
         return text_inputs, prompt_embeds
 
+    def _box_constraint_masks(self, bbox: List[List[int]], res: int, dtype, device, config):
+        """ Box, background and corner masks of every box at resolution `res`, built once per generation. """
+        key = (tuple(tuple(b) for b in bbox), res, config.P, config.L, dtype, device)
+        cache = getattr(self, "_box_masks", None)
+        if cache is not None and cache[0] == key:
+            return cache[1]
+
+        n = len(bbox)
+        obj_mask = torch.zeros(n, res, res, dtype=dtype, device=device)
+        corner_mask_x = torch.zeros(n, res, dtype=dtype, device=device)
+        corner_mask_y = torch.zeros(n, res, dtype=dtype, device=device)
+        for j, b in enumerate(bbox):
+            x1, y1, x2, y2 = [max(round(v / (512 / res)), 0) for v in b]
+            obj_mask[j, y1:y2, x1:x2] = 1.
+            # create gt according to the number config.L
+            corner_mask_x[j, max(x1 - config.L, 0): min(x1 + config.L + 1, res)] = 1.
+            corner_mask_x[j, max(x2 - config.L, 0): min(x2 + config.L + 1, res)] = 1.
+            corner_mask_y[j, max(y1 - config.L, 0): min(y1 + config.L + 1, res)] = 1.
+            corner_mask_y[j, max(y2 - config.L, 0): min(y2 + config.L + 1, res)] = 1.
+        bg_mask = 1 - obj_mask
+        masks = {
+            "obj": obj_mask,
+            "bg": bg_mask,
+            # top-k sizes of the inner- and outer-box constraints
+            "k_fg": (obj_mask.sum((1, 2)) * config.P).long().clamp(min=1),
+            "k_bg": (bg_mask.sum((1, 2)) * config.P).long().clamp(min=1),
+            "proj_x": obj_mask.max(dim=1)[0],
+            "proj_y": obj_mask.max(dim=2)[0],
+            "corner_x": corner_mask_x,
+            "corner_y": corner_mask_y,
+        }
+        # host copies, so the top-k does not sync on every call
+        masks["k_fg_max"], masks["k_bg_max"] = int(masks["k_fg"].max()), int(masks["k_bg"].max())
+        self._box_masks = (key, masks)
+        return masks
+
+    @staticmethod
+    def _topk_mean(values: torch.Tensor, k: torch.Tensor, k_max: int) -> torch.Tensor:
+        """ Mean of the k[i] largest entries of each row of `values`, k_max = max(k). """
+        top = values.topk(k_max, dim=1)[0]
+        keep = torch.arange(top.shape[1], device=top.device)[None] < k[:, None]
+        return (top * keep).sum(1) / k
+
     def _compute_max_attention_per_index(self,
                                          attention_maps: torch.Tensor,
                                          indices_to_alter: List[int],
@@ -189,8 +232,8 @@ class BoxDiffPipeline(StableDiffusionPipeline):
                                          normalize_eot: bool = False,
                                          bbox: List[int] = None,
                                          config=None,
-                                         ) -> List[torch.Tensor]:
-        """ Computes the maximum attention value for each of the tokens we wish to alter. """
+                                         ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """ Computes the box constraints of all the tokens we wish to alter, one entry per token. """
         last_idx = -1
         if normalize_eot:
             prompt = self.prompt
@@ -204,55 +247,33 @@ class BoxDiffPipeline(StableDiffusionPipeline):
         # Shift indices since we removed the first token
         indices_to_alter = [index - 1 for index in indices_to_alter]
 
-        # Extract the maximum values
-        max_indices_list_fg = []
-        max_indices_list_bg = []
-        dist_x = []
-        dist_y = []
-
-        cnt = 0
-        for i in indices_to_alter:
-            image = attention_for_text[:, :, i]
-
-            box = [max(round(b / (512 / image.shape[0])), 0) for b in bbox[cnt]]
-            x1, y1, x2, y2 = box
-            cnt += 1
-
-            # coordinates to masks
-            obj_mask = torch.zeros_like(image)
-            ones_mask = torch.ones([y2 - y1, x2 - x1], dtype=obj_mask.dtype).to(obj_mask.device)
-            obj_mask[y1:y2, x1:x2] = ones_mask
-            bg_mask = 1 - obj_mask
-
-            if smooth_attentions:
-                smoothing = GaussianSmoothing(channels=1, kernel_size=kernel_size, sigma=sigma, dim=2).cuda()
-                input = F.pad(image.unsqueeze(0).unsqueeze(0), (1, 1, 1, 1), mode='reflect')
-                image = smoothing(input).squeeze(0).squeeze(0)
-
-            # Inner-Box constraint
-            k = (obj_mask.sum() * config.P).long()
-            max_indices_list_fg.append((image * obj_mask).reshape(-1).topk(k)[0].mean())
-
-            # Outer-Box constraint
-            k = (bg_mask.sum() * config.P).long()
-            max_indices_list_bg.append((image * bg_mask).reshape(-1).topk(k)[0].mean())
-
-            # Corner Constraint
-            gt_proj_x = torch.max(obj_mask, dim=0)[0]
-            gt_proj_y = torch.max(obj_mask, dim=1)[0]
-            corner_mask_x = torch.zeros_like(gt_proj_x)
-            corner_mask_y = torch.zeros_like(gt_proj_y)
+        # n x res x res, one map per token
+        images = attention_for_text[:, :, indices_to_alter].permute(2, 0, 1)
+        n, res = images.shape[0], images.shape[1]
+        masks = self._box_constraint_masks(bbox[:n], res, images.dtype, images.device, config=config)
 
-            # create gt according to the number config.L
-            N = gt_proj_x.shape[0]
-            corner_mask_x[max(box[0] - config.L, 0): min(box[0] + config.L + 1, N)] = 1.
-            corner_mask_x[max(box[2] - config.L, 0): min(box[2] + config.L + 1, N)] = 1.
-            corner_mask_y[max(box[1] - config.L, 0): min(box[1] + config.L + 1, N)] = 1.
-            corner_mask_y[max(box[3] - config.L, 0): min(box[3] + config.L + 1, N)] = 1.
-            dist_x.append((F.l1_loss(image.max(dim=0)[0], gt_proj_x, reduction='none') * corner_mask_x).mean())
-            dist_y.append((F.l1_loss(image.max(dim=1)[0], gt_proj_y, reduction='none') * corner_mask_y).mean())
+        if smooth_attentions:
+            # all token maps in one grouped convolution
+            key = (n, kernel_size, sigma, images.device)
+            cache = getattr(self, "_smoothing", None)
+            if cache is None or cache[0] != key:
+                cache = (key, GaussianSmoothing(channels=n, kernel_size=kernel_size, sigma=sigma, dim=2).to(images.device))
+                self._smoothing = cache
+            smoothing = cache[1]
+            input = F.pad(images.unsqueeze(0), (1, 1, 1, 1), mode='reflect')
+            images = smoothing(input).squeeze(0)
+
+        # Inner-Box constraint
+        max_fg = self._topk_mean((images * masks["obj"]).reshape(n, -1), masks["k_fg"], masks["k_fg_max"])
+
+        # Outer-Box constraint
+        max_bg = self._topk_mean((images * masks["bg"]).reshape(n, -1), masks["k_bg"], masks["k_bg_max"])
+
+        # Corner Constraint
+        dist_x = (F.l1_loss(images.max(dim=1)[0], masks["proj_x"], reduction='none') * masks["corner_x"]).mean(1)
+        dist_y = (F.l1_loss(images.max(dim=2)[0], masks["proj_y"], reduction='none') * masks["corner_y"]).mean(1)
 
-        return max_indices_list_fg, max_indices_list_bg, dist_x, dist_y
+        return max_fg, max_bg, dist_x, dist_y
 
     def _aggregate_and_get_max_attention_per_token(self, attention_store: AttentionStore,
                                                    indices_to_alter: List[int],
@@ -284,16 +305,16 @@ class BoxDiffPipeline(StableDiffusionPipeline):
         return max_attention_per_index_fg, max_attention_per_index_bg, dist_x, dist_y
 
     @staticmethod
-    def _compute_loss(max_attention_per_index_fg: List[torch.Tensor], max_attention_per_index_bg: List[torch.Tensor],
-                      dist_x: List[torch.Tensor], dist_y: List[torch.Tensor], return_losses: bool = False) -> torch.Tensor:
+    def _compute_loss(max_attention_per_index_fg: torch.Tensor, max_attention_per_index_bg: torch.Tensor,
+                      dist_x: torch.Tensor, dist_y: torch.Tensor, return_losses: bool = False) -> torch.Tensor:
         """ Computes the attend-and-excite loss using the maximum attention value for each token. """
-        losses_fg = [max(0, 1. - curr_max) for curr_max in max_attention_per_index_fg]
-        losses_bg = [max(0, curr_max) for curr_max in max_attention_per_index_bg]
-        loss = sum(losses_fg) + sum(losses_bg) + sum(dist_x) + sum(dist_y)
+        losses_fg = (1. - max_attention_per_index_fg).clamp(min=0)
+        losses_bg = max_attention_per_index_bg.clamp(min=0)
+        loss = losses_fg.sum() + losses_bg.sum() + dist_x.sum() + dist_y.sum()
         if return_losses:
-            return max(losses_fg), losses_fg
+            return losses_fg.max(), losses_fg
         else:
-            return max(losses_fg), loss
+            return losses_fg.max(), loss
 
     @staticmethod
     def _update_latent(latents: torch.Tensor, loss: torch.Tensor, step_size: float) -> torch.Tensor:
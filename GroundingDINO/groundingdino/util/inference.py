@@ -10,7 +10,7 @@ import bisect
 
 import groundingdino.datasets.transforms as T
 from groundingdino.models import build_model
-from groundingdino.util.misc import clean_state_dict
+from groundingdino.util.misc import clean_state_dict, nested_tensor_from_tensor_list
 from groundingdino.util.slconfig import SLConfig
 from groundingdino.util.utils import get_phrases_from_posmap
 
@@ -70,6 +70,19 @@ def predict(
     prediction_logits = outputs["pred_logits"].cpu().sigmoid()[0]  # prediction_logits.shape = (nq, 256)
     prediction_boxes = outputs["pred_boxes"].cpu()[0]  # prediction_boxes.shape = (nq, 4)
 
+    return _post_process(model, prediction_logits, prediction_boxes, caption, box_threshold, text_threshold,
+                         remove_combined)
+
+
+def _post_process(
+        model,
+        prediction_logits: torch.Tensor,
+        prediction_boxes: torch.Tensor,
+        caption: str,
+        box_threshold: float,
+        text_threshold: float,
+        remove_combined: bool = False
+) -> Tuple[torch.Tensor, torch.Tensor, List[str]]:
     mask = prediction_logits.max(dim=1)[0] > box_threshold
     logits = prediction_logits[mask]  # logits.shape = (n, 256)
     boxes = prediction_boxes[mask]  # boxes.shape = (n, 4)
@@ -97,6 +110,47 @@ def predict(
     return boxes, logits.max(dim=1)[0], phrases
 
 
+def aspect_buckets(shapes: List[Tuple[int, int]], batch_size: int) -> List[List[int]]:
+    """Batches of indices of images (h, w) with similar aspect ratios, at most
+    `batch_size` each. After RandomResize([800], max_size=1333) the aspect
+    ratio decides the size, so images of a batch pad to little more than
+    their own size."""
+    order = sorted(range(len(shapes)), key=lambda i: (shapes[i][0] / shapes[i][1], shapes[i][0] * shapes[i][1]))
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def predict_batch(
+        model,
+        images: List[torch.Tensor],
+        captions,
+        box_threshold: float,
+        text_threshold: float,
+        batch_size: int = 8,
+        device: str = "cuda",
+        remove_combined: bool = False
+) -> List[Tuple[torch.Tensor, torch.Tensor, List[str]]]:
+    """predict() for several images (as returned by load_image), with one
+    caption for all of them or one per image. Images are grouped by aspect
+    ratio into padded NestedTensor batches; returns (boxes, logits, phrases)
+    per image, in the order of `images`."""
+    if isinstance(captions, str):
+        captions = [captions] * len(images)
+    captions = [preprocess_caption(caption=caption) for caption in captions]
+    model = model.to(device)
+
+    results = [None] * len(images)
+    for idxs in aspect_buckets([image.shape[1:] for image in images], batch_size):
+        samples = nested_tensor_from_tensor_list([images[i].to(device) for i in idxs])
+        with torch.no_grad():
+            outputs = model(samples, captions=[captions[i] for i in idxs])
+        prediction_logits = outputs["pred_logits"].cpu().sigmoid()
+        prediction_boxes = outputs["pred_boxes"].cpu()
+        for k, i in enumerate(idxs):
+            results[i] = _post_process(model, prediction_logits[k], prediction_boxes[k], captions[i],
+                                       box_threshold, text_threshold, remove_combined)
+    return results
+
+
 def annotate(image_source: np.ndarray, boxes: torch.Tensor, logits: torch.Tensor, phrases: List[str]) -> np.ndarray:
     h, w, _ = image_source.shape
     boxes = boxes * torch.Tensor([w, h, w, h])
@@ -176,6 +230,38 @@ class Model:
             logits=logits)
         return detections, phrases
 
+    def predict_with_caption_batch(
+        self,
+        images: List[np.ndarray],
+        captions,
+        box_threshold: float = 0.35,
+        text_threshold: float = 0.25,
+        batch_size: int = 8
+    ) -> List[Tuple[sv.Detections, List[str]]]:
+        """
+        predict_with_caption for a list of BGR images, with one caption or
+        one per image; see predict_batch.
+        """
+        processed_images = [Model.preprocess_image(image_bgr=image) for image in images]
+        results = predict_batch(
+            model=self.model,
+            images=processed_images,
+            captions=captions,
+            box_threshold=box_threshold,
+            text_threshold=text_threshold,
+            batch_size=batch_size,
+            device=self.device)
+        outputs = []
+        for image, (boxes, logits, phrases) in zip(images, results):
+            source_h, source_w, _ = image.shape
+            detections = Model.post_process_result(
+                source_h=source_h,
+                source_w=source_w,
+                boxes=boxes,
+                logits=logits)
+            outputs.append((detections, phrases))
+        return outputs
+
     def predict_with_classes(
         self,
         image: np.ndarray,
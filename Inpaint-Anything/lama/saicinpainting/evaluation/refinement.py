@@ -7,6 +7,7 @@ from kornia.morphology import erosion
 from torch.nn import functional as F
 import numpy as np
 import cv2
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 
 from saicinpainting.evaluation.data import pad_tensor_to_modulo
 from saicinpainting.evaluation.utils import move_to_device
@@ -118,14 +119,25 @@ def _infer(
     torch.Tensor
         inpainted image
     """
+    z = _infer_front(image, mask, forward_front)
+    return _infer_rear(image, mask, z, forward_rears, ref_lower_res, orig_shape, devices, scale_ind, n_iters, lr)
+
+@torch.no_grad()
+def _infer_front(image : torch.Tensor, mask : torch.Tensor, forward_front : nn.Module):
+    """features (z1, z2) of the front part; they do not depend on the other scales"""
     masked_image = image * (1 - mask)
     masked_image = torch.cat([masked_image, mask], dim=1)
-
+    return forward_front(masked_image)
+
+def _infer_rear(
+    image : torch.Tensor, mask : torch.Tensor, z : tuple,
+    forward_rears : nn.Module, ref_lower_res : torch.Tensor, orig_shape : tuple, devices : list,
+    scale_ind : int, n_iters : int=15, lr : float=0.002, progress : bool=True):
+    """refinement of the front features `z` at one scale, see _infer"""
+    z1, z2 = z
     mask = mask.repeat(1,3,1,1)
     if ref_lower_res is not None:
         ref_lower_res = ref_lower_res.detach()
-    with torch.no_grad():
-        z1,z2 = forward_front(masked_image)
     # Inference
     mask = mask.to(devices[-1])
     ekernel = torch.from_numpy(cv2.getStructuringElement(cv2.MORPH_ELLIPSE,(15,15)).astype(bool)).float()
@@ -136,7 +148,7 @@ def _infer(
 
     optimizer = Adam([z1,z2], lr=lr)
 
-    pbar = tqdm(range(n_iters), leave=False)
+    pbar = tqdm(range(n_iters), leave=False, disable=not progress)
     for idi in pbar:
         optimizer.zero_grad()
         input_feat = (z1,z2)
@@ -225,6 +237,45 @@ def _get_image_mask_pyramid(batch : dict, min_side : int, max_scales : int, px_b
     # reverse the lists because we want the lowest resolution image as index 0
     return ls_images[::-1], ls_masks[::-1]
 
+def _pad_scale(image : torch.Tensor, mask : torch.Tensor, modulo : int, device : torch.device):
+    """padded image and binary mask of one pyramid scale on `device`, and their unpadded shape"""
+    orig_shape = image.shape[2:]
+    image = pad_tensor_to_modulo(image, modulo)
+    mask = pad_tensor_to_modulo(mask, modulo)
+    mask[mask >= 1e-8] = 1.0
+    mask[mask < 1e-8] = 0.0
+    image, mask = move_to_device(image, device), move_to_device(mask, device)
+    return image, mask, orig_shape
+
+def _split_inpainter(inpainter : nn.Module, devices : list):
+    """front part of the generator on devices[0] and its resnet blocks split evenly over `devices`"""
+    assert not inpainter.training
+    assert not inpainter.add_noise_kwargs
+    assert inpainter.concat_mask
+
+    n_resnet_blocks = 0
+    first_resblock_ind = 0
+    found_first_resblock = False
+    for idl in range(len(inpainter.generator.model)):
+        if isinstance(inpainter.generator.model[idl], FFCResnetBlock) or isinstance(inpainter.generator.model[idl], ResnetBlock):
+            n_resnet_blocks += 1
+            found_first_resblock = True
+        elif not found_first_resblock:
+            first_resblock_ind += 1
+    resblocks_per_gpu = n_resnet_blocks // len(devices)
+
+    # split the model into front, and rear parts    
+    forward_front = inpainter.generator.model[0:first_resblock_ind]
+    forward_front.to(devices[0])
+    forward_rears = []
+    for idd in range(len(devices)):
+        if idd < len(devices) - 1:
+            forward_rears.append(inpainter.generator.model[first_resblock_ind + resblocks_per_gpu*(idd):first_resblock_ind+resblocks_per_gpu*(idd+1)]) 
+        else:
+            forward_rears.append(inpainter.generator.model[first_resblock_ind + resblocks_per_gpu*(idd):]) 
+        forward_rears[idd].to(devices[idd]) 
+    return forward_front, forward_rears
+
 def refine_predict(
     batch : dict, inpainter : nn.Module, gpu_ids : str, 
     modulo : int, n_iters : int, lr : float, min_side : int, 
@@ -259,34 +310,9 @@ def refine_predict(
         inpainted image of size (1,3,H,W)
     """
 
-    assert not inpainter.training
-    assert not inpainter.add_noise_kwargs
-    assert inpainter.concat_mask
-
     gpu_ids = [f'cuda:{gpuid}' for gpuid in gpu_ids.replace(" ","").split(",") if gpuid.isdigit()]
-    n_resnet_blocks = 0
-    first_resblock_ind = 0
-    found_first_resblock = False
-    for idl in range(len(inpainter.generator.model)):
-        if isinstance(inpainter.generator.model[idl], FFCResnetBlock) or isinstance(inpainter.generator.model[idl], ResnetBlock):
-            n_resnet_blocks += 1
-            found_first_resblock = True
-        elif not found_first_resblock:
-            first_resblock_ind += 1
-    resblocks_per_gpu = n_resnet_blocks // len(gpu_ids)
-
     devices = [torch.device(gpu_id) for gpu_id in gpu_ids]
-    
-    # split the model into front, and rear parts    
-    forward_front = inpainter.generator.model[0:first_resblock_ind]
-    forward_front.to(devices[0])
-    forward_rears = []
-    for idd in range(len(gpu_ids)):
-        if idd < len(gpu_ids) - 1:
-            forward_rears.append(inpainter.generator.model[first_resblock_ind + resblocks_per_gpu*(idd):first_resblock_ind+resblocks_per_gpu*(idd+1)]) 
-        else:
-            forward_rears.append(inpainter.generator.model[first_resblock_ind + resblocks_per_gpu*(idd):]) 
-        forward_rears[idd].to(devices[idd]) 
+    forward_front, forward_rears = _split_inpainter(inpainter, devices)
 
     ls_images, ls_masks = _get_image_mask_pyramid(
         batch, 
@@ -297,12 +323,7 @@ def refine_predict(
     image_inpainted = None
 
     for ids, (image, mask) in enumerate(zip(ls_images, ls_masks)):
-        orig_shape = image.shape[2:]
-        image = pad_tensor_to_modulo(image, modulo)
-        mask = pad_tensor_to_modulo(mask, modulo)
-        mask[mask >= 1e-8] = 1.0
-        mask[mask < 1e-8] = 0.0
-        image, mask = move_to_device(image, devices[0]), move_to_device(mask, devices[0])
+        image, mask, orig_shape = _pad_scale(image, mask, modulo, devices[0])
         if image_inpainted is not None:
             image_inpainted = move_to_device(image_inpainted, devices[-1])
         image_inpainted = _infer(image, mask, forward_front, forward_rears, image_inpainted, orig_shape, devices, ids, n_iters, lr)
@@ -312,3 +333,67 @@ def refine_predict(
         mask = mask.detach().cpu()
     
     return image_inpainted
+
+class RefinementEngine:
+    """refine_predict for many images, with the generator split once.
+
+    devices: torch devices the resnet blocks are split over, as the gpu_ids
+        of refine_predict (e.g. ["cuda:0", "cuda:1"]), or ["cpu"]
+    in_flight: images refined at the same time, each in its own thread, so
+        that while one image runs on the stage of one device another runs on
+        the next; default: one per device, 2 on CPU
+    scale_workers: threads for the front passes of the pyramid scales, which
+        do not depend on each other (the refinement of a scale needs the
+        result of the coarser one, so that part stays sequential)
+
+    On CPU, the threads share the intra-op pool: set torch.set_num_threads
+    to about (cores / in_flight).
+    """
+
+    def __init__(self, inpainter : nn.Module, devices=("cuda:0",), modulo : int=8, n_iters : int=15, lr : float=0.002,
+                 min_side : int=512, max_scales : int=3, px_budget : int=1800000, in_flight : int=None,
+                 scale_workers : int=None):
+        self.devices = [torch.device(device) for device in devices]
+        self.forward_front, self.forward_rears = _split_inpainter(inpainter, self.devices)
+        self.modulo, self.n_iters, self.lr = modulo, n_iters, lr
+        self.min_side, self.max_scales, self.px_budget = min_side, max_scales, px_budget
+        cpu = self.devices[0].type == 'cpu'
+        self.in_flight = in_flight or (2 if cpu else len(self.devices))
+        self.scale_pool = ThreadPoolExecutor(scale_workers or max_scales)
+
+    def refine(self, batch : dict):
+        """refine_predict of one image-mask batch (batch size 1), (1,3,H,W) on CPU"""
+        ls_images, ls_masks = _get_image_mask_pyramid(batch, self.min_side, self.max_scales, self.px_budget)
+        scales = [_pad_scale(image, mask, self.modulo, self.devices[0]) for image, mask in zip(ls_images, ls_masks)]
+        fronts = list(self.scale_pool.map(lambda s: _infer_front(s[0], s[1], self.forward_front), scales))
+        image_inpainted = None
+        for ids, ((image, mask, orig_shape), z) in enumerate(zip(scales, fronts)):
+            if image_inpainted is not None:
+                image_inpainted = move_to_device(image_inpainted, self.devices[-1])
+            image_inpainted = _infer_rear(image, mask, z, self.forward_rears, image_inpainted, orig_shape,
+                                          self.devices, ids, self.n_iters, self.lr, progress=False)
+            image_inpainted = image_inpainted[:,:,:orig_shape[0], :orig_shape[1]]
+        return image_inpainted
+
+    def refine_many(self, batches):
+        """Yields (index, inpainted image) for an iterable of batches, in completion order."""
+        with ThreadPoolExecutor(self.in_flight) as executor:
+            pending = {}
+            for idx, batch in enumerate(batches):
+                pending[executor.submit(self.refine, batch)] = idx
+                if len(pending) >= self.in_flight:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield pending.pop(future), future.result()
+            for future in as_completed(list(pending)):
+                yield pending.pop(future), future.result()
+
+    def close(self):
+        """Shut down the thread pool of the scale front passes"""
+        self.scale_pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -5,6 +5,7 @@ import torch
 import yaml
 import glob
 import argparse
+import cv2
 from PIL import Image
 from omegaconf import OmegaConf
 from pathlib import Path
@@ -104,7 +105,7 @@ def build_lama_model(
         predict_config.model.path, 'models',
         predict_config.model.checkpoint
     )
-    model = load_checkpoint(train_config, checkpoint_path, strict=False)
+    model = load_checkpoint(train_config, checkpoint_path, strict=False, map_location='cpu')
     model.to(device)
     model.freeze()
     return model
@@ -146,6 +147,176 @@ def inpaint_img_with_builded_lama(
     return cur_res
 
 
+def lama_batches(imgs, batch_size=8):
+    """Index lists of consecutive images of the same size, at most `batch_size` long."""
+    batch = []
+    for idx, img in enumerate(imgs):
+        if batch and (len(batch) == batch_size or img.shape != imgs[batch[0]].shape):
+            yield batch
+            batch = []
+        batch.append(idx)
+    if batch:
+        yield batch
+
+
+def _lama_host_batch(imgs, masks, idxs, mod=8, pin=False):
+    image = torch.from_numpy(np.stack([imgs[i] for i in idxs])).permute(0, 3, 1, 2).float().div(255.)
+    mask = torch.from_numpy(np.stack([np.asarray(masks[i]) > 0 for i in idxs])).float()[:, None]
+    image = pad_tensor_to_modulo(image, mod)
+    mask = pad_tensor_to_modulo(mask, mod)
+    if pin:
+        image, mask = image.pin_memory(), mask.pin_memory()
+    return image, mask
+
+
+@torch.no_grad()
+def inpaint_imgs_with_builded_lama(
+        model,
+        imgs,
+        masks,
+        batch_size=8,
+        mod=8,
+        device="cuda"
+):
+    """Yields (index, inpainted image) for a list of images and masks, in order.
+
+    Consecutive images of the same size run as one batch of up to
+    `batch_size`. On CUDA, the next batch is stacked, padded and copied to
+    the device on a side stream while the current one runs, and results are
+    copied back as uint8 through a pinned buffer.
+    """
+    device = torch.device(device)
+    cuda = device.type == "cuda"
+    copy_stream = torch.cuda.Stream(device) if cuda else None
+
+    def upload(idxs):
+        image, mask = _lama_host_batch(imgs, masks, idxs, mod, pin=cuda)
+        if not cuda:
+            return image.to(device), mask.to(device)
+        with torch.cuda.stream(copy_stream):
+            return image.to(device, non_blocking=True), mask.to(device, non_blocking=True)
+
+    batches = list(lama_batches(imgs, batch_size))
+    pinned = {}  # page-locked output buffer per batch shape, reused
+    pending = upload(batches[0]) if batches else None
+    for k, idxs in enumerate(batches):
+        image, mask = pending
+        if cuda:
+            stream = torch.cuda.current_stream(device)
+            stream.wait_stream(copy_stream)
+            image.record_stream(stream)
+            mask.record_stream(stream)
+        height, width = imgs[idxs[0]].shape[:2]
+        batch = model({'image': image, 'mask': mask})
+        res = batch["inpainted"][:, :, :height, :width].permute(0, 2, 3, 1)
+        res = (res * 255).clamp(0, 255).to(torch.uint8)
+        if cuda:
+            if res.shape not in pinned:
+                pinned[res.shape] = torch.empty(res.shape, dtype=torch.uint8, pin_memory=True)
+            out = pinned[res.shape]
+            out.copy_(res, non_blocking=True)
+            done = torch.cuda.Event()
+            done.record(stream)
+        else:
+            out = res
+        # prepare the next batch while this one runs
+        if k + 1 < len(batches):
+            pending = upload(batches[k + 1])
+        if cuda:
+            done.synchronize()
+        out = out.numpy()
+        for j, idx in enumerate(idxs):
+            yield idx, out[j].copy()
+
+
+def lama_refine_batch(img: np.ndarray, mask: np.ndarray, mod=8):
+    """Batch of one image for refine_predict / RefinementEngine.refine."""
+    image = torch.from_numpy(img).float().div(255.).permute(2, 0, 1)[None]
+    mask = torch.from_numpy((np.asarray(mask) > 0).astype(np.float32))[None, None]
+    return {
+        'image': pad_tensor_to_modulo(image, mod),
+        'mask': pad_tensor_to_modulo(mask, mod),
+        'unpad_to_size': [torch.tensor([img.shape[0]]), torch.tensor([img.shape[1]])],
+    }
+
+
+def refine_imgs_with_builded_lama(engine, imgs, masks, mod=8):
+    """Yields (index, inpainted image) refined by a RefinementEngine
+    (saicinpainting.evaluation.refinement), in completion order. Images
+    above the engine's px_budget come back downscaled."""
+    batches = (lama_refine_batch(img, mask, mod) for img, mask in zip(imgs, masks))
+    for idx, res in engine.refine_many(batches):
+        yield idx, np.clip(res[0].permute(1, 2, 0).numpy() * 255, 0, 255).astype('uint8')
+
+
+def lama_crop_window(mask: np.ndarray, context=0.5, min_context=32):
+    """(y0, y1, x0, x1) of the mask bounding box grown by `context` times
+    its larger side (at least `min_context` pixels) on each side, clipped
+    to the image; None for an empty mask."""
+    ys, xs = np.nonzero(mask)
+    if len(ys) == 0:
+        return None
+    y0, y1, x0, x1 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+    margin = int(max(min_context, context * max(y1 - y0, x1 - x0)))
+    h, w = mask.shape[:2]
+    return max(0, y0 - margin), min(h, y1 + margin), max(0, x0 - margin), min(w, x1 + margin)
+
+
+@torch.no_grad()
+def inpaint_img_with_builded_lama_crop(
+        model,
+        img: np.ndarray,
+        mask: np.ndarray,
+        work_size=512,
+        context=0.5,
+        min_context=32,
+        feather=8,
+        max_window_fraction=0.5,
+        mod=8,
+        device="cuda"
+):
+    """inpaint_img_with_builded_lama on a window around the mask only.
+
+    A window covering more than `max_window_fraction` of the image would lose
+    resolution and global context for little gain: the full image is
+    inpainted instead.
+
+    The window (lama_crop_window) is downscaled to at most `work_size`
+    pixels on its longer side, inpainted, scaled back and blended into the
+    image with an alpha that is 1 on the mask and falls off over about
+    2 * `feather` pixels outside it, so nothing changes at the window edge.
+    """
+    assert len(mask.shape) == 2
+    mask = (mask > 0).astype(np.uint8)
+    window = lama_crop_window(mask, context, max(min_context, 2 * feather + 1))
+    if window is None:
+        return img.copy()
+    y0, y1, x0, x1 = window
+    if (y1 - y0) * (x1 - x0) > max_window_fraction * mask.size:
+        return inpaint_img_with_builded_lama(model, img, mask, mod=mod, device=device)
+    crop = img[y0:y1, x0:x1]
+    crop_mask = mask[y0:y1, x0:x1]
+    h, w = crop_mask.shape
+
+    scale = min(1., work_size / max(h, w))
+    if scale < 1:
+        size = (max(mod, int(round(w * scale))), max(mod, int(round(h * scale))))
+        small = cv2.resize(crop, size, interpolation=cv2.INTER_AREA)
+        # any coverage of a low-resolution pixel keeps it in the hole
+        small_mask = (cv2.resize(crop_mask.astype(np.float32), size, interpolation=cv2.INTER_AREA) > 0).astype(np.uint8)
+    else:
+        small, small_mask = crop, crop_mask
+    res = inpaint_img_with_builded_lama(model, small, small_mask, mod=mod, device=device)
+    if scale < 1:
+        res = cv2.resize(res, (w, h), interpolation=cv2.INTER_CUBIC)
+
+    k = 2 * feather + 1
+    alpha = cv2.dilate(crop_mask, np.ones((k, k), np.uint8)).astype(np.float32)
+    alpha = np.maximum(cv2.GaussianBlur(alpha, (k, k), 0), crop_mask)[:, :, None]
+    out = img.copy()
+    out[y0:y1, x0:x1] = np.clip(alpha * res + (1 - alpha) * crop, 0, 255).round().astype('uint8')
+    return out
+
 
 def setup_args(parser):
     parser.add_argument(
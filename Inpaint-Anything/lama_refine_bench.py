@@ -0,0 +1,117 @@
+import sys
+import copy
+import json
+import time
+import argparse
+import numpy as np
+import cv2
+import torch
+
+from lama_inpaint import build_lama_model, refine_imgs_with_builded_lama
+from saicinpainting.evaluation.refinement import RefinementEngine
+from utils import load_img_to_array, dilate_mask
+
+
+def setup_args(parser):
+    parser.add_argument(
+        "--lama_config", type=str,
+        default="./lama/configs/prediction/default.yaml",
+        help="The path to the config file of lama model. "
+             "Default: the config of big-lama",
+    )
+    parser.add_argument(
+        "--lama_ckpt", type=str, required=True,
+        help="The path to the lama checkpoint.",
+    )
+    parser.add_argument(
+        "--input_img", type=str, default=None,
+        help="Image to refine (repeated). Default: a synthetic 512x512 image.",
+    )
+    parser.add_argument(
+        "--input_mask", type=str, default=None,
+        help="Mask of --input_img. Default: a centered rectangle.",
+    )
+    parser.add_argument(
+        "--num_images", type=int, default=8,
+        help="Images refined per configuration.",
+    )
+    parser.add_argument(
+        "--devices", type=str, default="cuda:0",
+        help="Device splits to compare, separated by ';', e.g. 'cuda:0;cuda:0,cuda:1'.",
+    )
+    parser.add_argument(
+        "--threads", type=str, default="1,2,4",
+        help="Images in flight to compare on CPU ('cpu' in --devices).",
+    )
+    parser.add_argument(
+        "--n_iters", type=int, default=15,
+        help="Refinement iterations per scale.",
+    )
+    parser.add_argument(
+        "--out", type=str, default=None,
+        help="Write the results as JSON.",
+    )
+
+
+def synthetic_pair(size=512, seed=0):
+    rng = np.random.default_rng(seed)
+    img = cv2.GaussianBlur(rng.integers(0, 256, (size, size, 3), dtype=np.uint8), (31, 31), 0)
+    mask = np.zeros((size, size), np.uint8)
+    mask[size // 3:2 * size // 3, size // 3:2 * size // 3] = 255
+    return img, mask
+
+
+def run(model, devices, in_flight, scale_workers, imgs, masks, n_iters):
+    """Images per minute of one engine configuration, after one warm-up image."""
+    with RefinementEngine(copy.deepcopy(model), devices, n_iters=n_iters,
+                          in_flight=in_flight, scale_workers=scale_workers) as engine:
+        list(refine_imgs_with_builded_lama(engine, imgs[:1], masks[:1]))
+        t0 = time.time()
+        for _ in refine_imgs_with_builded_lama(engine, imgs, masks):
+            pass
+        for device in engine.devices:
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+        seconds = time.time() - t0
+    return {"devices": [str(d) for d in engine.devices], "in_flight": engine.in_flight,
+            "scale_workers": scale_workers, "images": len(imgs), "seconds": seconds,
+            "images_per_min": 60. * len(imgs) / seconds}
+
+
+if __name__ == "__main__":
+    """Example usage:
+    python lama_refine_bench.py \
+        --lama_ckpt ./pretrained_models/big-lama \
+        --devices "cuda:0;cuda:0,cuda:1;cpu" --threads 1,2,4
+    """
+    parser = argparse.ArgumentParser()
+    setup_args(parser)
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.input_img is not None:
+        img = load_img_to_array(args.input_img)
+        mask = dilate_mask(load_img_to_array(args.input_mask), 15)
+    else:
+        img, mask = synthetic_pair()
+    imgs, masks = [img] * args.num_images, [mask] * args.num_images
+
+    model = build_lama_model(args.lama_config, args.lama_ckpt, device="cpu")
+    cores = torch.get_num_threads()
+    rows = []
+    for split in [s for s in args.devices.split(";") if s]:
+        devices = split.split(",")
+        if devices[0] == "cpu":
+            configs = [int(t) for t in args.threads.split(",")]
+        else:
+            configs = [1, len(devices)]
+        for in_flight in sorted(set(configs)):
+            if devices[0] == "cpu":
+                torch.set_num_threads(max(1, cores // in_flight))
+            # in_flight=1, scale_workers=1 is the sequential refine_predict
+            for scale_workers in (1, 3):
+                rows.append(run(model, devices, in_flight, scale_workers, imgs, masks, args.n_iters))
+                print("devices=%-20s in_flight=%d scale_workers=%d: %.1f images/min" % (
+                    split, in_flight, scale_workers, rows[-1]["images_per_min"]))
+    torch.set_num_threads(cores)
+    if args.out:
+        json.dump(rows, open(args.out, "w"), indent=1)
@@ -14,7 +14,7 @@ import matplotlib.patches as patches
 from typing import Any, Dict, List
 from pytracking.lib.test.evaluation.data import Sequence
 from sam_segment import build_sam_model
-from lama_inpaint import build_lama_model, inpaint_img_with_builded_lama
+from lama_inpaint import build_lama_model, inpaint_imgs_with_builded_lama
 from ostrack import build_ostrack_model, get_box_using_ostrack
 from utils import load_img_to_array, save_array_to_img, dilate_mask, \
     show_mask, show_points, get_clicked_point
@@ -67,6 +67,10 @@ def setup_args(parser):
         "--lama_ckpt", type=str, required=True,
         help="The path to the lama checkpoint.",
     )
+    parser.add_argument(
+        "--lama_batch_size", type=int, default=8,
+        help="Number of frames inpainted together by lama.",
+    )
     parser.add_argument(
         "--tracker_ckpt", type=str, required=True,
         help="The path to tracker checkpoint.",
@@ -293,6 +297,7 @@ class RemoveAnything3D(nn.Module):
         self.tracker_target = tracker_target
         self.segmentor_target = segmentor_target
         self.inpainter_target = inpainter_target
+        self.lama_batch_size = getattr(args, "lama_batch_size", 8)
 
     def build_tracker(self, target, **kwargs):
         assert target == "ostrack", "Only support sam now."
@@ -331,9 +336,10 @@ class RemoveAnything3D(nn.Module):
 
     def forward_inpainter(self, images, masks):
         if self.inpainter_target == "lama":
-            for idx in range(len(images)):
-                images[idx] = inpaint_img_with_builded_lama(
-                    self.inpainter, images[idx], masks[idx], device=self.device)
+            for idx, image in inpaint_imgs_with_builded_lama(
+                    self.inpainter, images, masks,
+                    batch_size=self.lama_batch_size, device=self.device):
+                images[idx] = image
         else:
             raise NotImplementedError
         return images
@@ -15,7 +15,7 @@ import imageio.v2 as iio
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 from sam_segment import build_sam_model
-from lama_inpaint import build_lama_model, inpaint_img_with_builded_lama
+from lama_inpaint import build_lama_model, inpaint_imgs_with_builded_lama
 from ostrack import build_ostrack_model, get_box_using_ostrack
 from sttn_video_inpaint import build_sttn_model, \
     inpaint_video_with_builded_sttn
@@ -68,6 +68,10 @@ def setup_args(parser):
         "--lama_ckpt", type=str, required=True,
         help="The path to the lama checkpoint.",
     )
+    parser.add_argument(
+        "--lama_batch_size", type=int, default=8,
+        help="Number of frames inpainted together by lama.",
+    )
     parser.add_argument(
         "--tracker_ckpt", type=str, required=True,
         help="The path to tracker checkpoint.",
@@ -121,6 +125,7 @@ class RemoveAnythingVideo(nn.Module):
         self.tracker_target = tracker_target
         self.segmentor_target = segmentor_target
         self.inpainter_target = inpainter_target
+        self.lama_batch_size = getattr(args, "lama_batch_size", 8)
 
     def build_tracker(self, target, **kwargs):
         assert target == "ostrack", "Only support sam now."
@@ -162,9 +167,10 @@ class RemoveAnythingVideo(nn.Module):
 
     def forward_inpainter(self, frames, masks):
         if self.inpainter_target == "lama":
-            for idx in range(len(frames)):
-                frames[idx] = inpaint_img_with_builded_lama(
-                    self.inpainter, frames[idx], masks[idx], device=self.device)
+            for idx, frame in inpaint_imgs_with_builded_lama(
+                    self.inpainter, frames, masks,
+                    batch_size=self.lama_batch_size, device=self.device):
+                frames[idx] = frame
         elif self.inpainter_target == "sttn":
             frames = [Image.fromarray(frame) for frame in frames]
             masks = [Image.fromarray(np.uint8(mask * 255)) for mask in masks]
@@ -63,10 +63,14 @@ def generate_single_object_with_box(
     saved_cross_attn_keys,
     sam_refine_kwargs,
     num_inference_steps,
+    saved_attn_steps=None,
     verbose=False,
     visualize=False,
     **kwargs,
 ):
+    """
+    saved_attn_steps: number of steps whose cross-attention for `saved_cross_attn_keys` is kept (for reference attention in the overall generation), all steps if None
+    """
     bboxes, phrases, words = [box], [phrase], [word]
 
     if verbose:
@@ -89,6 +93,14 @@ def generate_single_object_with_box(
         print("object positions:", object_positions)
         print("word_token_index:", word_token_index)
 
+    # Kept on the device: the mean attention of `obj_attn_key` for SAM as a running sum, and the attention of `saved_cross_attn_keys` per step for the steps with reference attention
+    saved_attns = attn.AttentionAccumulator(
+        aggregate_keys=[obj_attn_key],
+        step_keys=saved_cross_attn_keys,
+        aggregation_step_start=attn_aggregation_step_start,
+        keep_steps=saved_attn_steps,
+    )
+
     # `offload_guidance_cross_attn_to_cpu` will greatly slow down generation
     (
         latents,
@@ -116,6 +128,7 @@ def generate_single_object_with_box(
         return_box_vis=True,
         save_all_latents=True,
         dynamic_num_inference_steps=True,
+        saved_attn_accumulator=saved_attns,
         **kwargs,
     )
     # `saved_cross_attn_keys` kwargs may have duplicates
@@ -422,6 +435,7 @@ def run(
                 num_inference_steps=num_inference_steps,
                 fast_after_steps=fast_after_steps,
                 fast_rate=2,
+                saved_attn_steps=overall_max_index_step,
                 verbose=verbose,
             )
         else:
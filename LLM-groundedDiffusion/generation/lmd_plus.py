@@ -54,10 +54,14 @@ def generate_single_object_with_box(
     sam_refine_kwargs,
     num_inference_steps,
     gligen_scheduled_sampling_beta=0.3,
+    saved_attn_steps=None,
     verbose=False,
     visualize=False,
     **kwargs,
 ):
+    """
+    saved_attn_steps: number of steps whose cross-attention for `saved_cross_attn_keys` is kept (for reference attention in the overall generation), all steps if None
+    """
     bboxes, phrases, words = [box], [phrase], [word]
 
     if verbose:
@@ -79,6 +83,13 @@ def generate_single_object_with_box(
     if verbose:
         print("word_token_index:", word_token_index)
 
+    # Kept on the device: the attention of `saved_cross_attn_keys` per step for the steps with reference attention
+    # No aggregate: the object mask comes from SAM, not from the attention of `obj_attn_key`
+    saved_attns = attn.AttentionAccumulator(
+        step_keys=saved_cross_attn_keys,
+        keep_steps=saved_attn_steps,
+    )
+
     # `offload_guidance_cross_attn_to_cpu` will greatly slow down generation
     (
         latents,
@@ -107,6 +118,7 @@ def generate_single_object_with_box(
         return_box_vis=True,
         save_all_latents=True,
         dynamic_num_inference_steps=True,
+        saved_attn_accumulator=saved_attns,
         **kwargs,
     )
     # `saved_cross_attn_keys` kwargs may have duplicates
@@ -145,13 +157,138 @@ def generate_single_object_with_box(
     )
 
 
+def generate_single_objects_with_boxes(
+    prompts,
+    boxes,
+    phrases,
+    words,
+    input_latents_list,
+    input_embeddings,
+    semantic_guidance_kwargs,
+    obj_attn_key,
+    saved_cross_attn_keys,
+    sam_refine_kwargs,
+    num_inference_steps,
+    gligen_scheduled_sampling_beta=0.3,
+    saved_attn_steps=None,
+    verbose=False,
+    visualize=False,
+    **kwargs,
+):
+    """
+    Batched `generate_single_object_with_box`: the single-object latents are denoised together in one UNet batch
+    (with per-sample GLIGEN boxes/phrases) and SAM runs once over all single-object images.
+    input_embeddings: (uncond_embeddings, cond_embeddings), with one cond embedding per prompt
+    Returns a list with the outputs of `generate_single_object_with_box` for each box.
+    """
+    object_positions_list, word_token_index_list = [], []
+    for prompt, phrase, word in zip(prompts, phrases, words):
+        if verbose:
+            print(f"Getting token map (prompt: {prompt})")
+
+        object_positions, word_token_indices = guidance.get_phrase_indices(
+            tokenizer=tokenizer,
+            prompt=prompt,
+            phrases=[phrase],
+            words=[word],
+            return_word_token_indices=True,
+            add_suffix_if_not_found=False,
+            verbose=verbose,
+        )
+        object_positions_list.append(object_positions)
+        word_token_index_list.append(word_token_indices[0])
+
+    if verbose:
+        print("word_token_index_list:", word_token_index_list)
+
+    bboxes, phrases = [[box] for box in boxes], [[phrase] for phrase in phrases]
+
+    # Attention is saved for the words of all the samples (a few maps each), sample i keeps its own word (index i) below
+    saved_attns = attn.AttentionAccumulator(
+        step_keys=saved_cross_attn_keys,
+        keep_steps=saved_attn_steps,
+    )
+    (
+        latents,
+        single_object_images,
+        saved_attns,
+        single_object_pil_images_box_ann,
+        latents_all,
+    ) = pipelines.generate_gligen(
+        model_dict,
+        torch.cat(input_latents_list, dim=0),
+        input_embeddings,
+        num_inference_steps,
+        bboxes,
+        phrases,
+        gligen_scheduled_sampling_beta=gligen_scheduled_sampling_beta,
+        guidance_scale=guidance_scale,
+        return_saved_cross_attn=True,
+        semantic_guidance=True,
+        semantic_guidance_bboxes=bboxes,
+        semantic_guidance_object_positions=object_positions_list,
+        semantic_guidance_kwargs=semantic_guidance_kwargs,
+        saved_cross_attn_keys=[obj_attn_key, *saved_cross_attn_keys],
+        return_cond_ca_only=True,
+        return_token_ca_only=torch.tensor(word_token_index_list),
+        offload_cross_attn_to_cpu=offload_cross_attn_to_cpu,
+        return_box_vis=True,
+        save_all_latents=True,
+        dynamic_num_inference_steps=True,
+        batched_condition=True,
+        saved_attn_accumulator=saved_attns,
+        **kwargs,
+    )
+
+    utils.free_memory()
+
+    if visualize:
+        print("Single object images")
+        for single_object_pil_image_box_ann in single_object_pil_images_box_ann:
+            vis.display(single_object_pil_image_box_ann)
+
+    mask_selected_batched_list, _ = sam.sam_refine_boxes(
+        sam_input_images=list(single_object_images),
+        boxes=bboxes,
+        model_dict=model_dict,
+        verbose=verbose,
+        **sam_refine_kwargs,
+    )
+
+    # Copies rather than views, so that each box only keeps its own latents and attention (not the whole batch, N x N words for the attention)
+    outputs = []
+    for i, (mask_selected_list, single_object_pil_image_box_ann) in enumerate(
+        zip(mask_selected_batched_list, single_object_pil_images_box_ann)
+    ):
+        saved_attns_item = saved_attns.map(
+            lambda saved_attn, i=i: {
+                key: attn_map[i : i + 1, ..., i : i + 1].clone()
+                for key, attn_map in saved_attn.items()
+            }
+        )
+        outputs.append(
+            (
+                latents_all[:, i : i + 1].clone(),
+                torch.tensor(mask_selected_list[0]),
+                saved_attns_item,
+                single_object_pil_image_box_ann,
+            )
+        )
+
+    return outputs
+
+
 def get_masked_latents_all_list(
     so_prompt_phrase_word_box_list,
     input_latents_list,
     so_input_embeddings,
+    batch_size=None,
     verbose=False,
     **kwargs,
 ):
+    """
+    batch_size: number of boxes generated together (all of them by default). 1 runs `generate_single_object_with_box` on each box.
+    """
     latents_all_list, mask_tensor_list, saved_attns_list, so_img_list = [], [], [], []
 
     if not so_prompt_phrase_word_box_list:
@@ -159,6 +296,34 @@ def get_masked_latents_all_list(
 
     so_uncond_embeddings, so_cond_embeddings = so_input_embeddings
 
+    if batch_size is None:
+        batch_size = len(so_prompt_phrase_word_box_list)
+
+    if batch_size > 1:
+        for start in range(0, len(so_prompt_phrase_word_box_list), batch_size):
+            items = so_prompt_phrase_word_box_list[start : start + batch_size]
+            prompts, phrases, words, boxes = (list(item) for item in zip(*items))
+            outputs = generate_single_objects_with_boxes(
+                prompts,
+                boxes,
+                phrases,
+                words,
+                input_latents_list[start : start + batch_size],
+                input_embeddings=(
+                    so_uncond_embeddings,
+                    so_cond_embeddings[start : start + batch_size],
+                ),
+                verbose=verbose,
+                **kwargs,
+            )
+            for latents_all, mask_tensor, saved_attns, so_img in outputs:
+                latents_all_list.append(latents_all)
+                mask_tensor_list.append(mask_tensor)
+                saved_attns_list.append(saved_attns)
+                so_img_list.append(so_img)
+
+        return latents_all_list, mask_tensor_list, saved_attns_list, so_img_list
+
     for idx, ((prompt, phrase, word, box), input_latents) in enumerate(
         zip(so_prompt_phrase_word_box_list, input_latents_list)
     ):
@@ -224,6 +389,7 @@ def run(
     # Use reference cross attention to guide the cross attention in the overall generation
     use_ref_ca=True,
     use_autocast=True,
+    so_batch_size=4,
     verbose=False,
 ):
     """
@@ -250,6 +416,7 @@ def run(
     use_fast_schedule: since the per-box generation, after the steps for latent and attention transfer, is only used by SAM (which does not need to be precise), we skip steps after the steps needed for transfer with a fast schedule.
     use_ref_ca: Use reference cross attention to guide the cross attention in the overall generation
     use_autocast: enable automatic mixed precision (saves memory and makes generation faster)
+    so_batch_size: number of per-box generations denoised together in one UNet batch (None for all boxes, 1 for one box at a time)
     Note: attention guidance is disabled for per-box generation by default (`max_index_step` set to 0) because we did not find it improving the results. Attention guidance and reference attention are still enabled for final guidance (overall generation). They greatly improve attribute binding compared to GLIGEN.
     """
 
@@ -384,6 +551,8 @@ def run(
                 num_inference_steps=num_inference_steps,
                 fast_after_steps=fast_after_steps,
                 fast_rate=2,
+                saved_attn_steps=overall_max_index_step,
+                batch_size=so_batch_size,
                 verbose=verbose,
             )
         else:
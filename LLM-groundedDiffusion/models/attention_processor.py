@@ -293,6 +293,36 @@ class Attention(nn.Module):
         return encoder_hidden_states
 
 
+class AttentionLogSumExp(torch.autograd.Function):
+    """
+    logsumexp_j(q_i . k_j * scale) over all the keys, in float32 (or float64 for float64 inputs). It is computed over chunks of `chunk_size`
+    queries, and the backward pass recomputes the scores chunk by chunk, so the (queries, keys) scores are never kept in full.
+    query: (..., queries, dim), key: (..., keys, dim) -> (..., queries)
+    """
+    @staticmethod
+    def forward(ctx, query, key, scale, chunk_size):
+        dtype = torch.promote_types(query.dtype, torch.float32)
+        key_t = key.to(dtype).transpose(-1, -2)
+        lse = torch.cat([torch.logsumexp(torch.matmul(query_chunk.to(dtype), key_t) * scale, dim=-1) for query_chunk in query.split(chunk_size, dim=-2)], dim=-1)
+        ctx.save_for_backward(query, key, lse)
+        ctx.scale, ctx.chunk_size = scale, chunk_size
+        return lse
+
+    @staticmethod
+    def backward(ctx, grad_lse):
+        query, key, lse = ctx.saved_tensors
+        scale, chunk_size = ctx.scale, ctx.chunk_size
+        key_up = key.to(lse.dtype)
+        grad_query, grad_key = [], torch.zeros_like(key_up)
+        for query_chunk, lse_chunk, grad_chunk in zip(query.split(chunk_size, dim=-2), lse.split(chunk_size, dim=-1), grad_lse.split(chunk_size, dim=-1)):
+            query_chunk = query_chunk.to(lse.dtype)
+            # d lse_i / d s_ij is the attention probability p_ij
+            probs = torch.exp(torch.matmul(query_chunk, key_up.transpose(-1, -2)) * scale - lse_chunk[..., None]) * grad_chunk[..., None]
+            grad_query.append(torch.matmul(probs, key_up) * scale)
+            grad_key += torch.matmul(probs.transpose(-1, -2), query_chunk) * scale
+        return torch.cat(grad_query, dim=-2).to(query.dtype), grad_key.to(key.dtype), None, None
+
+
 class AttnProcessor:
     r"""
     Processor for implementing scaled dot-product attention (enabled by default if you're using PyTorch 2.0).
@@ -374,6 +404,77 @@ class AttnProcessor:
 
         return hidden_states
 
+    def __call_token_ca__(
+        self,
+        attn: Attention,
+        hidden_states,
+        encoder_hidden_states,
+        temb=None,
+        token_indices=None,
+    ):
+        """
+        Cross-attention with the fused kernel as in `__call_fast__`, plus the attention probabilities of the `token_indices` text tokens only:
+        p = exp(q . k_token * scale - logsumexp_j(q . k_j * scale)), without the full (batch * heads, 2d dimension, text tokens) probabilities.
+        Returns the output and the probabilities (batch size, n heads, 2d dimension, num selected tokens).
+        """
+        residual = hidden_states
+
+        if attn.spatial_norm is not None:
+            hidden_states = attn.spatial_norm(hidden_states, temb)
+
+        input_ndim = hidden_states.ndim
+
+        if input_ndim == 4:
+            batch_size, channel, height, width = hidden_states.shape
+            hidden_states = hidden_states.view(batch_size, channel, height * width).transpose(1, 2)
+
+        batch_size = encoder_hidden_states.shape[0]
+
+        if attn.group_norm is not None:
+            hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
+
+        query = attn.to_q(hidden_states)
+
+        if attn.norm_cross:
+            encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+
+        key = attn.to_k(encoder_hidden_states)
+        value = attn.to_v(encoder_hidden_states)
+
+        head_dim = query.shape[-1] // attn.heads
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+        hidden_states = F.scaled_dot_product_attention(
+            query, key, value, attn_mask=None, dropout_p=0.0, is_causal=False
+        )
+
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+        hidden_states = hidden_states.to(query.dtype)
+
+        # linear proj
+        hidden_states = attn.to_out[0](hidden_states)
+        # dropout
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if input_ndim == 4:
+            hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
+
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+
+        hidden_states = hidden_states / attn.rescale_output_factor
+
+        if isinstance(token_indices, int):
+            token_indices = [token_indices]
+        # (batch size, n heads, 2d dimension): normalizer over all the text tokens
+        lse = AttentionLogSumExp.apply(query, key, attn.scale, 1024)
+        token_scores = torch.matmul(query.float(), key[:, :, token_indices].float().transpose(-1, -2)) * attn.scale
+        attention_probs = torch.exp(token_scores - lse[..., None]).to(query.dtype)
+
+        return hidden_states, attention_probs
+
     def __call__(
         self,
         attn: Attention,
@@ -390,10 +491,12 @@ class AttnProcessor:
         save_attn_to_dict=None,
         save_keys=None,
         enable_flash_attn=True,
+        fused_token_ca=True,
     ):
         """
         attn_key: current key (a tuple of hierarchy index (up/mid/down, stage id, block id, sub-block id), sub block id should always be 0 in SD UNet)
         save_attn_to_dict: pass in a dict to save to dict
+        fused_token_ca: with `return_token_ca_only`, compute the output with the fused kernel and the probabilities of the selected tokens only (`__call_token_ca__`)
         """
         cross_attn = encoder_hidden_states is not None
         
@@ -404,6 +507,16 @@ class AttnProcessor:
             with torch.backends.cuda.sdp_kernel(enable_flash=enable_flash_attn, enable_math=True, enable_mem_efficient=enable_flash_attn):
                 return self.__call_fast__(attn, hidden_states, encoder_hidden_states, attention_mask, temb)
         
+        if fused_token_ca and return_token_ca_only is not None and attn_process_fn is None and attention_mask is None:
+            # The memory-efficient kernel supports backward and does not keep the probabilities: allowed even when flash attention is
+            # disabled (as in the guidance passes), otherwise SDPA falls back to the math kernel and keeps the full probabilities
+            with torch.backends.cuda.sdp_kernel(enable_flash=enable_flash_attn, enable_math=True, enable_mem_efficient=True):
+                hidden_states, attention_probs_unflattened = self.__call_token_ca__(attn, hidden_states, encoder_hidden_states, temb, return_token_ca_only)
+            attention_probs_unflattened = self.save_attention_probs(attention_probs_unflattened, attn_key, return_cond_ca_only, offload_cross_attn_to_cpu, save_attn_to_dict, save_keys)
+            if return_attntion_probs:
+                return hidden_states, attention_probs_unflattened
+            return hidden_states
+        
         residual = hidden_states
 
         if attn.spatial_norm is not None:
@@ -471,17 +584,24 @@ class AttnProcessor:
                 else:
                     # return_token_ca_only: A 1d index tensor
                     attention_probs_unflattened = attention_probs_unflattened[:, :, :, return_token_ca_only]
-            if return_cond_ca_only:
-                assert batch_size % 2 == 0, f"Samples are not in pairs: {batch_size} samples"
-                attention_probs_unflattened = attention_probs_unflattened[batch_size // 2:]
-            if offload_cross_attn_to_cpu:
-                attention_probs_unflattened = attention_probs_unflattened.cpu()
-            if save_attn_to_dict is not None and (save_keys is None or (tuple(attn_key) in save_keys)):
-                save_attn_to_dict[tuple(attn_key)] = attention_probs_unflattened
+            attention_probs_unflattened = self.save_attention_probs(attention_probs_unflattened, attn_key, return_cond_ca_only, offload_cross_attn_to_cpu, save_attn_to_dict, save_keys)
             if return_attntion_probs:
                 return hidden_states, attention_probs_unflattened
         return hidden_states
 
+    @staticmethod
+    def save_attention_probs(attention_probs_unflattened, attn_key, return_cond_ca_only, offload_cross_attn_to_cpu, save_attn_to_dict, save_keys):
+        """ attention_probs_unflattened: (batch size, n heads, 2d dimension, num text tokens). Returns what is saved. """
+        batch_size = attention_probs_unflattened.shape[0]
+        if return_cond_ca_only:
+            assert batch_size % 2 == 0, f"Samples are not in pairs: {batch_size} samples"
+            attention_probs_unflattened = attention_probs_unflattened[batch_size // 2:]
+        if offload_cross_attn_to_cpu:
+            attention_probs_unflattened = attention_probs_unflattened.cpu()
+        if save_attn_to_dict is not None and (save_keys is None or (tuple(attn_key) in save_keys)):
+            save_attn_to_dict[tuple(attn_key)] = attention_probs_unflattened
+        return attention_probs_unflattened
+
 # For typing
 AttentionProcessor = AttnProcessor
 
@@ -9,15 +9,48 @@ from .attention import GatedSelfAttentionDense
 from .models import process_input_embeddings, torch_device
 import warnings
 
+try:
+    # Timing spans when run from the GenArtist agent (agent_trace.py)
+    from agent_trace import span, span_iter
+except ImportError:
+    from contextlib import nullcontext
+
+    def span(name, **attrs):
+        return nullcontext()
+
+    def span_iter(name, iterable, **attrs):
+        return iterable
+
 # All keys: [('down', 0, 0, 0), ('down', 0, 1, 0), ('down', 1, 0, 0), ('down', 1, 1, 0), ('down', 2, 0, 0), ('down', 2, 1, 0), ('mid', 0, 0, 0), ('up', 1, 0, 0), ('up', 1, 1, 0), ('up', 1, 2, 0), ('up', 2, 0, 0), ('up', 2, 1, 0), ('up', 2, 2, 0), ('up', 3, 0, 0), ('up', 3, 1, 0), ('up', 3, 2, 0)]
 # Note that the first up block is `UpBlock2D` rather than `CrossAttnUpBlock2D` and does not have attention. The last index is always 0 in our case since we have one `BasicTransformerBlock` in each `Transformer2DModel`.
 DEFAULT_GUIDANCE_ATTN_KEYS = [("mid", 0, 0, 0), ("up", 1, 0, 0), ("up", 1, 1, 0), ("up", 1, 2, 0)]
 
-def latent_backward_guidance(scheduler, unet, cond_embeddings, index, bboxes, object_positions, t, latents, loss, loss_scale = 30, loss_threshold = 0.2, max_iter = 5, max_index_step = 10, cross_attention_kwargs=None, ref_ca_saved_attns=None, guidance_attn_keys=None, verbose=False, clear_cache=False, **kwargs):
+def token_subset(object_positions, word_token_indices=None):
+    """
+    The text tokens used by the attention losses, and `object_positions` and `word_token_indices` as indices into them,
+    for saving the cross-attention of these tokens only (`return_token_ca_only`).
+    """
+    tokens = sorted(set(position for positions in object_positions for position in positions) | set(word_token_indices or []))
+    column = {token: i for i, token in enumerate(tokens)}
+    object_positions = [[column[position] for position in positions] for positions in object_positions]
+    if word_token_indices is not None:
+        word_token_indices = [column[token] for token in word_token_indices]
+    return tokens, object_positions, word_token_indices
+
+def latent_backward_guidance(scheduler, unet, cond_embeddings, index, bboxes, object_positions, t, latents, loss, loss_scale = 30, loss_threshold = 0.2, max_iter = 5, max_index_step = 10, cross_attention_kwargs=None, ref_ca_saved_attns=None, guidance_attn_keys=None, verbose=False, clear_cache=False, token_subset_ca=True, **kwargs):
+    """
+    token_subset_ca: compute and save the attention of the tokens in `object_positions` (and `word_token_indices`) only, with the fused attention kernel (see `AttnProcessor.__call_token_ca__`)
+    """
 
     iteration = 0
     
     if index < max_index_step:
+        tokens = None
+        if token_subset_ca:
+            tokens, object_positions, word_token_indices = token_subset(object_positions, kwargs.get('word_token_indices'))
+            if word_token_indices is not None:
+                kwargs['word_token_indices'] = word_token_indices
+        
         if isinstance(max_iter, list):
             if len(max_iter) > index:
                 max_iter = max_iter[index]
@@ -36,14 +69,16 @@ def latent_backward_guidance(scheduler, unet, cond_embeddings, index, bboxes, ob
             
             if cross_attention_kwargs is not None:
                 full_cross_attention_kwargs.update(cross_attention_kwargs)
+            if tokens is not None:
+                full_cross_attention_kwargs['return_token_ca_only'] = tokens
             
             latents.requires_grad_(True)
             latent_model_input = latents
             latent_model_input = scheduler.scale_model_input(latent_model_input, t)
             
-            unet(latent_model_input, t, encoder_hidden_states=cond_embeddings, return_cross_attention_probs=False, cross_attention_kwargs=full_cross_attention_kwargs)
+            # only the attention of `guidance_attn_keys` is used: stop the UNet after the last block that has one of them
+            unet(latent_model_input, t, encoder_hidden_states=cond_embeddings, return_cross_attention_probs=False, cross_attention_kwargs=full_cross_attention_kwargs, stop_after_attn_keys=guidance_attn_keys)
 
-            # TODO: could return the attention maps for the required blocks only and not necessarily the final output
             # update latents with guidance
             loss = guidance.compute_ca_lossv3(saved_attn=saved_attn, bboxes=bboxes, object_positions=object_positions, guidance_attn_keys=guidance_attn_keys, ref_ca_saved_attns=ref_ca_saved_attns, index=index, verbose=verbose, **kwargs) * loss_scale
 
@@ -117,7 +152,7 @@ def encode(model_dict, image, generator):
 def decode(vae, latents):
     # scale and decode the image latents with vae
     scaled_latents = 1 / 0.18215 * latents
-    with torch.no_grad():
+    with torch.no_grad(), span("decode"):
         image = vae.decode(scaled_latents).sample
         
     image = (image / 2 + 0.5).clamp(0, 1)
@@ -129,10 +164,11 @@ def decode(vae, latents):
 def generate_semantic_guidance(model_dict, latents, input_embeddings, num_inference_steps, bboxes, phrases, object_positions, guidance_scale = 7.5, semantic_guidance_kwargs=None, 
                            return_cross_attn=False, return_saved_cross_attn=False, saved_cross_attn_keys=None, return_cond_ca_only=False, return_token_ca_only=None, offload_guidance_cross_attn_to_cpu=False,
                            offload_cross_attn_to_cpu=False, offload_latents_to_cpu=True, return_box_vis=False, show_progress=True, save_all_latents=False, 
-                           dynamic_num_inference_steps=False, fast_after_steps=None, fast_rate=2, use_boxdiff=False):
+                           dynamic_num_inference_steps=False, fast_after_steps=None, fast_rate=2, use_boxdiff=False, saved_attn_accumulator=None):
     """
     object_positions: object indices in text tokens
     return_cross_attn: should be deprecated. Use `return_saved_cross_attn` and the new format.
+    saved_attn_accumulator: an `utils.attn.AttentionAccumulator` collecting the saved cross-attention (returned in place of the list of per-step dicts)
     """
     vae, tokenizer, text_encoder, unet, scheduler, dtype = model_dict.vae, model_dict.tokenizer, model_dict.text_encoder, model_dict.unet, model_dict.scheduler, model_dict.dtype
     text_embeddings, uncond_embeddings, cond_embeddings = input_embeddings
@@ -168,7 +204,7 @@ def generate_semantic_guidance(model_dict, latents, input_embeddings, num_infere
     }
     
     if return_saved_cross_attn:
-        saved_attns = []
+        saved_attns = [] if saved_attn_accumulator is None else saved_attn_accumulator
     
     main_cross_attention_kwargs = {
         'offload_cross_attn_to_cpu': offload_cross_attn_to_cpu,
@@ -180,7 +216,7 @@ def generate_semantic_guidance(model_dict, latents, input_embeddings, num_infere
     # Repeating keys leads to different weights for each key.
     # assert len(set(semantic_guidance_kwargs['guidance_attn_keys'])) == len(semantic_guidance_kwargs['guidance_attn_keys']), f"guidance_attn_keys not unique: {semantic_guidance_kwargs['guidance_attn_keys']}"
 
-    for index, t in enumerate(tqdm(scheduler.timesteps, disable=not show_progress)):
+    for index, t in enumerate(tqdm(span_iter("denoise", scheduler.timesteps, loop="semantic_guidance"), total=len(scheduler.timesteps), disable=not show_progress)):
         # expand the latents if we are doing classifier-free guidance to avoid doing two forward passes.
         
         if bboxes:
@@ -254,7 +290,7 @@ def generate(model_dict, latents, input_embeddings, num_inference_steps, guidanc
     if not no_set_timesteps:
         scheduler.set_timesteps(num_inference_steps)
 
-    for t in tqdm(scheduler.timesteps):
+    for t in tqdm(span_iter("denoise", scheduler.timesteps, loop="generate"), total=len(scheduler.timesteps)):
         # expand the latents if we are doing classifier-free guidance to avoid doing two forward passes.
         latent_model_input = torch.cat([latents] * 2)
 
@@ -326,12 +362,14 @@ def generate_gligen(model_dict, latents, input_embeddings, num_inference_steps,
     return_saved_cross_attn=False, saved_cross_attn_keys=None, return_cond_ca_only=False, return_token_ca_only=None, 
     offload_cross_attn_to_cpu=False, offload_latents_to_cpu=True,
     semantic_guidance=False, semantic_guidance_bboxes=None, semantic_guidance_object_positions=None, semantic_guidance_kwargs=None, 
-    return_box_vis=False, show_progress=True, save_all_latents=False, batched_condition=False, dynamic_num_inference_steps=False, fast_after_steps=None, fast_rate=2):
+    return_box_vis=False, show_progress=True, save_all_latents=False, batched_condition=False, dynamic_num_inference_steps=False, fast_after_steps=None, fast_rate=2, saved_attn_accumulator=None):
     """
     The `bboxes` should be a list, rather than a list of lists (one box per phrase, we can have multiple duplicated phrases).
     batched: 
         Enabled: bboxes and phrases should be a list (batch dimension) of items (specify the bboxes/phrases of each image in the batch).
         Disabled: bboxes and phrases should be a list of bboxes and phrases specifying the bboxes/phrases of one image (no batch dimension).
+        With semantic guidance, `semantic_guidance_bboxes` and `semantic_guidance_object_positions` are also per image when enabled, and the guidance runs on each image separately.
+    saved_attn_accumulator: an `utils.attn.AttentionAccumulator` collecting the saved cross-attention (returned in place of the list of per-step dicts)
     """
     vae, tokenizer, text_encoder, unet, scheduler, dtype = model_dict.vae, model_dict.tokenizer, model_dict.text_encoder, model_dict.unet, model_dict.scheduler, model_dict.dtype
     
@@ -387,9 +425,17 @@ def generate_gligen(model_dict, latents, input_embeddings, num_inference_steps,
                 }
             }
         }
+        if batched_condition:
+            # The loss and its stopping criterion are per image
+            loss = [loss] * latents.shape[0]
+            gligen_guidance = guidance_cross_attention_kwargs['gligen']
+            sample_guidance_cross_attention_kwargs = [
+                {**guidance_cross_attention_kwargs, 'gligen': {**gligen_guidance, **{key: gligen_guidance[key][i:i+1] for key in ('boxes', 'positive_embeddings', 'masks')}}}
+                for i in range(latents.shape[0])
+            ]
     
     if return_saved_cross_attn:
-        saved_attns = []
+        saved_attns = [] if saved_attn_accumulator is None else saved_attn_accumulator
     
     main_cross_attention_kwargs = {
         'offload_cross_attn_to_cpu': offload_cross_attn_to_cpu,
@@ -408,14 +454,21 @@ def generate_gligen(model_dict, latents, input_embeddings, num_inference_steps,
     num_grounding_steps = int(gligen_scheduled_sampling_beta * len(timesteps))
     gligen_enable_fuser(unet, True)
 
-    for index, t in enumerate(tqdm(timesteps, disable=not show_progress)):
+    for index, t in enumerate(tqdm(span_iter("denoise", timesteps, loop="gligen"), total=len(timesteps), disable=not show_progress)):
         # Scheduled sampling
         if index == num_grounding_steps:
             gligen_enable_fuser(unet, False)
         
         if semantic_guidance_bboxes and semantic_guidance:
             with torch.enable_grad():
-                latents, loss = latent_backward_guidance(scheduler, unet, cond_embeddings, index, semantic_guidance_bboxes, semantic_guidance_object_positions, t, latents, loss, cross_attention_kwargs=guidance_cross_attention_kwargs, **semantic_guidance_kwargs)
+                if batched_condition:
+                    guided_latents = []
+                    for i in range(latents.shape[0]):
+                        latents_item, loss[i] = latent_backward_guidance(scheduler, unet, cond_embeddings[i:i+1], index, semantic_guidance_bboxes[i], semantic_guidance_object_positions[i], t, latents[i:i+1].clone(), loss[i], cross_attention_kwargs=sample_guidance_cross_attention_kwargs[i], **semantic_guidance_kwargs)
+                        guided_latents.append(latents_item)
+                    latents = torch.cat(guided_latents)
+                else:
+                    latents, loss = latent_backward_guidance(scheduler, unet, cond_embeddings, index, semantic_guidance_bboxes, semantic_guidance_object_positions, t, latents, loss, cross_attention_kwargs=guidance_cross_attention_kwargs, **semantic_guidance_kwargs)
         # expand the latents if we are doing classifier-free guidance to avoid doing two forward passes.
         latent_model_input = torch.cat([latents] * 2)
 
@@ -501,7 +554,7 @@ def invert(model_dict, latents, input_embeddings, num_inference_steps, guidance_
     timesteps, num_inference_steps = get_inverse_timesteps(inverse_scheduler, num_inference_steps, strength=1.0)
 
     inverted_latents = [latents.cpu()]
-    for t in tqdm(timesteps[:-1]):
+    for t in tqdm(span_iter("denoise", timesteps[:-1], loop="invert"), total=len(timesteps) - 1):
         # expand the latents if we are doing classifier-free guidance to avoid doing two forward passes.
         if guidance_scale > 0.:
             latent_model_input = torch.cat([latents] * 2)
@@ -558,7 +611,7 @@ def generate_partial_frozen(model_dict, latents_all, frozen_mask, input_embeddin
             'enable_flash_attn': False
         }
 
-    for index, t in enumerate(tqdm(scheduler.timesteps)):
+    for index, t in enumerate(tqdm(span_iter("denoise", scheduler.timesteps, loop="partial_frozen"), total=len(scheduler.timesteps))):
         if bboxes:
             # With semantic guidance, `guidance_attn_keys` should be in `semantic_guidance_kwargs`
             if use_boxdiff:
@@ -587,7 +640,7 @@ def generate_partial_frozen(model_dict, latents_all, frozen_mask, input_embeddin
 
     # scale and decode the image latents with vae
     scaled_latents = 1 / 0.18215 * latents
-    with torch.no_grad():
+    with torch.no_grad(), span("decode"):
         image = vae.decode(scaled_latents).sample
         
     image = (image / 2 + 0.5).clamp(0, 1)
@@ -24,8 +24,11 @@ def load_sam():
 
 # Not fully backward compatible with the previous implementation
 # Reference: lmdv2/notebooks/gen_masked_latents_multi_object_ref_ca_loss_modular.ipynb
-def sam(sam_model_dict, image, input_points=None, input_boxes=None, target_mask_shape=None, return_numpy=True):
-    """target_mask_shape: (h, w)"""
+def sam(sam_model_dict, image, input_points=None, input_boxes=None, target_mask_shape=None, return_numpy=True, return_all_conf_scores=False):
+    """
+    target_mask_shape: (h, w)
+    return_all_conf_scores: return the scores of every image and box (batch, boxes, 3) instead of the first ones only
+    """
     sam_model, sam_processor = sam_model_dict['sam_model'], sam_model_dict['sam_processor']
     
     if input_boxes and isinstance(input_boxes[0], tuple):
@@ -43,7 +46,9 @@ def sam(sam_model_dict, image, input_points=None, input_boxes=None, target_mask_
         masks = sam_processor.image_processor.post_process_masks(
             outputs.pred_masks.cpu().float(), inputs["original_sizes"].cpu(), inputs["reshaped_input_sizes"].cpu()
         )
-        conf_scores = outputs.iou_scores.cpu().numpy()[0,0]
+        conf_scores = outputs.iou_scores.cpu().numpy()
+        if not return_all_conf_scores:
+            conf_scores = conf_scores[0,0]
         del inputs, outputs
     
     # Uncomment if experiencing out-of-memory error:
@@ -185,13 +190,13 @@ def sam_refine_boxes(sam_input_images, boxes, model_dict, height, width, H, W, d
     # (w, h)
     input_boxes = [[utils.scale_proportion(box, H=height, W=width) for box in boxes_item] for boxes_item in boxes]
 
-    masks, conf_scores = sam_box_input(model_dict, image=sam_input_images, input_boxes=input_boxes, target_mask_shape=(H, W))
+    masks, conf_scores = sam_box_input(model_dict, image=sam_input_images, input_boxes=input_boxes, target_mask_shape=(H, W), return_all_conf_scores=True)
     
     mask_selected_batched_list, conf_score_selected_batched_list = [], []
     
-    for boxes_item, masks_item in zip(boxes, masks):
+    for boxes_item, masks_item, conf_scores_item in zip(boxes, masks, conf_scores):
         mask_selected_list, conf_score_selected_list = [], []
-        for box, three_masks in zip(boxes_item, masks_item):
+        for box, three_masks, three_conf_scores in zip(boxes_item, masks_item, conf_scores_item):
             mask_binary = utils.proportion_to_mask(box, H, W, return_np=True)
             if verbose >= 2:
                 # Also the box is the input for SAM
@@ -201,7 +206,7 @@ def sam_refine_boxes(sam_input_images, boxes, model_dict, height, width, H, W, d
             
             coarse_ious = get_iou_with_resize(mask_binary, three_masks, masks_shape=mask_binary.shape)
 
-            mask_selected, conf_score_selected = select_mask(three_masks, conf_scores, coarse_ious=coarse_ious, 
+            mask_selected, conf_score_selected = select_mask(three_masks, three_conf_scores, coarse_ious=coarse_ious, 
                                                                 rule="largest_over_conf", 
                                                                 discourage_mask_below_confidence=discourage_mask_below_confidence, 
                                                                 discourage_mask_below_coarse_iou=discourage_mask_below_coarse_iou,
@@ -697,6 +697,14 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
         for module in self.children():
             fn_recursive_set_attention_slice(module, reversed_slice_size)
 
+    def _last_block_index(self, attn_keys):
+        """
+        Index of the last block (in execution order: down blocks, mid block, up blocks) that contains one of `attn_keys`.
+        attn_keys: attention keys (up/mid/down, stage id, block id, sub-block id), as in `save_keys`
+        """
+        offsets = {"down": 0, "mid": len(self.down_blocks), "up": len(self.down_blocks) + 1}
+        return max(offsets[attn_key[0]] + (attn_key[1] if attn_key[0] != "mid" else 0) for attn_key in attn_keys)
+
     def _set_gradient_checkpointing(self, module, value=False):
         if isinstance(module, (CrossAttnDownBlock2D, DownBlock2D, CrossAttnUpBlock2D, UpBlock2D)):
             module.gradient_checkpointing = value
@@ -715,7 +723,8 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
         mid_block_additional_residual: Optional[torch.Tensor] = None,
         encoder_attention_mask: Optional[torch.Tensor] = None,
         return_dict: bool = True,
-        return_cross_attention_probs: bool = False
+        return_cross_attention_probs: bool = False,
+        stop_after_attn_keys: Optional[List[Tuple]] = None,
     ) -> Union[UNet2DConditionOutput, Tuple]:
         r"""
         Args:
@@ -736,6 +745,11 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
                 A kwargs dictionary that if specified includes additonal conditions that can be used for additonal time
                 embeddings or encoder hidden states projections. See the configurations `encoder_hid_dim_type` and
                 `addition_embed_type` for more information.
+            stop_after_attn_keys (`list`, *optional*):
+                Attention keys (up/mid/down, stage id, block id, sub-block id) that the caller reads through
+                `cross_attention_kwargs` (e.g. `save_attn_to_dict`). If given, the forward pass stops after the last
+                block that contains one of these keys: the remaining blocks and the output convolution are skipped and
+                the returned sample is `None`.
 
         Returns:
             [`~models.unet_2d_condition.UNet2DConditionOutput`] or `tuple`:
@@ -877,6 +891,15 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
         if cross_attention_kwargs is None:
             cross_attention_kwargs = {}
 
+        # index of the block after which the forward pass stops (`stop_after_attn_keys`)
+        last_block_index = self._last_block_index(stop_after_attn_keys) if stop_after_attn_keys else None
+        cross_attention_probs_mid, cross_attention_probs_up = [], []
+
+        def truncated_output():
+            if not return_dict:
+                return (None,)
+            return UNet2DConditionOutput(sample=None, cross_attention_probs_down=cross_attention_probs_down, cross_attention_probs_mid=cross_attention_probs_mid, cross_attention_probs_up=cross_attention_probs_up)
+
         for i, downsample_block in enumerate(self.down_blocks):
             cross_attention_kwargs["attn_key"] = ["down", i]
             
@@ -898,6 +921,9 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
             else:
                 sample, res_samples = downsample_block(hidden_states=sample, temb=emb)
 
+            if i == last_block_index:
+                return truncated_output()
+
             down_block_res_samples += res_samples
 
         if down_block_additional_residuals is not None:
@@ -912,7 +938,6 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
             down_block_res_samples = new_down_block_res_samples
 
         # 4. mid
-        cross_attention_probs_mid = []
         if self.mid_block is not None:
             cross_attention_kwargs["attn_key"] = ["mid", 0]
             
@@ -928,12 +953,13 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
             if return_cross_attention_probs:
                 sample, cross_attention_probs = sample
                 cross_attention_probs_mid.append(cross_attention_probs)
-            
+
+        if last_block_index == len(self.down_blocks):
+            return truncated_output()
 
         if mid_block_additional_residual is not None:
             sample = sample + mid_block_additional_residual
 
-        cross_attention_probs_up = []
         # 5. up
         for i, upsample_block in enumerate(self.up_blocks):
             cross_attention_kwargs["attn_key"] = ["up", i]
@@ -968,6 +994,9 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
                     hidden_states=sample, temb=emb, res_hidden_states_tuple=res_samples, upsample_size=upsample_size
                 )
 
+            if last_block_index == len(self.down_blocks) + 1 + i:
+                return truncated_output()
+
         # 6. post-process
         if self.conv_norm_out:
             sample = self.conv_norm_out(sample)
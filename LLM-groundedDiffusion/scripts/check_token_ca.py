@@ -0,0 +1,61 @@
+# Check the token-subset cross-attention (AttnProcessor.__call_token_ca__) against the explicit path (get_attention_scores)
+# Run from the LLM-groundedDiffusion root: python scripts/check_token_ca.py
+
+import os
+import sys
+import argparse
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.attention_processor import Attention, AttnProcessor, AttentionLogSumExp
+
+
+def check_logsumexp_gradcheck():
+    # chunk_size smaller than the number of queries, so that the chunked backward is exercised
+    query = torch.randn(2, 3, 10, 8, dtype=torch.double, requires_grad=True)
+    key = torch.randn(2, 3, 7, 8, dtype=torch.double, requires_grad=True)
+    ok = torch.autograd.gradcheck(lambda q, k: AttentionLogSumExp.apply(q, k, 0.35, 4), (query, key))
+    print(f"AttentionLogSumExp gradcheck: {ok}")
+    return ok
+
+
+def run_processor(attn, hidden_states, encoder_hidden_states, tokens, fused):
+    hidden_states = hidden_states.detach().requires_grad_(True)
+    # enable_flash_attn=False as in the guidance kwargs of the pipelines
+    out, probs = AttnProcessor()(attn, hidden_states, encoder_hidden_states, return_attntion_probs=True, attn_key=("up", 1, 0, 0),
+                                 return_token_ca_only=tokens, enable_flash_attn=False, fused_token_ca=fused)
+    # a loss of the same form as the guidance loss: weighted attention of the selected tokens
+    weights = torch.linspace(0., 1., probs.shape[2], device=probs.device)[None, None, :, None]
+    loss = (probs * weights).sum() + out.pow(2).mean()
+    grad, = torch.autograd.grad(loss, hidden_states)
+    return out.detach(), probs.detach(), grad
+
+
+def check_processor(device, hw=1024, batch_size=2, atol=1e-4):
+    torch.manual_seed(0)
+    attn = Attention(query_dim=320, cross_attention_dim=768, heads=8, dim_head=40, processor=AttnProcessor()).to(device)
+    hidden_states = torch.randn(batch_size, hw, 320, device=device)
+    encoder_hidden_states = torch.randn(batch_size, 77, 768, device=device)
+    tokens = torch.tensor([1, 4, 5], device=device)
+
+    results = {fused: run_processor(attn, hidden_states, encoder_hidden_states, tokens, fused) for fused in (False, True)}
+    worst = 0.
+    for name, explicit, fused in zip(("output", "token probabilities", "gradient"), results[False], results[True]):
+        diff = (explicit - fused).abs().max().item()
+        print(f"{name}: max |explicit - fused| = {diff:.3e}")
+        worst = max(worst, diff)
+    return worst <= atol
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--atol", type=float, default=1e-4)
+    args = parser.parse_args()
+
+    ok = check_logsumexp_gradcheck()
+    ok = check_processor(args.device, atol=args.atol) and ok
+    if not ok:
+        raise SystemExit("token-subset cross-attention differs from the explicit path")
+    print("OK")
@@ -6,17 +6,76 @@ import torch.nn.functional as F
 import math
 import utils
 
+class AttentionAccumulator:
+    """
+    Collects the saved cross-attention of each denoising step (the `save_attn_to_dict` dicts) on the device, in place of a list of per-step dicts.
+    
+    aggregate_keys: attn keys averaged over the steps from `aggregation_step_start` on, kept as a running sum (see `get_token_attnv2`)
+    step_keys: attn keys kept for each step, for the first `keep_steps` steps only (all steps if None), e.g. the reference cross-attention for `guidance_attn_keys`
+    
+    Indexing with a step returns the dict of that step, as with the list, so it can be used as `ref_ca_saved_attns`.
+    """
+    def __init__(self, aggregate_keys=(), step_keys=(), aggregation_step_start=10, keep_steps=None):
+        self.aggregate_keys = [tuple(k) for k in aggregate_keys]
+        self.step_keys = [tuple(k) for k in step_keys]
+        self.aggregation_step_start = aggregation_step_start
+        self.keep_steps = keep_steps
+        self.num_steps = 0
+        self.sums = {}
+        self.counts = {}
+        self.steps = []
+    
+    def append(self, saved_attn):
+        index = self.num_steps
+        self.num_steps += 1
+        if index >= self.aggregation_step_start:
+            for k in self.aggregate_keys:
+                if k not in saved_attn:
+                    continue
+                attn_map = saved_attn[k].float()
+                self.sums[k] = attn_map if k not in self.sums else self.sums[k] + attn_map
+                self.counts[k] = self.counts.get(k, 0) + 1
+        if self.keep_steps is None or index < self.keep_steps:
+            self.steps.append({k: saved_attn[k] for k in self.step_keys if k in saved_attn})
+    
+    def mean(self, attn_key):
+        attn_key = tuple(attn_key)
+        return self.sums[attn_key] / self.counts[attn_key]
+    
+    def map(self, fn):
+        """A copy with `fn` (a dict of attn maps by key -> a dict of attn maps) applied to every step and to the running sums."""
+        accumulator = AttentionAccumulator(self.aggregate_keys, self.step_keys, self.aggregation_step_start, self.keep_steps)
+        accumulator.num_steps = self.num_steps
+        accumulator.sums = fn(self.sums) if self.sums else {}
+        accumulator.counts = {k: self.counts[k] for k in accumulator.sums}
+        accumulator.steps = [fn(step) for step in self.steps]
+        return accumulator
+    
+    def __getitem__(self, index):
+        return self.steps[index]
+    
+    def __len__(self):
+        return len(self.steps)
+    
+    def __iter__(self):
+        return iter(self.steps)
+
+
 def get_token_attnv2(token_id, saved_attns, attn_key, attn_aggregation_step_start=10, input_ca_has_condition_only=False, return_np=False):
     """
-    saved_attns: a list of saved_attn (list is across timesteps)
+    saved_attns: a list of saved_attn (list is across timesteps), or an `AttentionAccumulator` aggregating `attn_key` from `attn_aggregation_step_start`
     
     moves to cpu by default
     """
-    saved_attns = saved_attns[attn_aggregation_step_start:]    
+    if isinstance(saved_attns, AttentionAccumulator):
+        assert saved_attns.aggregation_step_start == attn_aggregation_step_start, f"Attention is aggregated from step {saved_attns.aggregation_step_start}, not {attn_aggregation_step_start}"
+        attn = saved_attns.mean(attn_key).cpu()
+    else:
+        saved_attns = saved_attns[attn_aggregation_step_start:]    
 
-    saved_attns = [saved_attn[attn_key].cpu() for saved_attn in saved_attns]
-    
-    attn = torch.stack(saved_attns, dim=0).mean(dim=0)
+        saved_attns = [saved_attn[attn_key].cpu() for saved_attn in saved_attns]
+        
+        attn = torch.stack(saved_attns, dim=0).mean(dim=0)
     
     # print("attn shape", attn.shape)
     
@@ -64,6 +123,11 @@ def shift_saved_attns_item(saved_attns_item, offset, guidance_attn_keys, horizon
     return new_saved_attns_item
 
 def shift_saved_attns(saved_attns, offset, guidance_attn_keys, **kwargs):
+    if isinstance(saved_attns, AttentionAccumulator):
+        # The shift is linear, so the running sums are shifted as well
+        present_keys = lambda saved_attns_item: [k for k in guidance_attn_keys if tuple(k) in saved_attns_item]
+        return saved_attns.map(lambda saved_attns_item: shift_saved_attns_item(saved_attns_item, offset, present_keys(saved_attns_item), **kwargs))
+    
     # Iterate over timesteps
     shifted_saved_attns = [shift_saved_attns_item(saved_attns_item, offset, guidance_attn_keys, **kwargs) for saved_attns_item in saved_attns]
     
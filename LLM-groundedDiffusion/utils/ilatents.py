@@ -1,4 +1,6 @@
 
+import hashlib
+import numpy as np
 from models import sam
 from models import pipelines
 import torch
@@ -8,25 +10,48 @@ DEFAULT_OVERALL_NEGATIVE_PROMPT = "artifacts, blurry, smooth texture, bad qualit
 
 
 
-def get_all_latents(img_np, models, inv_seed=1):
+# Magic prompt
+# Have tried using the parsed bg prompt from the LLM, but it doesn't work well
+INVERSION_PROMPT = "A realistic photo of a scene"
+INVERSION_STEPS = 51
+INVERSION_GUIDANCE_SCALE = 2.5
+
+
+def image_hash(img_np):
+    h = hashlib.sha1(str((img_np.dtype.str, img_np.shape)).encode())
+    h.update(np.ascontiguousarray(img_np).data)
+    return h.hexdigest()
+
+
+def get_all_latents(img_np, models, inv_seed=1, cache=None, model_id=None):
+    """
+    cache: optional latent cache with get(key, dtype) and put(key, latents) (e.g. agent_cache.LatentCache).
+    model_id: identity of the weights at `models.sd_key` (e.g. agent_cache.checkpoint_identity), so that new weights at the same path miss the cache
+    The inversion is skipped if the same image was inverted with the same model, prompt, seed and steps before.
+    """
     generator = torch.cuda.manual_seed(inv_seed)
-    cln_latents = pipelines.encode(models.model_dict, img_np, generator)
-    # Magic prompt
-    # Have tried using the parsed bg prompt from the LLM, but it doesn't work well
-    prompt = "A realistic photo of a scene"
     input_embeddings = models.encode_prompts(
-        prompts=[prompt],
+        prompts=[INVERSION_PROMPT],
         tokenizer=models.model_dict.tokenizer,
         text_encoder=models.model_dict.text_encoder,
         negative_prompt=DEFAULT_OVERALL_NEGATIVE_PROMPT,
         one_uncond_input_only=False,
     )
+    if cache is not None:
+        key = ["lmd_inversion", image_hash(img_np), getattr(models, "sd_key", None), model_id, INVERSION_PROMPT,
+               DEFAULT_OVERALL_NEGATIVE_PROMPT, inv_seed, INVERSION_STEPS, INVERSION_GUIDANCE_SCALE]
+        all_latents = cache.get(key, dtype=models.model_dict.dtype)
+        if all_latents is not None:
+            return all_latents, input_embeddings
+    cln_latents = pipelines.encode(models.model_dict, img_np, generator)
     # Get all hidden latents
     all_latents = pipelines.invert(
         models.model_dict,
         cln_latents,
         input_embeddings,
-        num_inference_steps=51,
-        guidance_scale=2.5,
+        num_inference_steps=INVERSION_STEPS,
+        guidance_scale=INVERSION_GUIDANCE_SCALE,
     )
-    return all_latents, input_embeddings
\ No newline at end of file
+    if cache is not None:
+        cache.put(key, all_latents)
+    return all_latents, input_embeddings
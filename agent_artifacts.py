@@ -0,0 +1,195 @@
+import os
+import os.path as osp
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from agent_trace import span
+
+
+def _to_rgb(image):
+    if isinstance(image, Image.Image):
+        return np.asarray(image.convert("RGB"))
+    image = np.asarray(image)
+    if image.dtype != np.uint8:
+        image = np.clip(np.rint(image), 0, 255).astype(np.uint8)
+    if image.ndim == 2:
+        image = np.stack([image] * 3, -1)
+    return image[:, :, :3]
+
+
+def _to_mask(mask):
+    if isinstance(mask, Image.Image):
+        mask = np.asarray(mask.convert("L"))
+    if hasattr(mask, "numpy"):
+        # torch tensors
+        mask = mask.numpy()
+    mask = np.asarray(mask)
+    if mask.ndim == 3:
+        mask = mask[:, :, 0]
+    if mask.dtype == bool:
+        return mask.astype(np.uint8) * 255
+    return np.clip(np.rint(mask), 0, 255).astype(np.uint8)
+
+
+class ArtifactStore:
+    """Images, masks and latents handed between agent steps, keyed by path.
+
+    Keys are the paths produced by `command_parse`, so tools keep their
+    step arguments unchanged: `save_*` keeps the array in memory and `load_*`
+    returns it without a PNG round-trip, falling back to the file on disk
+    (e.g. the input image). Nothing is written until `flush`, unless
+    `spill` is set, in which case every artifact is also written to disk in
+    the background for debugging.
+
+    Images are stored as HxWx3 uint8 RGB arrays, masks as HxW uint8 (0/255).
+    """
+
+    def __init__(self, spill=None):
+        if spill is None:
+            spill = os.getenv("GENARTIST_SPILL", "0") == "1"
+        self.spill = spill
+        self.items = {}
+        self.extras = {}
+        self.dirty = set()
+        self.disk = {}
+        self.digests = {}
+        self.lock = threading.RLock()
+        self._writer = None
+
+    # ------------------------------------------------------------------ write
+
+    def _put(self, path, kind, value, persist):
+        with self.lock:
+            self.items[path] = (kind, value)
+            self.extras.pop(path, None)
+            self.disk.pop(path, None)
+            self.digests.pop(path, None)
+            self.dirty.add(path)
+        if persist:
+            self.flush([path])
+        elif self.spill:
+            if self._writer is None:
+                self._writer = ThreadPoolExecutor(max_workers=1)
+            self._writer.submit(self.flush, [path])
+
+    def save_image(self, path, image, persist=False):
+        """`image`: PIL image or RGB array."""
+        self._put(path, "image", _to_rgb(image), persist)
+
+    def save_bgr(self, path, image, persist=False):
+        """Same as cv2.imwrite(path, image)."""
+        self._put(path, "image", _to_rgb(np.asarray(image)[:, :, 2::-1]), persist)
+
+    def save_mask(self, path, mask, persist=False):
+        self._put(path, "mask", _to_mask(mask), persist)
+
+    def put_extra(self, path, name, value):
+        """Attach e.g. latents to the artifact at `path`; dropped when it is overwritten."""
+        with self.lock:
+            self.extras.setdefault(path, {})[name] = value
+
+    def get_extra(self, path, name):
+        with self.lock:
+            return self.extras.get(path, {}).get(name)
+
+    # ------------------------------------------------------------------- read
+
+    def _get(self, path):
+        with self.lock:
+            if path in self.items:
+                return self.items[path][1]
+            # Read-through cache for files that were not produced in memory
+            mtime = os.stat(path).st_mtime_ns
+            cached = self.disk.get(path)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+        with Image.open(path) as im:
+            if im.mode not in ("L", "RGB", "RGBA"):
+                im = im.convert("RGB")
+            value = np.array(im)
+        with self.lock:
+            self.disk[path] = (mtime, value)
+        return value
+
+    def load_rgb(self, path):
+        return _to_rgb(self._get(path))
+
+    def load_bgr(self, path):
+        """Same as cv2.imread(path)."""
+        return np.ascontiguousarray(self.load_rgb(path)[:, :, ::-1])
+
+    def load_pil(self, path):
+        return Image.fromarray(self.load_rgb(path))
+
+    def load_mask(self, path):
+        return _to_mask(self._get(path))
+
+    def exists(self, path):
+        return path in self.items or osp.exists(path)
+
+    def get_artifact(self, path):
+        """(kind, array) of an in-memory artifact, kind being "image" or "mask"."""
+        with self.lock:
+            return self.items[path]
+
+    def put_artifact(self, path, kind, value):
+        self._put(path, kind, value, False)
+
+    def digest(self, path):
+        """Content hash of the artifact (or file) at `path`."""
+        with self.lock:
+            cached = self.digests.get(path)
+            if cached is not None and (path in self.items or cached[0] == os.stat(path).st_mtime_ns):
+                return cached[1]
+        mtime = None if path in self.items else os.stat(path).st_mtime_ns
+        value = self._get(path)
+        h = hashlib.sha1(str((value.dtype.str, value.shape)).encode())
+        h.update(np.ascontiguousarray(value).data)
+        with self.lock:
+            self.digests[path] = (mtime, h.hexdigest())
+        return h.hexdigest()
+
+    # ------------------------------------------------------------------ flush
+
+    def flush(self, paths=None):
+        """Write the given (default: all) in-memory artifacts to disk."""
+        with self.lock:
+            paths = list(self.dirty if paths is None else paths)
+            todo = [(p, self.items[p][1]) for p in paths if p in self.dirty]
+            self.dirty.difference_update(p for p, _ in todo)
+        if not todo:
+            return
+        with span("save", files=len(todo)):
+            for path, value in todo:
+                if osp.dirname(path):
+                    os.makedirs(osp.dirname(path), exist_ok=True)
+                Image.fromarray(value).save(path)
+
+    def clear(self, prefix=None):
+        """Forget the artifacts under `prefix` (default: all), e.g. a finished job's directory.
+
+        Unflushed artifacts are lost.
+        """
+        if self._writer is not None:
+            self._writer.shutdown(wait=True)
+            self._writer = None
+        with self.lock:
+            if prefix is None:
+                keys = set(self.items) | set(self.disk) | set(self.extras) | set(self.digests)
+            else:
+                root = osp.join(osp.normpath(prefix), "")
+                keys = {k for k in set(self.items) | set(self.disk) | set(self.extras) | set(self.digests)
+                        if osp.normpath(k).startswith(root)}
+            for k in keys:
+                self.items.pop(k, None)
+                self.extras.pop(k, None)
+                self.disk.pop(k, None)
+                self.digests.pop(k, None)
+                self.dirty.discard(k)
+
+
+store = ArtifactStore()
@@ -0,0 +1,306 @@
+"""Benchmark of the agent orchestration (command parsing, step dispatch,
+artifact hand-off and I/O, mask/box conversions) with the models replaced by
+cheap deterministic CPU stubs, so it runs without GPUs:
+
+    python agent_bench.py --concurrency 1,2,4 --chain-lengths 4,16
+
+Every tool sleeps for a simulated latency (STUB_LATENCY, scaled by
+--latency-scale); per-step overhead is the time a step takes as seen by the
+scheduler minus that latency.
+"""
+import os
+import os.path as osp
+import copy
+import glob
+import json
+import time
+import random
+import hashlib
+import argparse
+import tempfile
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from agent_artifacts import store
+from agent_trace import tracer
+
+
+# Simulated seconds per call, roughly in proportion to the real tools
+STUB_LATENCY = {
+    "text_to_image_SDXL": 0.20,
+    "image_to_image_SD2": 0.10,
+    "layout_to_image_LMD": 0.30,
+    "layout_to_image_BoxDiff": 0.30,
+    "superresolution_SDXL": 0.20,
+    "object_addition_anydoor": 0.20,
+    "segmentation": 0.03,
+    "detection": 0.03,
+    "addition_anydoor": 0.10,
+    "replace_anydoor": 0.10,
+    "remove": 0.03,
+    "instruction": 0.10,
+    "attribute_diffedit": 0.10,
+}
+SIZE = 512
+
+
+def stub_latency(tool):
+    return STUB_LATENCY.get(tool, 0.0) * float(os.getenv("GENARTIST_STUB_SCALE", 1.0))
+
+
+# ----------------------------------------------------------------------------
+# Stub tools
+# ----------------------------------------------------------------------------
+
+def _rng(*parts):
+    return np.random.default_rng(int(hashlib.sha1(repr(parts).encode()).hexdigest()[:8], 16))
+
+
+def _fake_image(*parts):
+    cells = _rng(*parts).integers(0, 256, (SIZE // 8, SIZE // 8, 3), dtype=np.uint8)
+    return cells.repeat(8, 0).repeat(8, 1)
+
+
+def _text_box(text):
+    """A deterministic [x, y, w, h] box (relative) for a text query."""
+    x, y = _rng("box", text).uniform(0, 0.6, 2)
+    w, h = _rng("size", text).uniform(0.15, 0.4, 2)
+    return [round(float(v), 2) for v in (x, y, w, h)]
+
+
+def _box_mask(box):
+    mask = np.zeros((SIZE, SIZE), np.uint8)
+    x, y, w, h = [int(v * SIZE) for v in box]
+    mask[y:y + h, x:x + w] = 255
+    return mask
+
+
+def _mask_box(mask):
+    """Same conversion as the tools: bounding box of the mask, relative [x, y, w, h]."""
+    y, x = np.nonzero(mask)
+    if len(x) == 0:
+        return [0., 0., 0., 0.]
+    return [k / SIZE for k in (x.min(), y.min(), x.max() - x.min(), y.max() - y.min())]
+
+
+def _blend(image, other):
+    if image.shape != other.shape:
+        image = np.asarray(Image.fromarray(image).resize(other.shape[1::-1]))
+    return ((image.astype(np.uint16) + other) // 2).astype(np.uint8)
+
+
+def stub_tool(step):
+    """CPU stand-in for main_aux/main_edit/main_generate.
+
+    Reads and writes the same artifacts as the real tool, through the same
+    store, with cheap deterministic content. Use it in workers with
+    GENARTIST_TOOL_IMPL=agent_bench:stub_tool.
+    """
+    tool = step["tool"]
+    inp = step.get("input", {})
+    time.sleep(stub_latency(tool))
+    result = None
+    if tool in ("text_to_image_SDXL", "layout_to_image_LMD", "layout_to_image_BoxDiff"):
+        store.save_image(step["output"], _fake_image(tool, inp.get("text")))
+    elif tool in ("image_to_image_SD2", "superresolution_SDXL", "instruction", "attribute_diffedit"):
+        image = store.load_rgb(inp["image"])
+        store.save_image(step["output"], _blend(image, _fake_image(tool, inp.get("text"), inp.get("attr"))))
+    elif tool == "segmentation":
+        store.load_rgb(inp["image"])
+        queries = inp.get("queries", [inp])
+        outputs = step["output"] if isinstance(step["output"], list) else [step["output"]]
+        for path, query in zip(outputs, queries):
+            store.save_mask(path, _box_mask(query.get("box") or _text_box(query["text"])))
+    elif tool == "detection":
+        store.load_rgb(inp["image"])
+        result = [(text, _text_box(text)) for text in inp["text"].split(" . ")[:8]]
+        if "output" in step:
+            json.dump(result, open(step["output"], "w"))
+    elif tool == "object_addition_anydoor":
+        layout = inp["layout"]
+        if isinstance(layout, str):
+            layout = _mask_box(store.load_mask(layout))
+        store.load_rgb(inp["image"])
+        store.save_image(step["output"], _fake_image(tool, inp["object"]))
+        store.save_mask(step["output_mask"], _box_mask(layout))
+    elif tool in ("addition_anydoor", "replace_anydoor"):
+        back = store.load_rgb(inp["image"])
+        ref = store.load_rgb(inp["object"])
+        store.load_mask(inp["object_mask"])
+        box = inp["mask"]
+        if isinstance(box, str):
+            box = _mask_box(store.load_mask(box))
+        out = back.copy()
+        region = _box_mask(box) > 0
+        if ref.shape == back.shape:
+            out[region] = ref[region]
+        store.save_image(step["output"], out)
+    elif tool == "remove":
+        image = store.load_rgb(inp["image"])
+        mask = store.load_mask(inp["mask"]) > 0
+        out = image.copy()
+        out[mask] = image.reshape(-1, 3).mean(0).astype(np.uint8)
+        store.save_image(step["output"], out)
+    else:
+        raise ValueError("unknown tool: %s" % tool)
+    return result
+
+
+# ----------------------------------------------------------------------------
+# Workloads
+# ----------------------------------------------------------------------------
+
+def demo_workloads(pattern="demo/*.json"):
+    workloads = {}
+    for path in sorted(glob.glob(pattern)):
+        commands = json.load(open(path))
+        text = next((c["input"]["text"] for c in commands if isinstance(c.get("input"), dict) and "text" in c["input"]),
+                    "A realistic photo")
+        workloads[osp.splitext(osp.basename(path))[0]] = (commands, text)
+    return workloads
+
+
+def synthetic_chain(length, seed=0):
+    """A command list of `length` editing commands on random objects and boxes."""
+    rnd = random.Random(seed)
+    box = lambda: [round(rnd.uniform(0, 0.6), 2), round(rnd.uniform(0, 0.6), 2),
+                   round(rnd.uniform(0.1, 0.4), 2), round(rnd.uniform(0.1, 0.4), 2)]
+    commands = []
+    for i in range(length):
+        name = "object %d" % i
+        kind = rnd.choice(["remove", "addition", "move", "edit", "edit_attribute", "instruction"])
+        if kind == "remove":
+            commands.append({"tool": "remove", "input": name})
+        elif kind == "addition":
+            commands.append({"tool": "addition", "input": name, "box": box()})
+        elif kind == "move":
+            commands.append({"tool": "move", "input": name, "box": box()})
+        elif kind == "edit":
+            commands.append({"tool": "edit", "input": name, "edit": "another " + name})
+        elif kind == "edit_attribute":
+            commands.append({"tool": "edit_attribute", "input": name, "text": "a red " + name})
+        else:
+            commands.append({"tool": "instruction", "text": "make %s brighter" % name})
+    return commands, "A realistic photo"
+
+
+# ----------------------------------------------------------------------------
+# Runs
+# ----------------------------------------------------------------------------
+
+def run_job(commands, text, pool, root, ground_on_source=False):
+    """Parse and run one job end to end on `pool`; returns its number of steps."""
+    from agent_job import Job
+    from agent_scheduler import run_graph
+    job = Job(root=root)
+    try:
+        Image.fromarray(_fake_image("source")).save(job.source)
+        steps = job.parse(copy.deepcopy(commands), text, "A realistic scene", ground_on_source=ground_on_source)
+        run_graph(steps, pool)
+        pool.flush([steps[-1]["output"]])
+        pool.reset(job.dir)
+        return len(steps)
+    finally:
+        job.cleanup()
+
+
+def time_parse(commands, text, repeat=200, ground_on_source=False):
+    """Mean seconds of one `command_parse` call."""
+    from agent_tool import command_parse
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        command_parse(copy.deepcopy(commands), text, "A realistic scene", dir="inputs", ground_on_source=ground_on_source)
+    return (time.perf_counter() - t0) / repeat
+
+
+def critical_path_seconds(commands, text, ground_on_source=False):
+    """(all steps, longest dependency chain) in simulated seconds: the best a job can do with enough workers."""
+    from agent_tool import command_parse
+    from agent_scheduler import critical_path
+    steps = command_parse(copy.deepcopy(commands), text, "A realistic scene", dir="inputs", ground_on_source=ground_on_source)
+    cost = lambda step: STUB_LATENCY.get(step["tool"], 0.0)
+    return sum(cost(step) for step in steps), critical_path(steps, cost)
+
+
+def _percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def bench(workloads, concurrency=(1, 2, 4), jobs=4, ground_on_source=False):
+    """Run `jobs` jobs of each workload with 1..N concurrent jobs (one worker each)."""
+    from agent_worker import WorkerPool
+    root = tempfile.mkdtemp(prefix="genartist-bench-")
+    rows = []
+    try:
+        for level in concurrency:
+            with WorkerPool([None] * level) as pool:
+                for name, (commands, text) in workloads.items():
+                    # warm-up: worker imports, first-touch of the stubs
+                    run_job(commands, text, pool, root, ground_on_source)
+                    tracer.events(clear=True)
+                    t0 = time.perf_counter()
+                    with ThreadPoolExecutor(max_workers=level) as executor:
+                        n_steps = sum(executor.map(lambda _: run_job(commands, text, pool, root, ground_on_source), range(jobs)))
+                    elapsed = time.perf_counter() - t0
+                    overhead = [e["dur"] - stub_latency(e["name"][len("step:"):])
+                                for e in tracer.events(clear=True) if e["name"].startswith("step:")]
+                    serial_s, critical_s = critical_path_seconds(commands, text, ground_on_source)
+                    rows.append({
+                        "workload": name,
+                        "concurrency": level,
+                        "jobs": jobs,
+                        "steps": n_steps,
+                        "seconds": elapsed,
+                        "jobs_per_min": 60. * jobs / elapsed,
+                        "ground_on_source": ground_on_source,
+                        "serial_s": serial_s,
+                        "critical_path_s": critical_s,
+                        "parse_ms": 1000. * time_parse(commands, text, ground_on_source=ground_on_source),
+                        "overhead_ms_mean": 1000. * float(np.mean(overhead)) if overhead else 0.0,
+                        "overhead_ms_p50": 1000. * _percentile(overhead, 50),
+                        "overhead_ms_p95": 1000. * _percentile(overhead, 95),
+                    })
+                    print_row(rows[-1])
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return rows
+
+
+def print_row(row):
+    print("%-14s conc=%-2d jobs=%-3d steps=%-4d %7.2fs %8.1f jobs/min  critical path %.2fs of %.2fs  parse %.3fms  "
+          "overhead/step mean %.1fms p50 %.1fms p95 %.1fms" % (
+              row["workload"], row["concurrency"], row["jobs"], row["steps"], row["seconds"],
+              row["jobs_per_min"], row["critical_path_s"], row["serial_s"], row["parse_ms"], row["overhead_ms_mean"],
+              row["overhead_ms_p50"], row["overhead_ms_p95"]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="CPU benchmark of the agent orchestration with stub tools")
+    parser.add_argument("--demo", type=str, default="demo/*.json", help="command lists to replay")
+    parser.add_argument("--chain-lengths", type=str, default="4,16", help="synthetic chains of these many commands")
+    parser.add_argument("--concurrency", type=str, default="1,2,4", help="numbers of concurrent jobs (and workers)")
+    parser.add_argument("--jobs", type=int, default=4, help="jobs per workload and concurrency level")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="multiplies the simulated tool latencies; 0 measures overhead only")
+    parser.add_argument("--cache", action="store_true", help="keep the step cache on (in a temporary directory)")
+    parser.add_argument("--ground-on-source", action="store_true", help="parse with ground_on_source=True (see command_parse)")
+    parser.add_argument("--out", type=str, default=None, help="write the results as JSON")
+    args = parser.parse_args()
+
+    # Read by the spawned workers
+    os.environ["GENARTIST_TOOL_IMPL"] = "agent_bench:stub_tool"
+    os.environ["GENARTIST_STUB_SCALE"] = str(args.latency_scale)
+    os.environ["GENARTIST_CACHE"] = "1" if args.cache else "0"
+    if args.cache:
+        os.environ["GENARTIST_CACHE_DIR"] = tempfile.mkdtemp(prefix="genartist-bench-cache-")
+
+    workloads = demo_workloads(args.demo)
+    for n in [int(n) for n in args.chain_lengths.split(",") if n]:
+        workloads["chain_%d" % n] = synthetic_chain(n, seed=n)
+    rows = bench(workloads, [int(c) for c in args.concurrency.split(",")], args.jobs, args.ground_on_source)
+    if args.out:
+        json.dump(rows, open(args.out, "w"), indent=1)
+    if args.cache:
+        shutil.rmtree(os.environ["GENARTIST_CACHE_DIR"], ignore_errors=True)
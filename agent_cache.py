@@ -0,0 +1,321 @@
+import os
+import os.path as osp
+import json
+import pickle
+import shutil
+import hashlib
+import threading
+
+import numpy as np
+
+from agent_artifacts import store
+from agent_trace import span
+
+
+GB = 1024 ** 3
+# Bump when a tool changes its outputs for the same inputs
+CACHE_VERSION = 1
+# Keys that name where a step writes, not what it computes
+IGNORED_KEYS = ("output", "output_mask", "deps")
+# agent_models.GROUNDINGDINO_CKPT (not imported: agent_models needs torch)
+GROUNDINGDINO_CKPT = "GroundingDINO/weights/groundingdino_swint_ogc.pth"
+# Checkpoints (files or directories) each tool loads, and environment knobs
+# that change its outputs; both are part of the step key, so that new
+# weights at the same path do not replay the outputs of the old ones
+TOOL_CHECKPOINTS = {
+    "text_to_image_SDXL": ["stable-diffusion-xl-base-1.0"],
+    "image_to_image_SD2": ["stable-diffusion-2-1-base"],
+    "layout_to_image_LMD": ["diffusers-generation-text-box", "sam-vit-base"],
+    "layout_to_image_BoxDiff": ["stable-diffusion-2-1-base"],
+    "superresolution_SDXL": ["stable-diffusion-xl-refiner-1.0"],
+    "object_addition_anydoor": ["diffusers-generation-text-box", "sam-vit-base"],
+    "segmentation": [GROUNDINGDINO_CKPT, "sam-vit-base"],
+    "detection": [GROUNDINGDINO_CKPT],
+    "addition_anydoor": ["AnyDoor/path", "AnyDoor/configs"],
+    "replace_anydoor": ["AnyDoor/path", "AnyDoor/configs"],
+    "remove": ["Inpaint-Anything/pretrained_models/big-lama"],
+    "instruction": ["instruct-pix2pix/checkpoints/MagicBrush-epoch-000168.ckpt"],
+    "attribute_diffedit": ["stable-diffusion-2"],
+}
+TOOL_ENV = {
+    "addition_anydoor": ["GENARTIST_ANYDOOR_CONTROL"],
+    "replace_anydoor": ["GENARTIST_ANYDOOR_CONTROL"],
+    "remove": ["GENARTIST_LAMA_CROP"],
+}
+# checkpoint_identity per path, in this process
+_checkpoint_ids = {}
+
+
+def _canonical(value):
+    """Replace every path that names an image/mask by the hash of its content."""
+    if isinstance(value, dict):
+        return {k: _canonical(v) for k, v in sorted(value.items())}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, str) and value.lower().endswith((".png", ".jpg", ".jpeg")) and store.exists(value):
+        return {"sha1": store.digest(value)}
+    if isinstance(value, (np.floating, np.integer)):
+        return value.item()
+    return value
+
+
+def _outputs(step):
+    """(name, path) of every output of a step, e.g. ("output", ...) or ("output.1", ...)."""
+    for key in ("output", "output_mask"):
+        value = step.get(key)
+        if isinstance(value, str):
+            yield key, value
+        elif isinstance(value, list):
+            for i, path in enumerate(value):
+                yield "%s.%d" % (key, i), path
+
+
+def _path_identity(path):
+    """(path, size, mtime) of every file under `path`, or None if it does not exist."""
+    if osp.isfile(path):
+        files = [path]
+    elif osp.isdir(path):
+        files = sorted(osp.join(d, f) for d, _, names in os.walk(path) for f in names)
+    else:
+        return None
+    return [(f, osp.getsize(f), int(osp.getmtime(f))) for f in files]
+
+
+def checkpoint_identity(path):
+    """(path, size, mtime) of the files of a checkpoint, computed once per process: checkpoints are not replaced while a worker runs."""
+    path = osp.normpath(path)
+    if path not in _checkpoint_ids:
+        _checkpoint_ids[path] = _path_identity(path)
+    return _checkpoint_ids[path]
+
+
+def model_identity(tool):
+    """Checkpoint files (size, mtime) and output-changing settings of a tool."""
+    return {
+        "checkpoints": {path: checkpoint_identity(path) for path in TOOL_CHECKPOINTS.get(tool, ())},
+        "env": {name: os.getenv(name) for name in TOOL_ENV.get(tool, ())},
+    }
+
+
+def step_key(step):
+    spec = {k: v for k, v in step.items() if k not in IGNORED_KEYS}
+    spec = json.dumps([CACHE_VERSION, model_identity(step.get("tool")), _canonical(spec)], sort_keys=True, default=str)
+    return hashlib.sha256(spec.encode()).hexdigest()
+
+
+class StepCache:
+    """On-disk cache of tool step results, keyed by tool, checkpoints, parameters and input content.
+
+    An entry holds the step's output artifacts (as .npy) and its return
+    value. Entries are evicted least-recently-used once the cache grows
+    beyond `max_bytes`.
+    """
+
+    def __init__(self, root=None, max_bytes=None):
+        self.root = root or os.getenv("GENARTIST_CACHE_DIR", ".cache/steps")
+        if max_bytes is None:
+            max_bytes = float(os.getenv("GENARTIST_CACHE_GB", 20)) * GB
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        self.sizes = {}
+        self._scan()
+
+    @staticmethod
+    def _entry_size(path):
+        return sum(osp.getsize(osp.join(path, f)) for f in os.listdir(path))
+
+    def _scan(self):
+        """Update `sizes` with the entries on disk, including those written or evicted by other workers.
+
+        Entries never change once written, so only new ones are measured.
+        """
+        names = set(name for name in os.listdir(self.root) if ".tmp" not in name)
+        for name in names - set(self.sizes):
+            try:
+                self.sizes[name] = self._entry_size(osp.join(self.root, name))
+            except OSError:
+                # evicted meanwhile
+                pass
+        for name in set(self.sizes) - names:
+            del self.sizes[name]
+
+    def _load(self, entry, step):
+        with open(osp.join(entry, "meta.pkl"), "rb") as f:
+            meta = pickle.load(f)
+        paths = dict(_outputs(step))
+        for key, kind in meta["outputs"].items():
+            if kind == "file":
+                shutil.copyfile(osp.join(entry, key), paths[key])
+            else:
+                store.put_artifact(paths[key], kind, np.load(osp.join(entry, key + ".npy")))
+        os.utime(entry)
+        return meta["result"]
+
+    def _save(self, name, step, result):
+        entry = osp.join(self.root, name)
+        tmp = entry + ".tmp%d" % os.getpid()
+        os.makedirs(tmp, exist_ok=True)
+        outputs = {}
+        for key, path in _outputs(step):
+            if path in store.items:
+                kind, value = store.get_artifact(path)
+                np.save(osp.join(tmp, key + ".npy"), value)
+                outputs[key] = kind
+            elif osp.isfile(path):
+                # written directly by the tool, e.g. detection results
+                shutil.copyfile(path, osp.join(tmp, key))
+                outputs[key] = "file"
+        with open(osp.join(tmp, "meta.pkl"), "wb") as f:
+            pickle.dump({"tool": step["tool"], "outputs": outputs, "result": result}, f)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # Written concurrently by another worker
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        with self.lock:
+            self.sizes[name] = self._entry_size(entry)
+        self._evict()
+
+    def _evict(self):
+        with self.lock:
+            self._scan()
+            total = sum(self.sizes.values())
+            if total <= self.max_bytes:
+                return
+            entry = lambda n: osp.join(self.root, n)
+            by_age = sorted(self.sizes, key=lambda n: osp.getmtime(entry(n)) if osp.exists(entry(n)) else 0)
+            for name in by_age:
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(osp.join(self.root, name), ignore_errors=True)
+                total -= self.sizes.pop(name)
+
+    def run(self, step, fn):
+        """Return fn(step), or replay its outputs from the cache."""
+        name = step_key(step)
+        entry = osp.join(self.root, name)
+        if osp.isdir(entry):
+            try:
+                with span("cache:load"):
+                    result = self._load(entry, step)
+                with self.lock:
+                    self.hits += 1
+                return result
+            except (OSError, EOFError, pickle.UnpicklingError, KeyError):
+                shutil.rmtree(entry, ignore_errors=True)
+        with self.lock:
+            self.misses += 1
+        result = fn(step)
+        with span("cache:save"):
+            self._save(name, step, result)
+        return result
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self.sizes),
+                "bytes": sum(self.sizes.values()),
+            }
+
+
+class LatentCache:
+    """On-disk cache of latent tensors, e.g. the DDIM inversion of a background.
+
+    Entries are single fp16 .npy files named by the hash of their key (any
+    JSON-serializable value) and are loaded memory-mapped. They are evicted
+    least-recently-used once the cache grows beyond `max_bytes`.
+    """
+
+    def __init__(self, root=None, max_bytes=None):
+        self.root = root or os.getenv("GENARTIST_LATENT_CACHE_DIR", ".cache/latents")
+        if max_bytes is None:
+            max_bytes = float(os.getenv("GENARTIST_LATENT_CACHE_GB", 2)) * GB
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        self.sizes = {}
+        self._scan()
+
+    def _scan(self):
+        """Update `sizes` with the files on disk, including those written or evicted by other workers."""
+        names = set(name for name in os.listdir(self.root) if name.endswith(".npy"))
+        for name in names - set(self.sizes):
+            try:
+                self.sizes[name] = osp.getsize(osp.join(self.root, name))
+            except OSError:
+                pass
+        for name in set(self.sizes) - names:
+            del self.sizes[name]
+
+    @staticmethod
+    def _name(key):
+        spec = json.dumps([CACHE_VERSION, key], sort_keys=True, default=str)
+        return hashlib.sha256(spec.encode()).hexdigest() + ".npy"
+
+    def get(self, key, dtype=None):
+        """The tensor stored under `key` (CPU, memory-mapped until cast or moved), or None."""
+        import torch
+        path = osp.join(self.root, self._name(key))
+        try:
+            # copy-on-write: writable for torch, the file is never modified
+            array = np.load(path, mmap_mode="c")
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        os.utime(path)
+        with self.lock:
+            self.hits += 1
+        tensor = torch.from_numpy(array)
+        return tensor if dtype is None else tensor.to(dtype)
+
+    def put(self, key, tensor):
+        name = self._name(key)
+        path = osp.join(self.root, name)
+        tmp = path + ".tmp%d" % os.getpid()
+        with open(tmp, "wb") as f:
+            np.save(f, tensor.detach().cpu().half().numpy())
+        os.replace(tmp, path)
+        with self.lock:
+            self.sizes[name] = osp.getsize(path)
+        self._evict()
+
+    def _evict(self):
+        with self.lock:
+            self._scan()
+            total = sum(self.sizes.values())
+            if total <= self.max_bytes:
+                return
+            entry = lambda n: osp.join(self.root, n)
+            by_age = sorted(self.sizes, key=lambda n: osp.getmtime(entry(n)) if osp.exists(entry(n)) else 0)
+            for name in by_age:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(entry(name))
+                except OSError:
+                    pass
+                total -= self.sizes.pop(name)
+
+
+_latent_cache = None
+
+
+def latent_cache():
+    """The LatentCache of this process, or None when GENARTIST_CACHE=0."""
+    global _latent_cache
+    if os.getenv("GENARTIST_CACHE", "1") != "1":
+        return None
+    if _latent_cache is None:
+        _latent_cache = LatentCache()
+    return _latent_cache
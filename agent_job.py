@@ -0,0 +1,56 @@
+import os
+import os.path as osp
+import json
+import shutil
+import time
+import uuid
+
+
+JOBS_ROOT = os.getenv("GENARTIST_JOBS", "jobs")
+
+
+class Job:
+    """Scratch space of one agent run: jobs/<id>/{inputs/, input.json, outputs/}.
+
+    Every file a job reads or writes lives under its own directory, so
+    several jobs (in one process, several processes or on several GPUs) can
+    run side by side without overwriting each other's inputs/<k>.png.
+    """
+
+    def __init__(self, job_id=None, root=JOBS_ROOT):
+        if job_id is None:
+            job_id = time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+        self.id = str(job_id)
+        self.dir = osp.join(root, self.id)
+        self.inputs = osp.join(self.dir, "inputs")
+        self.outputs = osp.join(self.dir, "outputs")
+        self.args_path = osp.join(self.dir, "input.json")
+        os.makedirs(self.inputs, exist_ok=True)
+        os.makedirs(self.outputs, exist_ok=True)
+
+    def path(self, name):
+        """Path of a step file, e.g. job.path('0.png')."""
+        return osp.join(self.inputs, name)
+
+    def output_path(self, name):
+        return osp.join(self.outputs, name)
+
+    @property
+    def source(self):
+        return self.path("0.png")
+
+    def parse(self, commands, text, text_bg, **kwargs):
+        from agent_tool import command_parse
+        return command_parse(commands, text, text_bg, dir=self.inputs, **kwargs)
+
+    def dump_step(self, step):
+        """Write a step for `python agent_tool_*.py --json_out True --input_json <path>`."""
+        with open(self.args_path, "w") as f:
+            json.dump(step, f)
+        return self.args_path
+
+    def cleanup(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def __repr__(self):
+        return "Job(%r)" % self.id
@@ -0,0 +1,240 @@
+import os
+import os.path as osp
+import gc
+import json
+import threading
+from collections import OrderedDict
+
+import torch
+
+from agent_trace import span
+
+
+GB = 1024 ** 3
+
+
+def _modules(obj):
+    """Yield the torch modules held by a model, a pipeline or a container of them."""
+    if isinstance(obj, torch.nn.Module):
+        yield obj
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            yield from _modules(v)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            yield from _modules(v)
+    elif hasattr(obj, "components"):
+        # diffusers pipelines
+        yield from _modules(dict(obj.components))
+
+
+def model_nbytes(obj):
+    nbytes = 0
+    for module in _modules(obj):
+        for t in list(module.parameters()) + list(module.buffers()):
+            nbytes += t.numel() * t.element_size()
+    return nbytes
+
+
+def _to(obj, device):
+    for module in _modules(obj):
+        module.to(device)
+
+
+class _Entry:
+    def __init__(self, model, device, nbytes, movable):
+        self.model = model
+        self.home = device
+        self.device = device
+        self.nbytes = nbytes
+        self.movable = movable
+
+
+class ModelRegistry:
+    """Process-wide cache of loaded models, keyed by (model id, dtype, device).
+
+    Models stay resident until the GPU budget is exceeded; the least recently
+    used ones are then offloaded to CPU (while the CPU budget allows) or
+    dropped, in which case the next `get` reloads them from disk.
+
+    Room is made before a model is loaded, from the size it had when it was
+    last loaded (kept in `sizes_path` across runs); a model that runs out of
+    GPU memory while loading (first load, or a grown checkpoint) is loaded
+    again after everything else has been moved off the GPU.
+    """
+
+    def __init__(self, gpu_budget=None, cpu_budget=None, sizes_path=None):
+        if gpu_budget is None:
+            gpu_budget = float(os.getenv("GENARTIST_GPU_BUDGET_GB", 0)) * GB
+            if not gpu_budget and torch.cuda.is_available():
+                gpu_budget = 0.85 * torch.cuda.get_device_properties(0).total_memory
+        if cpu_budget is None:
+            cpu_budget = float(os.getenv("GENARTIST_CPU_BUDGET_GB", 16)) * GB
+        self.gpu_budget = gpu_budget
+        self.cpu_budget = cpu_budget
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.offloads = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+        self.sizes_path = sizes_path or os.getenv("GENARTIST_MODEL_SIZES", ".cache/model_sizes.json")
+        self.sizes = self._read_sizes()
+
+    def _read_sizes(self):
+        try:
+            with open(self.sizes_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _record_size(self, name, nbytes):
+        if self.sizes.get(name) == nbytes:
+            return
+        # merged with the sizes recorded meanwhile by other workers
+        self.sizes = dict(self._read_sizes(), **{name: nbytes})
+        try:
+            os.makedirs(osp.dirname(self.sizes_path) or ".", exist_ok=True)
+            tmp = self.sizes_path + ".tmp%d" % os.getpid()
+            with open(tmp, "w") as f:
+                json.dump(self.sizes, f, indent=1)
+            os.replace(tmp, self.sizes_path)
+        except OSError:
+            pass
+
+    def _load(self, name, loader, on_gpu):
+        """loader(), after making room for the model's last known size."""
+        estimate = self.sizes.get(name)
+        if estimate is not None:
+            self._make_room(estimate, on_gpu)
+        try:
+            return loader()
+        except RuntimeError as e:
+            # torch.cuda.OutOfMemoryError is a RuntimeError
+            if not on_gpu or "out of memory" not in str(e):
+                raise
+        # unknown or outdated size: free the whole GPU budget and try again
+        self._make_room(self.gpu_budget, True)
+        return loader()
+
+    def _used(self, on_gpu):
+        return sum(e.nbytes for e in self.entries.values() if (e.device != "cpu") == on_gpu)
+
+    def _make_room(self, nbytes, on_gpu, keep=None):
+        budget = self.gpu_budget if on_gpu else self.cpu_budget
+        for key in list(self.entries):
+            if self._used(on_gpu) + nbytes <= budget:
+                return
+            entry = self.entries[key]
+            if key == keep or (entry.device != "cpu") != on_gpu:
+                continue
+            if on_gpu and entry.movable and self._used(False) + entry.nbytes <= self.cpu_budget:
+                _to(entry.model, "cpu")
+                entry.device = "cpu"
+                self.offloads += 1
+            else:
+                self._drop(key)
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _drop(self, key):
+        del self.entries[key]
+        self.evictions += 1
+
+    def get(self, model_id, loader, dtype=None, device="cuda", movable=True):
+        """Return the model for `model_id`, calling `loader()` on a miss.
+
+        `loader` must return the model already placed on `device`. Pass
+        movable=False for pipelines that manage their own placement
+        (e.g. with enable_model_cpu_offload); they are dropped instead of
+        being offloaded.
+        """
+        key = (model_id, str(dtype), str(device))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                if entry.device != entry.home:
+                    with span("load:" + model_id, offloaded=True):
+                        self._make_room(entry.nbytes, True, keep=key)
+                        _to(entry.model, entry.home)
+                    entry.device = entry.home
+                return entry.model
+
+            self.misses += 1
+            on_gpu = str(device) != "cpu"
+            with span("load:" + model_id, offloaded=False):
+                model = self._load("|".join(key), loader, on_gpu)
+                nbytes = model_nbytes(model)
+                self._record_size("|".join(key), nbytes)
+                # the estimate may be missing or out of date
+                self._make_room(nbytes, on_gpu)
+            self.entries[key] = _Entry(model, str(device), nbytes, movable)
+            return model
+
+    def evict(self, model_id=None):
+        """Drop one model id (all dtypes/devices), or everything."""
+        with self.lock:
+            for key in list(self.entries):
+                if model_id is None or key[0] == model_id:
+                    self._drop(key)
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "offloads": self.offloads,
+                "evictions": self.evictions,
+                "gpu_bytes": self._used(True),
+                "cpu_bytes": self._used(False),
+                "resident": [key[0] for key in self.entries],
+            }
+
+
+registry = ModelRegistry()
+
+
+# ----------------------------------------------------------------------------
+# Models shared by several tools
+# ----------------------------------------------------------------------------
+
+GROUNDINGDINO_CONFIG = "GroundingDINO/groundingdino/config/GroundingDINO_SwinT_OGC.py"
+GROUNDINGDINO_CKPT = "GroundingDINO/weights/groundingdino_swint_ogc.pth"
+
+
+def get_sam(key="sam-vit-base"):
+    """(SamModel, SamProcessor) from transformers, on cuda."""
+    def load():
+        from transformers import SamModel, SamProcessor
+        return SamModel.from_pretrained(key).to("cuda"), SamProcessor.from_pretrained(key)
+    return registry.get(key, load, dtype=torch.float)
+
+
+def get_groundingdino():
+    def load():
+        from groundingdino.util.inference import load_model
+        return load_model(GROUNDINGDINO_CONFIG, GROUNDINGDINO_CKPT).to("cuda")
+    return registry.get(GROUNDINGDINO_CKPT, load, dtype=torch.float)
+
+
+def get_lmd_models(models, key="diffusers-generation-text-box"):
+    """LMD model_dict (vae, text encoder, unet, schedulers) plus SAM.
+
+    `models` is the LLM-groundedDiffusion `models` package of the caller.
+    """
+    def load():
+        return models.load_sd(key=key, use_fp16=False, load_inverse_scheduler=True, scheduler_cls=None)
+    # A shallow copy, so that offloading the LMD entry never moves SAM
+    model_dict = registry.get(osp.normpath(key), load, dtype=torch.float)
+    model_dict = type(model_dict)(model_dict)
+    sam_model, sam_processor = get_sam()
+    model_dict.update(sam_model=sam_model, sam_processor=sam_processor)
+    return model_dict
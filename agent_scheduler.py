@@ -0,0 +1,92 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from agent_trace import span
+
+
+OUTPUT_KEYS = ("output", "output_mask")
+
+
+def step_outputs(step):
+    """Paths a step writes; "output" is a list for multi-query segmentation steps."""
+    paths = []
+    for k in OUTPUT_KEYS:
+        value = step.get(k)
+        if isinstance(value, str):
+            paths.append(value)
+        elif isinstance(value, list):
+            paths.extend(value)
+    return paths
+
+
+def step_inputs(step):
+    return [v for v in step.get("input", {}).values() if isinstance(v, str)]
+
+
+def step_dependencies(steps):
+    """For each step, the indices of the earlier steps producing a file it reads."""
+    producer = {}
+    deps = []
+    for i, step in enumerate(steps):
+        deps.append(sorted({producer[p] for p in step_inputs(step) if p in producer}))
+        for p in step_outputs(step):
+            producer[p] = i
+    return deps
+
+
+def critical_path(steps, cost=None):
+    """Length of the longest dependency chain, in steps (or in `cost(step)` units)."""
+    cost = cost or (lambda step: 1)
+    deps = [step.get("deps", d) for step, d in zip(steps, step_dependencies(steps))]
+    finish = []
+    for i, step in enumerate(steps):
+        finish.append(max([finish[j] for j in deps[i]], default=0) + cost(step))
+    return max(finish, default=0)
+
+
+class StepFailed(RuntimeError):
+    pass
+
+
+def run_graph(steps, pool):
+    """Run `steps` on a WorkerPool, starting every step as soon as its inputs exist.
+
+    Steps carry their dependencies in "deps" (see `command_parse`); steps
+    without it get them from the files they read. When the pool has more
+    than one worker, each step's outputs are flushed to disk right away so
+    a step running in another worker process can read them.
+    """
+    deps = [set(step.get("deps", d)) for step, d in zip(steps, step_dependencies(steps))]
+    children = [[] for _ in steps]
+    for i, d in enumerate(deps):
+        for j in d:
+            children[j].append(i)
+    share_outputs = len(pool) > 1
+    results = [None] * len(steps)
+
+    def run(i):
+        with pool.acquire() as worker, span("step:" + steps[i]["tool"], index=i):
+            result = worker.run(steps[i])
+            if share_outputs and step_outputs(steps[i]):
+                worker.flush(step_outputs(steps[i]))
+        return result
+
+    with ThreadPoolExecutor(max_workers=len(pool)) as executor:
+        running = {}
+        for i in range(len(steps)):
+            if not deps[i]:
+                running[executor.submit(run, i)] = i
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    for f in running:
+                        f.cancel()
+                    raise StepFailed("step %d (%s) failed" % (i, steps[i]["tool"])) from error
+                results[i] = future.result()
+                for c in children[i]:
+                    deps[c].discard(i)
+                    if not deps[c]:
+                        running[executor.submit(run, c)] = c
+    return results
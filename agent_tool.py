@@ -1,35 +1,70 @@
 from PIL import Image
 import os
 import os.path as osp
-import torch
-import diffusers
 import cv2
-from agent_tool_aux import main_aux
-from agent_tool_edit import main_edit
-from agent_tool_generate import main_generate
-import gc
+from agent_worker import WorkerPool, devices_from_env
+from agent_scheduler import step_dependencies, run_graph
+from agent_job import Job
+from agent_trace import tracer
 import json
-
-
-def command_parse(commands, text, text_bg, dir='inputs'):
+import argparse
+
+
+def merge_segmentations(args):
+    """Fold segmentation steps that read the same image into one multi-query step.
+
+    The merged step takes the place of the first of them, with
+    "input": {"image", "queries": [...]} and one "output" path per query, so
+    GroundingDINO and SAM encode the image once for all of them.
+    """
+    by_image = {}
+    for arg in args:
+        if arg["tool"] == "segmentation":
+            by_image.setdefault(arg["input"]["image"], []).append(arg)
+    merged = []
+    for arg in args:
+        group = by_image.get(arg["input"]["image"]) if arg["tool"] == "segmentation" else None
+        if not group or len(group) == 1:
+            merged.append(arg)
+        elif arg is group[0]:
+            queries = [{k: v for k, v in a["input"].items() if k != "image"} for a in group]
+            merged.append({"tool": "segmentation", "output": [a["output"] for a in group],
+                           "input": {"image": arg["input"]["image"], "queries": queries}})
+    return merged
+
+
+def command_parse(commands, text, text_bg, dir='inputs', ground_on_source=False):
+    """Expand agent commands into tool steps.
+
+    Step k reads the image written by the previous command (`<k>.png`). With
+    ground_on_source=True, locating an object (segmentation, and generating the
+    object of an `addition`/`edit`) uses the source image `0.png` instead, so
+    these steps no longer wait for earlier commands and can run concurrently;
+    only use it when earlier commands do not move or add the objects that later
+    commands refer to. Segmentations of the same image are then merged into one
+    step (see `merge_segmentations`). Every step gets "deps": the indices of the
+    steps whose outputs it reads.
+    """
     args = []
     generation_arg = None
+    source = osp.join(dir, '0.png')
     for i in range(len(commands)):
         command = commands[i]
+        k = len(args)
+        locate = source if ground_on_source else osp.join(dir, str(k)+'.png')
         if command['tool'] == 'edit':
-            k = len(args)
             if 'box' in command:
                 if 'intbox' in command:
                     bb = command['box']
                     command['box'] = [bb[0]/512., bb[1]/512., (bb[2]-bb[0])/512., (bb[3]-bb[1])/512.]
-                arg = {"tool": "segmentation", "output": osp.join(dir, str(k+1)+'_mask.png'), "input": {"image": osp.join(dir, str(k)+'.png'), "text": command["input"], 'box': command['box']} }
+                arg = {"tool": "segmentation", "output": osp.join(dir, str(k+1)+'_mask.png'), "input": {"image": locate, "text": command["input"], 'box': command['box']} }
             else:
-                arg = {"tool": "segmentation", "output": osp.join(dir, str(k+1)+'_mask.png'), "input": {"image": osp.join(dir, str(k)+'.png'), "text": command["input"]} }
+                arg = {"tool": "segmentation", "output": osp.join(dir, str(k+1)+'_mask.png'), "input": {"image": locate, "text": command["input"]} }
             args.append(arg)
 
             arg = {"tool": "object_addition_anydoor",  "text": text, "text_bg": text_bg, 
                     "output": osp.join(dir, str(k+2)+'.png'), "output_mask": osp.join(dir, str(k+2)+'_mask.png'), 
-                    "input": {"image": osp.join(dir, str(k)+'.png'), "object": command["edit"], "layout": osp.join(dir, str(k+1)+'_mask.png') } }
+                    "input": {"image": locate, "object": command["edit"], "layout": osp.join(dir, str(k+1)+'_mask.png') } }
             args.append(arg)
 
             arg = {"tool": "replace_anydoor", "output": osp.join(dir, str(k+3)+'.png'), 
@@ -40,25 +75,23 @@ def command_parse(commands, text, text_bg, dir='inputs'):
             if 'intbox' in command:
                 bb = command['box']
                 command['box'] = [bb[0]/512., bb[1]/512., (bb[2]-bb[0])/512., (bb[3]-bb[1])/512.]
-            k = len(args)
-            arg = {"tool": "segmentation", "output": osp.join(dir, str(k+1)+'_mask.png'), "input": {"image": osp.join(dir, str(k)+'.png'), "text": command["input"]} }
+            arg = {"tool": "segmentation", "output": osp.join(dir, str(k+1)+'_mask.png'), "input": {"image": locate, "text": command["input"]} }
             args.append(arg)
 
             arg = {"tool": "remove", "output":  osp.join(dir, str(k+2)+'.png'), "input": {"image": osp.join(dir, str(k)+'.png'), "mask": osp.join(dir, str(k+1)+'_mask.png')} }
             args.append(arg)
 
             arg = {"tool": "addition_anydoor", "output": osp.join(dir, str(k+3)+'.png'), 
-                "input": {"image": osp.join(dir, str(k+2)+'.png'), "object": osp.join(dir, str(k)+'.png'), 
+                "input": {"image": osp.join(dir, str(k+2)+'.png'), "object": locate, 
                         "object_mask": osp.join(dir, str(k+1)+'_mask.png'), "mask": command["box"]  } }
             args.append(arg)
         elif command['tool'] == 'addition':
-            k = len(args)
             if 'intbox' in command:
                 bb = command['box']
                 command['box'] = [bb[0]/512., bb[1]/512., (bb[2]-bb[0])/512., (bb[3]-bb[1])/512.]
             arg = {"tool": "object_addition_anydoor",  "text": text, "text_bg": text_bg, 
                     "output": osp.join(dir, str(k+1)+'.png'), "output_mask": osp.join(dir, str(k+1)+'_mask.png'), 
-                    "input": {"image": osp.join(dir, str(k)+'.png'), "object": command["input"], "layout": command["box"] } }
+                    "input": {"image": locate, "object": command["input"], "layout": command["box"] } }
             args.append(arg)
 
             arg = {"tool": "addition_anydoor", "output": osp.join(dir, str(k+2)+'.png'), 
@@ -66,8 +99,7 @@ def command_parse(commands, text, text_bg, dir='inputs'):
                         "object_mask": osp.join(dir, str(k+1)+'_mask.png'), "mask": command["box"]  } }
             args.append(arg)
         elif command['tool'] == 'remove':
-            k = len(args)
-            arg = {"tool": "segmentation", "output": osp.join(dir, str(k+1)+'_mask.png'), "input": {"image": osp.join(dir, str(k)+'.png'), "text": command["input"], "mask_threshold": command.get("mask_thr", 0.0)} }
+            arg = {"tool": "segmentation", "output": osp.join(dir, str(k+1)+'_mask.png'), "input": {"image": locate, "text": command["input"], "mask_threshold": command.get("mask_thr", 0.0)} }
             if 'box' in command:
                 if 'intbox' in command:
                     bb = command['box']
@@ -78,15 +110,13 @@ def command_parse(commands, text, text_bg, dir='inputs'):
             arg = {"tool": "remove", "output":  osp.join(dir, str(k+2)+'.png'), "input": {"image": osp.join(dir, str(k)+'.png'), "mask": osp.join(dir, str(k+1)+'_mask.png')} }
             args.append(arg)
         elif command['tool'] == 'instruction':
-            k = len(args)
             arg = {"tool": "instruction", "output": osp.join(dir, str(k+1)+'.png'), "input": {"image": osp.join(dir, str(k)+'.png'), "text": command["text"]} }
             args.append(arg)
         elif command['tool'] == 'edit_attribute':
-            k = len(args)
             if 'box' in command:
-                arg = {"tool": "segmentation", "output": osp.join(dir, str(k+1)+'_mask.png'), "input": {"image": osp.join(dir, str(k)+'.png'), "text": command["input"], 'box': command['box']} }
+                arg = {"tool": "segmentation", "output": osp.join(dir, str(k+1)+'_mask.png'), "input": {"image": locate, "text": command["input"], 'box': command['box']} }
             else:
-                arg = {"tool": "segmentation", "output": osp.join(dir, str(k+1)+'_mask.png'), "input": {"image": osp.join(dir, str(k)+'.png'), "text": command["input"]} }
+                arg = {"tool": "segmentation", "output": osp.join(dir, str(k+1)+'_mask.png'), "input": {"image": locate, "text": command["input"]} }
             args.append(arg)
 
             arg = {"tool": "attribute_diffedit", 
@@ -103,11 +133,18 @@ def command_parse(commands, text, text_bg, dir='inputs'):
     args.append(arg)
     if generation_arg is not None:
         args = [generation_arg] + args
+    args = merge_segmentations(args)
+    for arg, deps in zip(args, step_dependencies(args)):
+        arg["deps"] = deps
     return args
 
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="for agent")
+    parser.add_argument("--ground_on_source", action="store_true",
+                        help="locate objects on the source image, so that independent commands run concurrently")
+    cli_args = parser.parse_args()
 
     ### text to image generation
     input_image = None
@@ -131,22 +168,19 @@ if __name__ == '__main__':
     # commands = json.load(open('demo/editing_1.json')) 
 
 
+    job = Job()
     if input_image is not None:
-        os.system('cp ' + input_image + ' inputs/0.png')
-        im = cv2.imread('inputs/0.png')
+        im = cv2.imread(input_image)
         im = cv2.resize(im, (512,512))
-        cv2.imwrite('inputs/0.png', im)
+        cv2.imwrite(job.source, im)
 
-    seq_args = command_parse(commands, text, text_bg,)
+    # Independent steps run concurrently when several workers are given, e.g.
+    # GENARTIST_DEVICES=0,1 python agent_tool.py --ground_on_source
+    # (without it every step reads the previous <k>.png and the steps form a chain)
+    seq_args = job.parse(commands, text, text_bg, ground_on_source=cli_args.ground_on_source)
     print(seq_args)
-    for i in range(len(seq_args)):
-        json.dump(seq_args[i], open('input.json','w'))
-        if seq_args[i]['tool'] in ["object_addition_anydoor", "segmentation"]:
-            # main_aux(seq_args[i])
-            os.system('python agent_tool_aux.py --json_out True')
-        elif seq_args[i]['tool'] in ["addition_anydoor", "replace_anydoor", "remove", "instruction", "attribute_diffedit"]:
-            # main_edit(seq_args[i])
-            os.system('python agent_tool_edit.py --json_out True')
-        elif seq_args[i]['tool'] in ['text_to_image_SDXL', 'image_to_image_SD2', 'layout_to_image_LMD', 'layout_to_image_BoxDiff', 'superresolution_SDXL']:
-            # main_generate(seq_args[i])
-            os.system('python agent_tool_generate.py --json_out True')
+    with WorkerPool(devices_from_env()) as pool:
+        run_graph(seq_args, pool)
+        pool.flush([seq_args[-1]['output']])
+        print('trace:', tracer.export(job.dir, pool.trace()))
+    print('output:', seq_args[-1]['output'])
@@ -8,9 +8,21 @@ import random
 import json
 import gc
 import argparse
+from collections import OrderedDict
+from agent_models import get_sam, get_groundingdino, get_lmd_models
+from agent_artifacts import store
+from agent_cache import latent_cache, checkpoint_identity
+from agent_trace import span
 
 class_lvis = json.load(open('cname7k.json'))
 
+# GroundingDINO vocabulary chunks by class list, and their text features by chunk captions
+_vocab_chunks = {}
+_vocab_text = {}
+# GroundingDINO backbone outputs by image content hash, least recently used first
+_dino_features = OrderedDict()
+DINO_FEATURE_CACHE = int(os.getenv("GENARTIST_DINO_FEATURES", 8))
+
 def clear_globals():
     global_vars = globals()
     for var_name in list(global_vars.keys()):
@@ -18,13 +30,214 @@ def clear_globals():
             print(var_name)
             del global_vars[var_name]
 
+def load_dino_image(image_path):
+    """groundingdino.util.inference.load_image, reading through the artifact store."""
+    import groundingdino.datasets.transforms as T
+    transform = T.Compose(
+        [
+            T.RandomResize([800], max_size=1333),
+            T.ToTensor(),
+            T.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+        ]
+    )
+    image_source = store.load_pil(image_path)
+    image = np.asarray(image_source)
+    image_transformed, _ = transform(image_source, None)
+    return image, image_transformed
+
+
+def dino_image_features(image_path):
+    """(samples, features, poss) of the GroundingDINO backbone for an image.
+
+    Cached by the content of the image (store.digest), so that the
+    segmentations and detections of a job on the same inputs/<k>.png run the
+    Swin backbone once. Only the backbone output is reusable: the encoder
+    fuses image and text features. At most GENARTIST_DINO_FEATURES images
+    are kept.
+    """
+    from groundingdino.util.misc import nested_tensor_from_tensor_list
+    key = store.digest(image_path)
+    if key in _dino_features:
+        _dino_features.move_to_end(key)
+        return _dino_features[key]
+    model = get_groundingdino()
+    with span("preprocess"):
+        _, image = load_dino_image(image_path)
+    with span("backbone"), torch.no_grad():
+        samples = nested_tensor_from_tensor_list([image.to("cuda")])
+        features, poss = model.backbone(samples)
+    _dino_features[key] = (samples, features, poss)
+    while len(_dino_features) > DINO_FEATURE_CACHE:
+        _dino_features.popitem(last=False)
+    return samples, features, poss
+
+
+def dino_forward(model, image_path, batch=1, **kw):
+    """GroundingDINO forward on an image for `batch` captions (captions=... or
+    text_dict=...), from its cached backbone features."""
+    from groundingdino.util.misc import NestedTensor
+    samples, features, poss = dino_image_features(image_path)
+    repeat = lambda t: t.repeat(batch, *[1] * (t.dim() - 1))
+    # new lists: forward appends the extra feature levels to poss
+    model.set_image_features([NestedTensor(repeat(f.tensors), repeat(f.mask)) for f in features],
+                             [repeat(p) for p in poss])
+    return model(NestedTensor(repeat(samples.tensors), repeat(samples.mask)), **kw)
+
+
+def dino_predict(image_path, caption, box_threshold, text_threshold):
+    """groundingdino.util.inference.predict, from the cached backbone features."""
+    from groundingdino.util.inference import preprocess_caption
+    from groundingdino.util.utils import get_phrases_from_posmap
+    model = get_groundingdino()
+    caption = preprocess_caption(caption=caption)
+    with torch.no_grad():
+        outputs = dino_forward(model, image_path, captions=[caption])
+    prediction_logits = outputs["pred_logits"].cpu().sigmoid()[0]
+    prediction_boxes = outputs["pred_boxes"].cpu()[0]
+    mask = prediction_logits.max(dim=1)[0] > box_threshold
+    logits = prediction_logits[mask]
+    boxes = prediction_boxes[mask]
+    tokenized = model.tokenizer(caption)
+    phrases = [get_phrases_from_posmap(logit > text_threshold, tokenized, model.tokenizer).replace('.', '')
+               for logit in logits]
+    return boxes, logits.max(dim=1)[0], phrases
+
+
+def vocabulary_chunks(names, tokenizer, max_tokens):
+    """Captions "a . b . c ." of consecutive class names, each within
+    `max_tokens` BERT tokens, with the (name, start, end) character span of
+    every name in its caption."""
+    key = (tuple(names), max_tokens)
+    if key not in _vocab_chunks:
+        chunks, caption, spans, used = [], "", [], 0
+        for name in names:
+            name = name.lower().strip()
+            n_tokens = len(tokenizer(name, add_special_tokens=False)["input_ids"]) + 1  # and its " ."
+            if spans and used + n_tokens > max_tokens:
+                chunks.append((caption, spans))
+                caption, spans, used = "", [], 0
+            start = len(caption) + 1 if caption else 0
+            caption = (caption + " " if caption else "") + name + " ."
+            spans.append((name, start, start + len(name)))
+            used += n_tokens
+        if spans:
+            chunks.append((caption, spans))
+        _vocab_chunks[key] = chunks
+    return _vocab_chunks[key]
+
+
+def vocabulary_text(model, chunks):
+    """GroundingDINO text_dict of a batch of chunks, and a positive map (names x tokens) per chunk; cached."""
+    from groundingdino.util.vl_utils import create_positive_map_from_span
+    key = tuple(caption for caption, _ in chunks)
+    if key not in _vocab_text:
+        with span("encode_text", chunks=len(chunks)), torch.no_grad():
+            text_dict = model.encode_text(list(key), "cuda")
+        positive_maps = []
+        for caption, spans in chunks:
+            tokenized = model.tokenizer(caption)
+            positive_maps.append(create_positive_map_from_span(
+                tokenized, [[[start, end]] for _, start, end in spans], max_text_len=model.max_text_len).to("cuda"))
+        _vocab_text[key] = (text_dict, positive_maps)
+    return _vocab_text[key]
+
+
+def detect_vocabulary(image_path, names, box_threshold=0.35, text_threshold=0.25, chunk_batch=8, iou_threshold=0.5):
+    """Detection over a class list of any size.
+
+    The names are split into captions that fit GroundingDINO's max_text_len
+    (a single caption would be truncated to the first few hundred names).
+    Text features of the chunks are computed once and cached, the image
+    backbone runs once, and the chunks go through the transformer
+    `chunk_batch` at a time. Each kept query is labelled with the class whose
+    tokens it matches best; results of all chunks are merged by class-aware
+    NMS. Returns relative xyxy boxes, scores and class names, best first.
+    """
+    from groundingdino.util import box_ops
+    from torchvision.ops import batched_nms
+
+    model = get_groundingdino()
+    chunks = vocabulary_chunks(names, model.tokenizer, model.max_text_len - 2)
+    boxes, scores, labels, label_names = [], [], [], []
+    with span("detect", chunks=len(chunks)), torch.no_grad():
+        for b in range(0, len(chunks), chunk_batch):
+            batch = chunks[b:b + chunk_batch]
+            text_dict, positive_maps = vocabulary_text(model, batch)
+            outputs = dino_forward(model, image_path, len(batch), text_dict=text_dict)
+            probs = outputs["pred_logits"].sigmoid()
+            for k, (_, spans) in enumerate(batch):
+                keep = probs[k].max(dim=1)[0] > box_threshold
+                if not keep.any():
+                    continue
+                class_scores, class_ids = (probs[k][keep] @ positive_maps[k].T).max(dim=1)
+                matched = class_scores > text_threshold
+                boxes.append(box_ops.box_cxcywh_to_xyxy(outputs["pred_boxes"][k][keep][matched]))
+                scores.append(probs[k][keep][matched].max(dim=1)[0])
+                labels.append(class_ids[matched] + len(label_names))
+                label_names += [name for name, _, _ in spans]
+    if not boxes:
+        return torch.zeros((0, 4)), torch.zeros(0), []
+    boxes, scores, labels = torch.cat(boxes), torch.cat(scores), torch.cat(labels)
+    keep = batched_nms(boxes, scores, labels, iou_threshold)  # sorted by score
+    return boxes[keep].cpu(), scores[keep].cpu(), [label_names[i] for i in labels[keep].tolist()]
+
+
+def segment_queries(image_path, queries, box_threshold=0.35):
+    """Masks for several queries on one image, each {"text", "box" (optional), "mask_threshold"}.
+
+    Queries without a box are located by GroundingDINO: the Swin backbone runs
+    once and all captions go through the transformer as one batch. SAM then
+    embeds the image once and decodes the first box of every query in one
+    call. Returns an HxW uint8 mask (0/255) per query, None if nothing was found.
+    """
+    from groundingdino.util.inference import preprocess_caption
+    from groundingdino.util import box_ops
+
+    boxes = [None] * len(queries)  # relative xyxy
+    for i, query in enumerate(queries):
+        if query.get("box") is not None:
+            x, y, w, h = query["box"]
+            boxes[i] = [x, y, x + w, y + h]
+
+    todo = [i for i in range(len(queries)) if boxes[i] is None]
+    if todo:
+        model = get_groundingdino()
+        captions = [preprocess_caption(queries[i]["text"]) for i in todo]
+        with span("detect", queries=len(todo)), torch.no_grad():
+            outputs = dino_forward(model, image_path, len(todo), captions=captions)
+        logits = outputs["pred_logits"].cpu().sigmoid()
+        pred_boxes = outputs["pred_boxes"].cpu()
+        for k, i in enumerate(todo):
+            keep = logits[k].max(dim=1)[0] > box_threshold
+            if keep.any():
+                boxes[i] = box_ops.box_cxcywh_to_xyxy(pred_boxes[k][keep])[0].tolist()
+
+    masks = [None] * len(queries)
+    found = [i for i in range(len(queries)) if boxes[i] is not None]
+    if found:
+        # model, processor = get_sam("sam-vit-huge")
+        model, processor = get_sam("sam-vit-base")
+        raw_image = store.load_pil(image_path)
+        input_boxes = [[[k * 512 for k in boxes[i]] for i in found]]  ##############
+        with span("segment", boxes=len(found)), torch.no_grad():
+            inputs = processor([raw_image], input_boxes=input_boxes, return_tensors="pt").to("cuda")
+            embeddings = model.get_image_embeddings(inputs["pixel_values"])
+            outputs = model(image_embeddings=embeddings, input_boxes=inputs["input_boxes"])
+            probs = processor.image_processor.post_process_masks(outputs.pred_masks.cpu(), inputs["original_sizes"].cpu(), inputs["reshaped_input_sizes"].cpu(), binarize=False)[0]
+        for k, i in enumerate(found):
+            # first of SAM's three candidate masks, as before
+            masks[i] = (probs[k, 0] > queries[i].get("mask_threshold", 0.0)).numpy().astype(np.uint8) * 255
+    return masks
+
+
 def main_aux(args):
+    result = None
     if args["tool"] == "object_addition_anydoor":
         import cv2
         if args["input"]["layout"] == "TBG":
             args["input"]["layout"] = args_layout
         if type(args["input"]["layout"]) is str:
-            mask_image = cv2.imread(args["input"]["layout"])[:,:,0]
+            mask_image = store.load_mask(args["input"]["layout"])
             y, x = np.nonzero(mask_image)
             args["input"]["layout"] = [x.min(), y.min(), x.max()-x.min(), y.max()-y.min()]
             args["input"]["layout"] = [k/512. for k in args["input"]["layout"]]
@@ -37,7 +250,6 @@ def main_aux(args):
         
         os.sys.path.append('./LLM-groundedDiffusion/')
         import models
-        from models import sam
         from models.sam import sam_box_input
         from utils import parse, utils
         import cv2
@@ -48,14 +260,7 @@ def main_aux(args):
         # models.sd_key = "stable-diffusion-2-1-base"
         # models.sd_version = "sdv2"
 
-        models.model_dict = models.load_sd(
-            key=models.sd_key,
-            # use_fp16=True,
-            load_inverse_scheduler=True,
-            scheduler_cls=None
-        )
-        sam_model_dict = sam.load_sam()
-        models.model_dict.update(sam_model_dict)
+        models.model_dict = get_lmd_models(models, models.sd_key)
 
         import image_generator
         from utils.ilatents import get_all_latents
@@ -66,9 +271,16 @@ def main_aux(args):
         np.random.seed(default_seed)
         random.seed(default_seed)
 
-        image_source = np.array(Image.open(args["input"]["image"]))
-        # Background latent preprocessing
-        all_latents, _ = get_all_latents(image_source, models, default_seed)
+        image_source = store.load_rgb(args["input"]["image"])
+        # Background latent preprocessing, kept with the image for later steps on it
+        latents_key = ("lmd_inversion", models.sd_key, default_seed)
+        all_latents = store.get_extra(args["input"]["image"], latents_key)
+        if all_latents is None:
+            with span("preprocess", what="inversion"):
+                # persistent across runs: skipped for a background inverted before
+                all_latents, _ = get_all_latents(image_source, models, default_seed, cache=latent_cache(),
+                                                 model_id=checkpoint_identity(models.sd_key))
+            store.put_extra(args["input"]["image"], latents_key, all_latents)
         addition_objs = (args["input"]["object"], args["input"]["layout"])
         spec = {'add_objects': [addition_objs]}
         spec['remove_region'] = cv2.resize(mask_image, (64,64))
@@ -77,56 +289,53 @@ def main_aux(args):
         spec['prompt'] = args['text'] #'An oil painting at the beach of a blue bicycle to the left of a bench and to the right of a palm tree with three seagulls in the sky'
         spec['bg_prompt'] = args['text_bg'] # 'An oil painting at the beach of a blue bicycle to the left of a bench and to the right of a palm tree with three seagulls in the sky'
         spec["extra_neg_prompt"] = None
-        output = image_generator.run_singleobj(
-            spec,
-            fg_seed_start=default_seed,
-            bg_seed=default_seed,
-            bg_all_latents=all_latents,
-            frozen_step_ratio=0.5,
-        )
+        with span("generate"):
+            output = image_generator.run_singleobj(
+                spec,
+                fg_seed_start=default_seed,
+                bg_seed=default_seed,
+                bg_all_latents=all_latents,
+                frozen_step_ratio=0.5,
+            )
 
         layout = [i * 512 for i in args["input"]["layout"]]
         layout[2] = layout[2] + layout[0]
         layout[3] = layout[3] + layout[1]
             
-        output.save(args["output"])
-        from transformers import SamModel, SamProcessor
-        # model = SamModel.from_pretrained("sam-vit-huge").to("cuda")
-        # processor = SamProcessor.from_pretrained("sam-vit-huge")
-        model = SamModel.from_pretrained("sam-vit-base").to("cuda")
-        processor = SamProcessor.from_pretrained("sam-vit-base")
+        store.save_image(args["output"], output)
+        # model, processor = get_sam("sam-vit-huge")
+        model, processor = get_sam("sam-vit-base")
         raw_image = output
         input_boxes = [[layout]]
-        inputs = processor([raw_image], input_boxes=input_boxes, return_tensors="pt").to("cuda")
-        outputs = model(**inputs)
-        masks = processor.image_processor.post_process_masks(outputs.pred_masks.cpu(), inputs["original_sizes"].cpu(), inputs["reshaped_input_sizes"].cpu())
+        with span("segment"):
+            inputs = processor([raw_image], input_boxes=input_boxes, return_tensors="pt").to("cuda")
+            outputs = model(**inputs)
+            masks = processor.image_processor.post_process_masks(outputs.pred_masks.cpu(), inputs["original_sizes"].cpu(), inputs["reshaped_input_sizes"].cpu())
         masks = np.transpose(masks[0][0], (1,2,0))
         masks = masks[:,:,0]
-        cv2.imwrite(args["output_mask"], masks.numpy() * 255)
+        store.save_mask(args["output_mask"], masks.numpy() * 255)
         
     
     elif args["tool"] == "detection":
-        if args["input"]["text"] == "TBG":
-            args["input"]["text"] = " . ".join(class_lvis)
         from groundingdino.util.inference import load_model, load_image, predict, annotate
         import cv2
         from groundingdino.util import box_ops
 
-        model = load_model("GroundingDINO/groundingdino/config/GroundingDINO_SwinT_OGC.py", "GroundingDINO/weights/groundingdino_swint_ogc.pth")
+        model = get_groundingdino()
         IMAGE_PATH = args['input']['image']
         TEXT_PROMPT = args['input']['text']
         BOX_TRESHOLD = 0.35
         TEXT_TRESHOLD = 0.25
 
-        image_source, image = load_image(IMAGE_PATH)
-        boxes, logits, phrases = predict(
-            model=model,
-            image=image,
-            caption=TEXT_PROMPT,
-            box_threshold=BOX_TRESHOLD,
-            text_threshold=TEXT_TRESHOLD
-        )
-        boxes = box_ops.box_cxcywh_to_xyxy(boxes)
+        if TEXT_PROMPT == "TBG" or len(model.tokenizer(TEXT_PROMPT)["input_ids"]) > model.max_text_len:
+            # Whole vocabulary (or a caption that would be truncated): chunked, see detect_vocabulary
+            names = class_lvis if TEXT_PROMPT == "TBG" else [t.strip(" .") for t in TEXT_PROMPT.split(" . ")]
+            boxes, logits, phrases = detect_vocabulary(IMAGE_PATH, names, BOX_TRESHOLD, TEXT_TRESHOLD)
+        else:
+            # predict(), reusing the backbone features of this image if another step computed them
+            with span("detect"):
+                boxes, logits, phrases = dino_predict(IMAGE_PATH, TEXT_PROMPT, BOX_TRESHOLD, TEXT_TRESHOLD)
+            boxes = box_ops.box_cxcywh_to_xyxy(boxes)
         boxes[:,2] = boxes[:,2] - boxes[:,0]
         boxes[:,3] = boxes[:,3] - boxes[:,1]
         boxes = np.around(boxes.numpy(), decimals=2).tolist()
@@ -141,75 +350,37 @@ def main_aux(args):
         # annotated_frame = annotate(image_source=image_source, boxes=boxes, logits=logits, phrases=phrases)
         # cv2.imwrite("annotated_image.jpg", annotated_frame)
         print(str_objs)
+        if "output" in args:
+            json.dump(str_objs, open(args["output"], 'w'))
+        result = str_objs
     
     elif args["tool"] == "segmentation":
-        from groundingdino.util.inference import load_model, load_image, predict, annotate
-        import cv2
-        from groundingdino.util import box_ops
-
-        if not "box" in args["input"]:
-            model = load_model("GroundingDINO/groundingdino/config/GroundingDINO_SwinT_OGC.py", "GroundingDINO/weights/groundingdino_swint_ogc.pth")
-            IMAGE_PATH = args['input']['image']
-            TEXT_PROMPT = args['input']['text']
-            BOX_TRESHOLD = 0.35
-            TEXT_TRESHOLD = 0.25
-
-            image_source, image = load_image(IMAGE_PATH)
-            boxes, logits, phrases = predict(
-                model=model,
-                image=image,
-                caption=TEXT_PROMPT,
-                box_threshold=BOX_TRESHOLD,
-                text_threshold=TEXT_TRESHOLD
-            )
-            masks = torch.tensor([])
-            boxes = box_ops.box_cxcywh_to_xyxy(boxes)
-        else:
-            IMAGE_PATH = args['input']['image']
-            boxes = torch.tensor([args["input"]["box"]])
-            boxes[:,2] = boxes[:,2] + boxes[:,0]
-            boxes[:,3] = boxes[:,3] + boxes[:,1]
-
-        print(boxes)
-        if len(boxes) > 0:
-            from transformers import SamModel, SamProcessor
-            # model = SamModel.from_pretrained("sam-vit-huge", torch_dtype=torch.float16).to("cuda")
-            # processor = SamProcessor.from_pretrained("sam-vit-huge", torch_dtype=torch.float16)
-            model = SamModel.from_pretrained("sam-vit-base").to("cuda")
-            processor = SamProcessor.from_pretrained("sam-vit-base")
-            raw_image = Image.open(IMAGE_PATH)
-            input_boxes = [boxes.numpy().tolist()]
-            for i in range(len(input_boxes[0])):
-                bb = [k * 512 for k in input_boxes[0][i]]  ##############
-                input_boxes[0][i] = bb
-            inputs = processor([raw_image], input_boxes=input_boxes, return_tensors="pt").to("cuda")
-            outputs = model(**inputs)
-            # masks = processor.image_processor.post_process_masks(outputs.pred_masks.cpu(), inputs["original_sizes"].cpu(), inputs["reshaped_input_sizes"].cpu())
-            # print('aaaaaaaaaaaaaaaaa',args, args.get('mask_threshold', 0.0))
-            masks = processor.image_processor.post_process_masks(outputs.pred_masks.cpu(), inputs["original_sizes"].cpu(), inputs["reshaped_input_sizes"].cpu(), mask_threshold=args['input'].get('mask_threshold', 0.0))
-            print('aaaaaaaaaaa', len(masks))
-            masks = masks[0]
-            
-            masks = np.transpose(masks[0], (1,2,0))   ################### index 1
-            # masks = np.transpose((masks[0]+masks[1]) > 0.5, (1,2,0)) 
-            masks = masks[:,:,0]
-            _ = cv2.imwrite(args["output"], masks.numpy() * 255)
+        # One query ({"text", "box", "mask_threshold"} in "input"), or several
+        # on the same image in "input"["queries"], with one output path each
+        queries = args["input"].get("queries", [args["input"]])
+        outputs = args["output"] if isinstance(args["output"], list) else [args["output"]]
+        masks = segment_queries(args["input"]["image"], queries)
+        for path, mask in zip(outputs, masks):
+            if mask is not None:
+                store.save_mask(path, mask)
     
     # clear_globals()
     torch.cuda.empty_cache()
     gc.collect()
     torch.cuda.empty_cache()
-    return None
+    return result
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="for agent")
     parser.add_argument("--json_out", type=bool, default=False, help="Path to the json file")
+    parser.add_argument("--input_json", type=str, default="input.json", help="step arguments, e.g. jobs/<id>/input.json")
     args = parser.parse_args()
 
     if args.json_out:
-        args = json.load(open('input.json'))
+        args = json.load(open(args.input_json))
     else:
         args = {"tool": "detection", "input": {"image": "./inputs/0.png", "text": "car . person"} }
     main_aux(args)
+    store.flush()
     
@@ -10,6 +10,9 @@ import random
 import argparse
 import json
 import math
+from agent_models import registry
+from agent_artifacts import store
+from agent_trace import span
 
 def main_edit(args):
     default_seed = 42
@@ -21,7 +24,9 @@ def main_edit(args):
         os.sys.path.append('./AnyDoor')
         os.sys.path.append('./AnyDoor/dinov2')
         os.sys.path.append('./AnyDoor/dinov2/datasets')
-        from run_inference import inference_single_image
+        from run_inference import inference_single_image, load_anydoor_engine
+        # AnyDoorEngine: model, DDIM schedule and unconditional embedding stay loaded
+        model = registry.get("anydoor", load_anydoor_engine, dtype=torch.float)
         reference_image_path = args["input"]["object"] #
         reference_image_mask_path = args["input"]["object_mask"] 
         bg_image_path = args["input"]["image"]
@@ -31,15 +36,11 @@ def main_edit(args):
         # reference image + reference mask
         # You could use the demo of SAM to extract RGB-A image with masks
         # https://segment-anything.com/demo
-        image = cv2.imread( reference_image_path, cv2.IMREAD_UNCHANGED)
-        image = cv2.cvtColor(image.copy(), cv2.COLOR_BGR2RGB)
-        mask = cv2.imread(reference_image_mask_path)
-        ref_image = image
-        ref_mask = mask[:,:,0] / 255.
+        ref_image = store.load_rgb(reference_image_path)
+        ref_mask = store.load_mask(reference_image_mask_path) / 255.
 
         # background image
-        back_image = cv2.imread(bg_image_path).astype(np.uint8)
-        back_image = cv2.cvtColor(back_image, cv2.COLOR_BGR2RGB)
+        back_image = store.load_rgb(bg_image_path).astype(np.uint8)
 
         # background mask 
         tar_mask = np.zeros((512, 512)) #cv2.imread(bg_mask_path)[:,:,0]
@@ -49,12 +50,13 @@ def main_edit(args):
 
         # print(ref_image.shape, ref_mask.shape, back_image.shape, tar_mask.shape)
 
-        gen_image = inference_single_image(ref_image, ref_mask, back_image.copy(), tar_mask)
+        with span("generate"):
+            gen_image = inference_single_image(ref_image, ref_mask, back_image.copy(), tar_mask, model=model)
         h,w = back_image.shape[0], back_image.shape[0]
         ref_image = cv2.resize(ref_image, (w,h))
         vis_image = cv2.hconcat([ref_image, back_image, gen_image])
 
-        cv2.imwrite(args["output"], gen_image[:,:,::-1])
+        store.save_image(args["output"], gen_image)
     
     elif args["tool"] == 'attribute_diffedit':
         from diffusers import StableDiffusionDiffEditPipeline
@@ -65,29 +67,37 @@ def main_edit(args):
         mask_prompt = args["input"]["object"]
         prompt = args["input"]["attr"]
 
-        init_image = Image.open(img_url).resize((768, 768))
-
-        pipe = StableDiffusionDiffEditPipeline.from_pretrained(
-            "stable-diffusion-2", torch_dtype=torch.float16
-        )
-        pipe = pipe.to("cuda")
-        pipe.scheduler = DDIMScheduler.from_config(pipe.scheduler.config)
-        pipe.inverse_scheduler = DDIMInverseScheduler.from_config(pipe.scheduler.config)
-        pipe.enable_model_cpu_offload()
-
-        mask_image = np.array(Image.open(args["input"]["object_mask"]).resize((96,96))) / 255.
+        init_image = store.load_pil(img_url).resize((768, 768))
+
+        def load_diffedit():
+            pipe = StableDiffusionDiffEditPipeline.from_pretrained(
+                "stable-diffusion-2", torch_dtype=torch.float16
+            )
+            pipe = pipe.to("cuda")
+            pipe.scheduler = DDIMScheduler.from_config(pipe.scheduler.config)
+            pipe.inverse_scheduler = DDIMInverseScheduler.from_config(pipe.scheduler.config)
+            pipe.enable_model_cpu_offload()
+            return pipe
+        # cpu offloaded: the pipeline places its own modules
+        pipe = registry.get("stable-diffusion-2-diffedit", load_diffedit, dtype=torch.float16, device="cpu", movable=False)
+
+        mask_image = np.array(Image.fromarray(store.load_mask(args["input"]["object_mask"])).resize((96,96))) / 255.
         mask_image = mask_image[None,:,:]
-        image_latents = pipe.invert(image=init_image, prompt=mask_prompt, inpaint_strength=0.8).latents
-        image = pipe(prompt=prompt, mask_image=mask_image, image_latents=image_latents, 
-                    guidance_scale=10.5, inpaint_strength=0.8).images[0].resize((512, 512))
+        with span("preprocess", what="inversion"):
+            image_latents = pipe.invert(image=init_image, prompt=mask_prompt, inpaint_strength=0.8).latents
+        with span("generate"):
+            image = pipe(prompt=prompt, mask_image=mask_image, image_latents=image_latents, 
+                        guidance_scale=10.5, inpaint_strength=0.8).images[0].resize((512, 512))
 
-        image.save(args["output"])
+        store.save_image(args["output"], image)
     
     elif args["tool"] == "replace_anydoor":
         os.sys.path.append('./AnyDoor')
         os.sys.path.append('./AnyDoor/dinov2')
         os.sys.path.append('./AnyDoor/dinov2/datasets')
-        from run_inference import inference_single_image
+        from run_inference import inference_single_image, load_anydoor_engine
+        # AnyDoorEngine: model, DDIM schedule and unconditional embedding stay loaded
+        model = registry.get("anydoor", load_anydoor_engine, dtype=torch.float)
         reference_image_path = args["input"]["object"] #
         reference_image_mask_path = args["input"]["object_mask"] 
         bg_image_path = args["input"]["image"]
@@ -97,11 +107,8 @@ def main_edit(args):
         # reference image + reference mask
         # You could use the demo of SAM to extract RGB-A image with masks
         # https://segment-anything.com/demo
-        image = cv2.imread( reference_image_path, cv2.IMREAD_UNCHANGED)
-        image = cv2.cvtColor(image.copy(), cv2.COLOR_BGR2RGB)
-        mask = cv2.imread(reference_image_mask_path)
-        ref_image = image
-        ref_mask = mask[:,:,0] / 255.
+        ref_image = store.load_rgb(reference_image_path)
+        ref_mask = store.load_mask(reference_image_mask_path) / 255.
 
         # y, x = np.nonzero(ref_mask)
         # ref_bbox = [x.min(), y.min(), x.max()-x.min(), y.max()-y.min()]
@@ -112,14 +119,13 @@ def main_edit(args):
         # ref_mask = ref_mask.astype(np.uint8)
 
         if type(args["input"]["mask"]) is str:
-            mask_image = cv2.imread(args["input"]["mask"])[:,:,0]
+            mask_image = store.load_mask(args["input"]["mask"])
             y, x = np.nonzero(mask_image)
             args["input"]["mask"] = [x.min(), y.min(), x.max()-x.min(), y.max()-y.min()]
             args["input"]["mask"] = [k/512. for k in args["input"]["mask"]]
 
         # background image
-        back_image = cv2.imread(bg_image_path).astype(np.uint8)
-        back_image = cv2.cvtColor(back_image, cv2.COLOR_BGR2RGB)
+        back_image = store.load_rgb(bg_image_path).astype(np.uint8)
 
         # background mask 
         # tar_mask = cv2.imread(bg_mask_path)[:,:,0]
@@ -131,28 +137,36 @@ def main_edit(args):
 
         # print(ref_image.shape, ref_mask.shape, back_image.shape, tar_mask.shape)
 
-        gen_image = inference_single_image(ref_image, ref_mask, back_image.copy(), tar_mask)
+        with span("generate"):
+            gen_image = inference_single_image(ref_image, ref_mask, back_image.copy(), tar_mask, model=model)
         h,w = back_image.shape[0], back_image.shape[0]
         ref_image = cv2.resize(ref_image, (w,h))
         vis_image = cv2.hconcat([ref_image, back_image, gen_image])
 
-        cv2.imwrite(args["output"], gen_image[:,:,::-1])
+        store.save_image(args["output"], gen_image)
     
     elif args["tool"] == "remove":
         os.sys.path.append('./Inpaint-Anything')
-        from lama_inpaint import inpaint_img_with_lama
+        from lama_inpaint import build_lama_model, inpaint_img_with_builded_lama, inpaint_img_with_builded_lama_crop
         from utils import load_img_to_array, save_array_to_img, dilate_mask, show_mask, show_points, get_clicked_point
         from PIL import Image
-        img = load_img_to_array(args["input"]["image"])
-        masks = np.array(Image.open(args["input"]["mask"])) #[None,:,:]
+        img = store.load_rgb(args["input"]["image"])
+        masks = store.load_mask(args["input"]["mask"]) #[None,:,:]
         masks = masks.astype(np.uint8) #* 255
         # masks = dilate_mask(masks, 15)
         masks = dilate_mask(masks, 10)
         # print(img.shape, masks.shape)
-        img_inpainted = inpaint_img_with_lama(
-            img, masks, './Inpaint-Anything/lama/configs/prediction/default.yaml', './Inpaint-Anything/pretrained_models/big-lama', device='cuda')
+        model = registry.get("big-lama", lambda: build_lama_model(
+            './Inpaint-Anything/lama/configs/prediction/default.yaml', './Inpaint-Anything/pretrained_models/big-lama', device='cuda'), dtype=torch.float)
+        # LaMa on a window around the mask only, blended back into the image (full image if the window
+        # covers more than half of it); GENARTIST_LAMA_CROP=0 always inpaints the full image
+        with span("generate"):
+            if os.getenv("GENARTIST_LAMA_CROP", "1") == "1":
+                img_inpainted = inpaint_img_with_builded_lama_crop(model, img, masks, work_size=512, device='cuda')
+            else:
+                img_inpainted = inpaint_img_with_builded_lama(model, img, masks, device='cuda')
         # Image.fromarray(img_inpainted).save(args["output"])
-        save_array_to_img(img_inpainted, args["output"])
+        store.save_image(args["output"], img_inpainted)
     
     elif args["tool"] == "instruction":
         from omegaconf import OmegaConf
@@ -167,16 +181,16 @@ def main_edit(args):
         sys.path.append("./instruct-pix2pix/stable_diffusion")
         step = 50
         config = OmegaConf.load("./instruct-pix2pix/configs/generate.yaml")
-        # model = load_model_from_config(config, "./instruct-pix2pix/checkpoints/MagicBrush-epoch-52-step-4999.ckpt", None)
-        # model = load_model_from_config(config, "./instruct-pix2pix/checkpoints/instruct-pix2pix-00-22000.ckpt", None)
-        model = load_model_from_config(config, "./instruct-pix2pix/checkpoints/MagicBrush-epoch-000168.ckpt", None)
-        model.eval().cuda()
+        # ckpt = "./instruct-pix2pix/checkpoints/MagicBrush-epoch-52-step-4999.ckpt"
+        # ckpt = "./instruct-pix2pix/checkpoints/instruct-pix2pix-00-22000.ckpt"
+        ckpt = "./instruct-pix2pix/checkpoints/MagicBrush-epoch-000168.ckpt"
+        model = registry.get(ckpt, lambda: load_model_from_config(config, ckpt, None).eval().cuda(), dtype=torch.float)
         model_wrap = K.external.CompVisDenoiser(model)
         model_wrap_cfg = CFGDenoiser(model_wrap)
         null_token = model.get_learned_conditioning([""])
 
         seed = 666 #42 #random.randint(0, 100000) if args.seed is None else args.seed
-        input_image = Image.open(args["input"]["image"]).convert("RGB")
+        input_image = store.load_pil(args["input"]["image"])
         width, height = input_image.size
         factor = 512 / max(width, height)
         factor = math.ceil(min(width, height) * factor / 64) * 64 / min(width, height)
@@ -189,7 +203,8 @@ def main_edit(args):
             cond["c_crossattn"] = [model.get_learned_conditioning([args["input"]["text"]])]
             input_image = 2 * torch.tensor(np.array(input_image)).float() / 255 - 1
             input_image = rearrange(input_image, "h w c -> 1 c h w").to(model.device)
-            cond["c_concat"] = [model.encode_first_stage(input_image).mode()]
+            with span("preprocess", what="encode"):
+                cond["c_concat"] = [model.encode_first_stage(input_image).mode()]
 
             uncond = {}
             uncond["c_crossattn"] = [null_token]
@@ -205,12 +220,14 @@ def main_edit(args):
             }
             torch.manual_seed(seed)
             z = torch.randn_like(cond["c_concat"][0]) * sigmas[0]
-            z = K.sampling.sample_euler_ancestral(model_wrap_cfg, z, sigmas, extra_args=extra_args)
-            x = model.decode_first_stage(z)
+            with span("denoise", steps=step):
+                z = K.sampling.sample_euler_ancestral(model_wrap_cfg, z, sigmas, extra_args=extra_args)
+            with span("decode"):
+                x = model.decode_first_stage(z)
             x = torch.clamp((x + 1.0) / 2.0, min=0.0, max=1.0)
             x = 255.0 * rearrange(x, "1 c h w -> h w c")
             edited_image = Image.fromarray(x.type(torch.uint8).cpu().numpy())
-        edited_image.save(args["output"])
+        store.save_image(args["output"], edited_image)
 
 
 
@@ -222,13 +239,15 @@ def main_edit(args):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="for agent")
     parser.add_argument("--json_out", type=bool, default=False, help="Path to the json file")
+    parser.add_argument("--input_json", type=str, default="input.json", help="step arguments, e.g. jobs/<id>/input.json")
     args = parser.parse_args()
 
     if args.json_out:
-        args = json.load(open('input.json'))
+        args = json.load(open(args.input_json))
     else:
         args = {'tool': 'instruction', 'output': 'inputs/368667-input-output.png', 'input': {'image': 'inputs/368667-input.png', 'text': 'The farm should have a stream, and a giraffe should be on the left of the stream under a supernova explosion sky.'}}
     main_edit(args)
+    store.flush()
 
 
     
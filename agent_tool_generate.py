@@ -10,6 +10,9 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.patches import Polygon
 from matplotlib.collections import PatchCollection
+from agent_models import registry, get_lmd_models
+from agent_artifacts import store
+from agent_trace import span
 
 
 def draw_boxes(anns):
@@ -39,7 +42,7 @@ def draw_boxes(anns):
     ax.add_collection(p)
 
 
-def show_boxes(gen_boxes, ind=None, show=False, save=False):
+def show_boxes(gen_boxes, ind=None, show=False, save=False, img_dir='./inputs'):
     if len(gen_boxes) == 0:
         return
     
@@ -62,36 +65,43 @@ def show_boxes(gen_boxes, ind=None, show=False, save=False):
         plt.show()
     else:
         # print("Saved boxes visualizations to", f"{img_dir}/boxes.png", f"ind: {ind}")
-        plt.savefig(f"./inputs/boxes.png", bbox_inches='tight', pad_inches=0)
+        plt.savefig(f"{img_dir}/boxes.png", bbox_inches='tight', pad_inches=0)
 
 
 def main_generate(args):
     if args["tool"] == "text_to_image_SDXL":
         import torch
         from diffusers import StableDiffusionXLPipeline, StableDiffusionXLImg2ImgPipeline
-        pipe = StableDiffusionXLPipeline.from_pretrained("stable-diffusion-xl-base-1.0", torch_dtype=torch.float16, variant="fp16", use_safetensors=True).to("cuda")
+        pipe = registry.get("stable-diffusion-xl-base-1.0", lambda: StableDiffusionXLPipeline.from_pretrained(
+            "stable-diffusion-xl-base-1.0", torch_dtype=torch.float16, variant="fp16", use_safetensors=True).to("cuda"), dtype=torch.float16)
         # for i in range(10):
         g = torch.Generator('cuda').manual_seed(17)
-        image = pipe(args["input"]["text"], height=1024, width=1024, generator=g).images[0]
-        image.save(args["output"])
+        with span("generate"):
+            image = pipe(args["input"]["text"], height=1024, width=1024, generator=g).images[0]
+        store.save_image(args["output"], image)
         # image.save('inputs/' + str(i) + '.png')
     elif args["tool"] == 'image_to_image_SD2':
         import torch
         from diffusers import AutoPipelineForImage2Image
         from diffusers.utils import make_image_grid, load_image
 
-        pipeline = AutoPipelineForImage2Image.from_pretrained("stable-diffusion-2-1-base", torch_dtype=torch.float16, variant="fp16", use_safetensors=True)
-        pipeline.enable_model_cpu_offload()
-        # remove following line if xFormers is not installed or you have PyTorch 2.0 or higher installed
-        pipeline.enable_xformers_memory_efficient_attention()
+        def load_img2img():
+            pipeline = AutoPipelineForImage2Image.from_pretrained("stable-diffusion-2-1-base", torch_dtype=torch.float16, variant="fp16", use_safetensors=True)
+            pipeline.enable_model_cpu_offload()
+            # remove following line if xFormers is not installed or you have PyTorch 2.0 or higher installed
+            pipeline.enable_xformers_memory_efficient_attention()
+            return pipeline
+        # cpu offloaded: the pipeline places its own modules
+        pipeline = registry.get("stable-diffusion-2-1-base-img2img", load_img2img, dtype=torch.float16, device="cpu", movable=False)
 
         # prepare image
         url = args["input"]['image']
-        init_image = load_image(url)
+        init_image = store.load_pil(url)
 
         prompt = args["input"]['text']
-        image = pipeline(prompt, image=init_image).images[0]
-        image.save(args["output"])
+        with span("generate"):
+            image = pipeline(prompt, image=init_image).images[0]
+        store.save_image(args["output"], image)
     
     elif args["tool"] == "layout_to_image_LMD":
         # if args["input"]["layout"] == "TBG":
@@ -127,27 +137,22 @@ def main_generate(args):
         # show_boxes(bb_draw)
         os.sys.path.append('./LLM-groundedDiffusion')
         import models
-        from models import sam
         models.sd_key = "./diffusers-generation-text-box"
         models.sd_version = "sdv1.4"
-        models.model_dict = models.load_sd(
-            key=models.sd_key,
-            use_fp16=False,
-            scheduler_cls=None
-        )
-        sam_model_dict = sam.load_sam()
-        models.model_dict.update(sam_model_dict)
+        models.model_dict = get_lmd_models(models, models.sd_key)
         import generation.lmd_plus as generation
         bg_prompt = args["input"].get('bg_prompt', 'A realistic scene')
         spec = {'prompt': args["input"]["text"], 'gen_boxes': args["input"]["layout"], 'bg_prompt': bg_prompt, 'extra_neg_prompt': ''}
-        output = generation.run(
-                spec=spec,
-                bg_seed=27159,
-                fg_seed_start=123483948,
-                frozen_step_ratio=0.5
-            )
-        output = Image.fromarray(output.image)
-        output.save(args["output"])
+        with span("generate"):
+            output = generation.run(
+                    spec=spec,
+                    bg_seed=27159,
+                    fg_seed_start=123483948,
+                    frozen_step_ratio=0.5,
+                    # per-box generations denoised together (memory grows with it)
+                    so_batch_size=int(os.getenv("GENARTIST_LMD_SO_BATCH", 4)),
+                )
+        store.save_image(args["output"], output.image)
     elif args["tool"] == "layout_to_image_BoxDiff":
         if args["input"]["layout"] == "TBG":
             args["input"]["layout"] = args_layout
@@ -160,7 +165,7 @@ def main_generate(args):
         from utils.ptp_utils import AttentionStore
         from run_sd_boxdiff import run_on_prompt
 
-        stable = BoxDiffPipeline.from_pretrained('stable-diffusion-2-1-base').to('cuda')
+        stable = registry.get('stable-diffusion-2-1-base-boxdiff', lambda: BoxDiffPipeline.from_pretrained('stable-diffusion-2-1-base').to('cuda'), dtype=torch.float)
 
         objs = [i[0] for i in args["input"]["layout"]]
         prompt = args["input"]["text"]
@@ -181,36 +186,36 @@ def main_generate(args):
 
         g = torch.Generator('cuda').manual_seed(1)
         controller = AttentionStore()
-        image = run_on_prompt(prompt=prompt,
-                                model=stable,
-                                controller=controller,
-                                token_indices=token_indices,
-                                seed=g,
-                                config=config_run)
-        image.save(args["output"])
+        with span("generate"):
+            image = run_on_prompt(prompt=prompt,
+                                    model=stable,
+                                    controller=controller,
+                                    token_indices=token_indices,
+                                    seed=g,
+                                    config=config_run)
+        store.save_image(args["output"], image)
 
     elif args["tool"] == "superresolution_SDXL":
         from diffusers import StableDiffusionXLImg2ImgPipeline
         import torch
         torch.set_float32_matmul_precision("high")
-        pipe = StableDiffusionXLImg2ImgPipeline.from_pretrained(
+        pipe = registry.get("stable-diffusion-xl-refiner-1.0", lambda: StableDiffusionXLImg2ImgPipeline.from_pretrained(
             "stable-diffusion-xl-refiner-1.0", #height=1024, width=2048,
             torch_dtype=torch.float16,
-        )
-
-        pipe = pipe.to("cuda")
+        ).to("cuda"), dtype=torch.float16)
         prompt = ''
-        init_image = Image.open(args["input"]["image"])
+        init_image = store.load_pil(args["input"]["image"])
         init_image = init_image.resize((1024, 1024), Image.LANCZOS)
         # for i in range(10):
-        image = pipe(
-            prompt,
-            image=init_image,
-            strength=0.3, #0.3,
-            aesthetic_score=7., #7., #7.0,
-            num_inference_steps=50,
-        ).images
-        image[0].save(args["output"])
+        with span("generate"):
+            image = pipe(
+                prompt,
+                image=init_image,
+                strength=0.3, #0.3,
+                aesthetic_score=7., #7., #7.0,
+                num_inference_steps=50,
+            ).images
+        store.save_image(args["output"], image[0])
             # image[0].save('inputs/' + str(i+1) + '.png')
     
     import torch
@@ -222,13 +227,15 @@ def main_generate(args):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="for agent")
     parser.add_argument("--json_out", type=bool, default=False, help="Path to the json file")
+    parser.add_argument("--input_json", type=str, default="input.json", help="step arguments, e.g. jobs/<id>/input.json")
     args = parser.parse_args()
 
     if args.json_out:
-        args = json.load(open('input.json'))
+        args = json.load(open(args.input_json))
     else:
         args =  {"tool": "text_to_image_SDXL", "input": {"text": "The glass picture frame and metallic stand display the wooden photo on the nightstand."}, "output": "inputs/0.png" }
         
     main_generate(args)
+    store.flush()
 
     
\ No newline at end of file
@@ -0,0 +1,168 @@
+import os
+import os.path as osp
+import sys
+import json
+import time
+import threading
+from collections import deque, defaultdict
+from contextlib import contextmanager
+
+
+MB = 1024 ** 2
+
+
+def _cuda():
+    """torch.cuda if this process already uses the GPU; never initializes CUDA itself."""
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_initialized():
+        return None
+    return torch.cuda
+
+
+class Tracer:
+    """Nested timing spans around tool steps and their phases.
+
+    A span records its wall time and, in a process that uses the GPU, the
+    CUDA time between its start and end (CUDA events on the current stream)
+    and the peak memory allocated while it was open. Spans nest per thread.
+    `export` writes them to a job directory as trace.json (events plus a
+    per-name summary) and trace.chrome.json (chrome://tracing, Perfetto).
+    `tag` adds attributes (e.g. job=...) to every span opened in its block
+    on the current thread, so that `events` and `export` can select the
+    spans of one job while other jobs are in flight on other threads.
+
+    Set GENARTIST_TRACE=0 to disable.
+    """
+
+    def __init__(self, enabled=None, max_events=100000):
+        if enabled is None:
+            enabled = os.getenv("GENARTIST_TRACE", "1") == "1"
+        self.enabled = enabled
+        self.records = deque(maxlen=max_events)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    @contextmanager
+    def tag(self, **attrs):
+        """Add `attrs` to the spans opened in this block on the current thread."""
+        tags = getattr(self.local, "tags", {})
+        self.local.tags = dict(tags, **attrs)
+        try:
+            yield
+        finally:
+            self.local.tags = tags
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """Time the block; the yielded dict can be used to add attributes."""
+        if not self.enabled:
+            yield attrs
+            return
+        cuda = _cuda()
+        stack = self._stack()
+        frame = {"peak": 0}
+        start = None
+        if cuda is not None:
+            # The peak counter is global: fold the parent's peak so far into
+            # the parent before restarting it for this span.
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], cuda.max_memory_allocated())
+            cuda.reset_peak_memory_stats()
+            start = cuda.Event(enable_timing=True)
+            start.record()
+        stack.append(frame)
+        tags = getattr(self.local, "tags", {})
+        ts = time.time()
+        t0 = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            record = {"name": name, "ts": ts, "dur": time.perf_counter() - t0,
+                      "pid": os.getpid(), "tid": threading.get_ident(), "args": dict(tags, **attrs)}
+            stack.pop()
+            if start is not None:
+                end = cuda.Event(enable_timing=True)
+                end.record()
+                record["cuda"] = (start, end)
+                record["peak_mb"] = max(frame["peak"], cuda.max_memory_allocated()) / MB
+                if stack:
+                    stack[-1]["peak"] = max(stack[-1]["peak"], record["peak_mb"] * MB)
+            with self.lock:
+                self.records.append(record)
+
+    def span_iter(self, name, iterable, **attrs):
+        """Iterate over `iterable` inside one span, e.g. a denoising loop."""
+        with self.span(name, **attrs):
+            yield from iterable
+
+    def events(self, clear=False, job=None):
+        """Finished spans as plain dicts (picklable, JSON-serializable); only those tagged `job` if given."""
+        with self.lock:
+            if job is None:
+                records = list(self.records)
+                if clear:
+                    self.records.clear()
+            else:
+                records = [r for r in self.records if r["args"].get("job") == job]
+                if clear:
+                    others = [r for r in self.records if r["args"].get("job") != job]
+                    self.records.clear()
+                    self.records.extend(others)
+        events = []
+        for record in records:
+            event = {k: v for k, v in record.items() if k != "cuda"}
+            if "cuda" in record:
+                start, end = record["cuda"]
+                end.synchronize()
+                event["cuda_ms"] = start.elapsed_time(end)
+            events.append(event)
+        return events
+
+    def export(self, directory, extra=(), clear=True, job=None):
+        """Write this process's spans (those tagged `job` if given), plus `extra` events (e.g. a worker's), to `directory`."""
+        events = sorted(self.events(clear=clear, job=job) + list(extra), key=lambda e: e["ts"])
+        os.makedirs(directory, exist_ok=True)
+        path = osp.join(directory, "trace.json")
+        with open(path, "w") as f:
+            json.dump({"events": events, "summary": summarize(events)}, f, indent=1, default=str)
+        with open(osp.join(directory, "trace.chrome.json"), "w") as f:
+            json.dump({"traceEvents": chrome_events(events), "displayTimeUnit": "ms"}, f, default=str)
+        return path
+
+
+def summarize(events):
+    """Count, total/max wall seconds, total CUDA ms and max peak MB per span name."""
+    summary = defaultdict(lambda: {"count": 0, "wall_s": 0.0, "max_wall_s": 0.0, "cuda_ms": 0.0, "peak_mb": 0.0})
+    for e in events:
+        s = summary[e["name"]]
+        s["count"] += 1
+        s["wall_s"] += e["dur"]
+        s["max_wall_s"] = max(s["max_wall_s"], e["dur"])
+        s["cuda_ms"] += e.get("cuda_ms", 0.0)
+        s["peak_mb"] = max(s["peak_mb"], e.get("peak_mb", 0.0))
+    return dict(sorted(summary.items(), key=lambda kv: -kv[1]["wall_s"]))
+
+
+def chrome_events(events):
+    """Events in the Chrome trace-event format (complete "X" events, microseconds)."""
+    out = []
+    for e in events:
+        args = dict(e["args"])
+        for key in ("cuda_ms", "peak_mb"):
+            if key in e:
+                args[key] = round(e[key], 3)
+        out.append({"name": e["name"], "cat": e["name"].split(":")[0], "ph": "X",
+                    "ts": e["ts"] * 1e6, "dur": e["dur"] * 1e6,
+                    "pid": e["pid"], "tid": e["tid"], "args": args})
+    return out
+
+
+tracer = Tracer()
+span = tracer.span
+span_iter = tracer.span_iter
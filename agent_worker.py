@@ -0,0 +1,320 @@
+import os
+import os.path as osp
+import sys
+import argparse
+import queue
+import importlib
+import traceback
+import multiprocessing as mp
+from multiprocessing.connection import Listener, Client
+from contextlib import contextmanager
+
+from agent_trace import tracer
+
+
+AUX_TOOLS = ["object_addition_anydoor", "segmentation", "detection"]
+EDIT_TOOLS = ["addition_anydoor", "replace_anydoor", "remove", "instruction", "attribute_diffedit"]
+GENERATE_TOOLS = ["text_to_image_SDXL", "image_to_image_SD2", "layout_to_image_LMD",
+                  "layout_to_image_BoxDiff", "superresolution_SDXL"]
+
+# Sub-projects that are put on sys.path by the tools. Several of them ship
+# top-level packages with the same name (utils, models, ldm, config, ...), so
+# a long-lived worker has to keep their modules apart.
+PROJECT_DIRS = ["AnyDoor", "BoxDiff", "Inpaint-Anything", "LLM-groundedDiffusion", "instruct-pix2pix"]
+TOOL_PROJECTS = {
+    "object_addition_anydoor": "LLM-groundedDiffusion",
+    "layout_to_image_LMD": "LLM-groundedDiffusion",
+    "layout_to_image_BoxDiff": "BoxDiff",
+    "addition_anydoor": "AnyDoor",
+    "replace_anydoor": "AnyDoor",
+    "remove": "Inpaint-Anything",
+    "instruction": "instruct-pix2pix",
+}
+
+DEFAULT_ADDRESS = ("127.0.0.1", 6010)
+DEFAULT_AUTHKEY = b"genartist"
+
+
+class ToolError(RuntimeError):
+    pass
+
+
+class ProjectImports:
+    """Keeps the modules imported from each sub-project in a separate stash.
+
+    Before a step runs, sys.path is reset and the modules of the step's
+    project are put back into sys.modules; afterwards they are taken out
+    again, so e.g. `utils` of Inpaint-Anything never shadows `utils` of
+    LLM-groundedDiffusion while both stay imported (and their models warm).
+    """
+
+    def __init__(self, root="."):
+        self.roots = tuple(osp.join(osp.abspath(osp.join(root, p)), "") for p in PROJECT_DIRS)
+        self.base_path = list(sys.path)
+        self.paths = {}
+        self.stash = {}
+
+    def _detach(self):
+        modules = {}
+        for name, module in list(sys.modules.items()):
+            path = getattr(module, "__file__", None)
+            if path and osp.abspath(path).startswith(self.roots):
+                modules[name] = sys.modules.pop(name)
+        return modules
+
+    @contextmanager
+    def scope(self, project):
+        # Modules such as lama_inpaint extend sys.path at import time only,
+        # so each project gets back the path it ended its last step with.
+        sys.path[:] = self.paths.get(project, self.base_path)
+        sys.modules.update(self.stash.pop(project, {}))
+        try:
+            yield
+        finally:
+            self.paths[project] = list(dict.fromkeys(sys.path))
+            self.stash[project] = self._detach()
+            sys.path[:] = self.base_path
+
+
+_imports = None
+_cache = None
+_impl = None
+
+
+def run_tool(step):
+    """Run a single agent step in the current process.
+
+    Results are served from the step cache (agent_cache.py) when the same
+    tool already ran on the same inputs; set GENARTIST_CACHE=0 to disable.
+    """
+    global _cache
+    impl = _tool_impl()
+    with tracer.span("tool:" + step["tool"], output=step.get("output")):
+        if os.getenv("GENARTIST_CACHE", "1") != "1":
+            return impl(step)
+        if _cache is None:
+            from agent_cache import StepCache
+            _cache = StepCache()
+        return _cache.run(step, impl)
+
+
+def _tool_impl():
+    """`_dispatch`, or the function named by GENARTIST_TOOL_IMPL="module:function",
+    e.g. the CPU stubs of agent_bench.py."""
+    global _impl
+    if _impl is None:
+        spec = os.getenv("GENARTIST_TOOL_IMPL")
+        if spec:
+            module, name = spec.split(":")
+            _impl = getattr(importlib.import_module(module), name)
+        else:
+            _impl = _dispatch
+    return _impl
+
+
+def _dispatch(step):
+    global _imports
+    if _imports is None:
+        _imports = ProjectImports()
+
+    tool = step["tool"]
+    with _imports.scope(TOOL_PROJECTS.get(tool)):
+        if tool in AUX_TOOLS:
+            from agent_tool_aux import main_aux
+            return main_aux(step)
+        elif tool in EDIT_TOOLS:
+            from agent_tool_edit import main_edit
+            return main_edit(step)
+        elif tool in GENERATE_TOOLS:
+            from agent_tool_generate import main_generate
+            return main_generate(step)
+    raise ToolError("unknown tool: %s" % tool)
+
+
+def _handle(conn):
+    """Serve requests on `conn` until it is closed or asked to shut down."""
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            return False
+        command = request[0]
+        if command == "shutdown":
+            conn.send(("ok", None))
+            return True
+        try:
+            if command == "run":
+                result = run_tool(request[1])
+            elif command == "ping":
+                result = os.getpid()
+            elif command == "flush":
+                from agent_artifacts import store
+                result = store.flush(request[1])
+            elif command == "reset":
+                from agent_artifacts import store
+                result = store.clear(request[1])
+            elif command == "stats":
+                from agent_models import registry
+                result = {"models": registry.stats(), "cache": _cache.stats() if _cache else None}
+            elif command == "trace":
+                result = tracer.events(clear=request[1])
+            else:
+                raise ToolError("unknown command: %s" % command)
+            conn.send(("ok", result))
+        except Exception:
+            conn.send(("error", traceback.format_exc()))
+
+
+def _worker_main(conn, device, cwd):
+    if device is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(device)
+    os.chdir(cwd)
+    if cwd not in sys.path:
+        sys.path.insert(0, cwd)
+    _handle(conn)
+    conn.close()
+
+
+def _call(conn, request):
+    conn.send(request)
+    status, result = conn.recv()
+    if status == "error":
+        raise ToolError(result)
+    return result
+
+
+class _Connection:
+    """Requests to a worker over `self.conn`, shared by ToolWorker and WorkerClient."""
+
+    def run(self, step):
+        return _call(self.conn, ("run", step))
+
+    def ping(self):
+        return _call(self.conn, ("ping",))
+
+    def flush(self, paths=None):
+        """Write in-memory step outputs (default: all of them) to disk."""
+        return _call(self.conn, ("flush", paths))
+
+    def reset(self, prefix=None):
+        """Drop the in-memory step outputs under `prefix` (a job directory), or all of them."""
+        return _call(self.conn, ("reset", prefix))
+
+    def stats(self):
+        return _call(self.conn, ("stats",))
+
+    def trace(self, clear=True):
+        """Spans recorded in the worker (see agent_trace.py), by default emptying its buffer."""
+        return _call(self.conn, ("trace", clear))
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ToolWorker(_Connection):
+    """A long-lived child process that runs main_aux/main_edit/main_generate.
+
+    Imports and anything the tools keep alive between calls survive across
+    steps, so a chain of steps pays the interpreter and import cost once.
+    """
+
+    def __init__(self, device=None, cwd=None):
+        self.device = device
+        ctx = mp.get_context("spawn")
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, daemon=True,
+                                   args=(child_conn, device, osp.abspath(cwd or os.getcwd())))
+        self.process.start()
+        child_conn.close()
+
+    def close(self):
+        if self.process.is_alive():
+            try:
+                _call(self.conn, ("shutdown",))
+            except (EOFError, OSError):
+                pass
+            self.process.join(timeout=30)
+        self.conn.close()
+
+
+class WorkerClient(_Connection):
+    """Connects to a worker started with `python agent_worker.py`."""
+
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=DEFAULT_AUTHKEY):
+        self.conn = Client(address, authkey=authkey)
+
+
+class WorkerPool:
+    """A fixed set of ToolWorkers, one per device; `run` blocks until a worker is free."""
+
+    def __init__(self, devices=(None,), cwd=None):
+        self.workers = [ToolWorker(device, cwd=cwd) for device in devices]
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+
+    def __len__(self):
+        return len(self.workers)
+
+    @contextmanager
+    def acquire(self):
+        worker = self.idle.get()
+        try:
+            yield worker
+        finally:
+            self.idle.put(worker)
+
+    def run(self, step):
+        with self.acquire() as worker:
+            return worker.run(step)
+
+    def flush(self, paths=None):
+        for worker in self.workers:
+            worker.flush(paths)
+
+    def reset(self, prefix=None):
+        for worker in self.workers:
+            worker.reset(prefix)
+
+    def trace(self, clear=True):
+        return [e for worker in self.workers for e in worker.trace(clear)]
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def devices_from_env():
+    """Worker devices from GENARTIST_DEVICES, e.g. "0,1" or "0,0,1" (two workers on GPU 0)."""
+    devices = os.getenv("GENARTIST_DEVICES", "")
+    return [d.strip() for d in devices.split(",") if d.strip()] or [None]
+
+
+def serve(address=DEFAULT_ADDRESS, authkey=DEFAULT_AUTHKEY):
+    """Serve clients one after another on a local socket, in this process."""
+    with Listener(address, authkey=authkey) as listener:
+        print("agent worker listening on %s:%d" % address)
+        while True:
+            with listener.accept() as conn:
+                if _handle(conn):
+                    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="persistent worker for agent tools")
+    parser.add_argument("--host", type=str, default=DEFAULT_ADDRESS[0])
+    parser.add_argument("--port", type=int, default=DEFAULT_ADDRESS[1])
+    args = parser.parse_args()
+    serve((args.host, args.port))
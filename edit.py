@@ -3,12 +3,15 @@ import json
 import base64
 import requests
 import cv2
-from agent_tool_aux import main_aux
-from agent_tool_edit import main_edit
-from agent_tool_generate import main_generate
-from agent_tool import command_parse
+from agent_job import Job
+from agent_worker import ToolWorker, ToolError
+from agent_trace import span, tracer
 import time
 import re
+import threading
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from PIL import Image
 import io 
@@ -41,10 +44,12 @@ os.environ["DIFFUSERS_OFFLINE"] = "0"
 print("Using HF_CACHE:", HF_CACHE)
 print("HF_TOKEN is set:", HF_TOKEN is not None)
 
-INPUT_FOLDER  = "inputs"
 OUTPUT_FOLDER = "tung_ga"
+# Các entry kế tiếp được tải ảnh + gọi GPT trước trong lúc GPU chạy entry hiện tại
+PREFETCH_WINDOW = int(os.getenv("GENARTIST_PREFETCH", 4))
+# Một dòng JSON cho mỗi entry đã xử lý, để chạy lại thì tiếp tục từ chỗ dừng
+PROGRESS_FILE = os.path.join(OUTPUT_FOLDER, "progress.jsonl")
 
-os.makedirs(INPUT_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 os.makedirs(HF_CACHE, exist_ok=True)
 
@@ -73,14 +78,17 @@ def encode_image(image_path):
 # ===========================================================
 
 def download_and_save_image(url, save_path):
+    # save_path only appears once the image is complete, so a resumed run can trust it
+    part_path = save_path + ".part"
     try:
-        r = requests.get(url, stream=True, timeout=30)
-        r.raise_for_status()
-        with open(save_path, "wb") as f:
-            for chunk in r.iter_content(8192):
-                f.write(chunk)
-
-        img = cv2.imread(save_path)
+        with span("download"):
+            r = requests.get(url, stream=True, timeout=30)
+            r.raise_for_status()
+            with open(part_path, "wb") as f:
+                for chunk in r.iter_content(8192):
+                    f.write(chunk)
+
+        img = cv2.imread(part_path)
         if img is None:
             print("Error: cv2 cannot read image.")
             return False
@@ -92,6 +100,36 @@ def download_and_save_image(url, save_path):
     except Exception as e:
         print(f"Download image error: {e}")
         return False
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+
+# ===========================================================
+# RATE LIMIT
+# ===========================================================
+
+class RateLimiter:
+    """Pause shared by every thread calling an endpoint once it answered 429."""
+
+    def __init__(self):
+        self.resume_at = 0.
+        self.lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self.lock:
+                delay = self.resume_at - time.time()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def defer(self, seconds):
+        with self.lock:
+            self.resume_at = max(self.resume_at, time.time() + seconds)
+
+
+azure_limiter = RateLimiter()
 
 
 # ===========================================================
@@ -161,7 +199,10 @@ def get_edit_commands(critique, base64_img):
         r = None
         for attempt in range(1, max_retries + 1):
             try:
-                r = requests.post(url, headers=headers, json=payload, timeout=60)
+                azure_limiter.wait()
+                with span("llm:azure", attempt=attempt) as attrs:
+                    r = requests.post(url, headers=headers, json=payload, timeout=60)
+                    attrs["status"] = r.status_code
             except Exception as e:
                 print(f"Request exception (attempt {attempt}): {e}")
                 if attempt == max_retries:
@@ -181,7 +222,8 @@ def get_edit_commands(critique, base64_img):
                 except Exception:
                     wait = backoff
                 print(f"Azure returned 429 (attempt {attempt}/{max_retries}), retrying after {wait}s")
-                time.sleep(wait)
+                # các thread prefetch khác cũng chờ, không dồn thêm request
+                azure_limiter.defer(wait)
                 backoff = min(backoff * 2, 60)
                 continue
 
@@ -234,14 +276,71 @@ def get_edit_commands(critique, base64_img):
 
 
 # ===========================================================
-# PROCESS REVIEWER
+# PROGRESS CHECKPOINT
 # ===========================================================
 
+def load_progress(path=PROGRESS_FILE):
+    """Post_IDs already finished by an earlier (possibly crashed) run."""
+    done = set()
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # last line cut by a crash
+                    continue
+                if record.get("status") == "done":
+                    done.add(record["Post_ID"])
+    return done
+
+
+def record_progress(post_id, status, elapsed=None, path=PROGRESS_FILE):
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"Post_ID": post_id, "status": status, "elapsed": elapsed}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
 # ===========================================================
-# PROCESS REVIEWER (ĐÃ SỬA)
+# PREFETCH (NETWORK STAGE)
 # ===========================================================
 
-def process_reviewer():
+def prepare_entry(entry):
+    """Download the image of an entry and ask GPT-4o for its edit commands.
+
+    Returns (job, commands, error). The image and the commands are kept in
+    the job directory, so a resumed run does not fetch them again.
+    """
+    post_id = entry.get("Post_ID")
+    job = Job(post_id)
+    commands_path = os.path.join(job.dir, "commands.json")
+    # download / llm spans of this thread belong to this entry, not to the job running on the GPU
+    with tracer.tag(job=post_id), span("prepare"):
+        if os.path.exists(commands_path) and os.path.exists(job.source):
+            with open(commands_path, "r", encoding="utf-8") as f:
+                return job, json.load(f), None
+
+        if not os.path.exists(job.source) and not download_and_save_image(entry.get("Image_URL"), job.source):
+            return job, None, "image download failed"
+
+        b64_img = encode_image(job.source)
+        if not b64_img:
+            return job, None, "encode failed"
+
+        commands = get_edit_commands(entry.get("Critique"), b64_img)
+        if commands is None:
+            return job, None, "GPT returned invalid commands"
+        with open(commands_path, "w", encoding="utf-8") as f:
+            json.dump(commands, f)
+        return job, commands, None
+
+
+# ===========================================================
+# PROCESS REVIEWER
+# ===========================================================
+
+def process_reviewer(worker=None, window=PREFETCH_WINDOW):
 
     file_path = f"dataset.json"
     if not os.path.exists(file_path):
@@ -251,71 +350,89 @@ def process_reviewer():
     with open(file_path, "r", encoding="utf-8") as f:
         data_list = json.load(f)
 
+    # Một worker duy nhất cho cả dataset: import và model được giữ lại giữa các bước
+    if worker is None:
+        with ToolWorker() as worker:
+            return process_reviewer(worker, window)
+
     # Tất cả ảnh sẽ lưu vào 1 folder duy nhất
     output_dir = OUTPUT_FOLDER
 
-    for entry in data_list:
+    done = load_progress()
+    todo = [entry for entry in data_list if entry.get("Post_ID") not in done]
+    print(f"{len(data_list) - len(todo)} entries already done, {len(todo)} to go")
 
-        post_id = entry.get("Post_ID")
-        critique = entry.get("Critique")
-        image_url = entry.get("Image_URL")
-        print(f"\nProcessing {post_id} ...")
-        start_time = time.time()
+    # Tải ảnh + GPT cho tối đa `window` entry phía trước chạy song song,
+    # trong khi GPU xử lý lần lượt từng entry theo thứ tự
+    with ThreadPoolExecutor(max_workers=window) as prefetch:
+        entries = iter(todo)
+        pending = deque((entry, prefetch.submit(prepare_entry, entry)) for entry in itertools.islice(entries, window))
 
-        # ==== tải ảnh
-        input_path = f"{INPUT_FOLDER}/0.png"
-        if not download_and_save_image(image_url, input_path):
-            print(f"Skipping {post_id}: image download failed")
-            continue
+        while pending:
+            entry, future = pending.popleft()
+            upcoming = next(entries, None)
+            if upcoming is not None:
+                pending.append((upcoming, prefetch.submit(prepare_entry, upcoming)))
 
-        b64_img = encode_image(input_path)
-        if not b64_img:
-            print(f"Skipping {post_id}: encode failed")
-            continue
-
-        # ==== GPT tạo command
-        commands = get_edit_commands(critique, b64_img)
-        if commands is None:
-            print(f"Skipping {post_id}: GPT returned invalid commands")
-            continue
+            post_id = entry.get("Post_ID")
+            print(f"\nProcessing {post_id} ...")
+            start_time = time.time()
 
-        # ==== build agent sequence
-        text = "A detailed photo"
-        text_bg = "A detailed photo"
-        seq_args = command_parse(commands, text, text_bg)
+            # ==== ảnh + GPT command (thường đã xong trong lúc GPU chạy entry trước)
+            try:
+                job, commands, error = future.result()
+            except Exception as e:
+                job, commands, error = None, None, f"prefetch error: {e}"
+            if error is not None:
+                print(f"Skipping {post_id}: {error}")
+                record_progress(post_id, error)
+                if job is not None:
+                    tracer.export(job.dir, job=post_id)
+                else:
+                    tracer.events(clear=True, job=post_id)
+                continue
+            wait_time = time.time() - start_time
 
-        # OUTPUT FILE (yêu cầu của bạn)
-        output_path = f"{output_dir}/{post_id}_output_genartist.png"
+            # ==== build agent sequence
+            text = "A detailed photo"
+            text_bg = "A detailed photo"
+            seq_args = job.parse(commands, text, text_bg)
 
-        seq_args.append({
-            "tool": "superresolution_SDXL",
-            "input": {"image": f"{INPUT_FOLDER}/{len(seq_args)-1}.png"},
-            "output": output_path
-        })
+            # OUTPUT FILE (yêu cầu của bạn)
+            output_path = f"{output_dir}/{post_id}_output_genartist.png"
 
-        print(f"Running {len(seq_args)} steps...")
+            seq_args.append({
+                "tool": "superresolution_SDXL",
+                "input": {"image": job.path(f"{len(seq_args)-1}.png")},
+                "output": output_path
+            })
 
-        # ==== chạy từng bước
-        for step in seq_args:
-            json.dump(step, open("input.json", "w"))
-            tool = step["tool"]
+            print(f"Running {len(seq_args)} steps...")
 
-            if tool in ["object_addition_anydoor", "segmentation", "detection"]:
-                os.system("python agent_tool_aux.py --json_out True")
-            elif tool in ["addition_anydoor", "replace_anydoor", "remove",
-                          "instruction", "attribute_diffedit"]:
-                os.system("python agent_tool_edit.py --json_out True")
-            elif tool in ["text_to_image_SDXL", "image_to_image_SD2",
-                          "layout_to_image_LMD", "layout_to_image_BoxDiff",
-                          "superresolution_SDXL"]:
-                os.system("python agent_tool_generate.py --json_out True")
+            # ==== chạy từng bước
+            try:
+                with tracer.tag(job=post_id):
+                    for i, step in enumerate(seq_args):
+                        with span("step:" + step["tool"], index=i):
+                            worker.run(step)
+                worker.flush([output_path])
+            except ToolError as e:
+                print(f"Failed {post_id}: {e}")
+                record_progress(post_id, f"failed: {e}")
+                continue
+            finally:
+                worker.reset(job.dir)
+                # jobs/<post_id>/trace.json, trace.chrome.json, also for a failed job;
+                # spans of the entries still being prefetched stay in the tracer
+                tracer.export(job.dir, worker.trace(), job=post_id)
 
-        # tính thời gian
-        end_time = time.time()
-        elapsed = end_time - start_time
+            # tính thời gian
+            end_time = time.time()
+            elapsed = end_time - start_time
+            record_progress(post_id, "done", elapsed)
 
-        print(f"Done: {output_path}")
-        print(f"Edit time: {elapsed:.2f} seconds")
+            print(f"Done: {output_path}")
+            print(f"Edit time: {elapsed:.2f} seconds (waiting for download/GPT: {wait_time:.2f} seconds)")
 
 
 
@@ -324,5 +441,4 @@ def process_reviewer():
 # ===========================================================
 
 if __name__ == "__main__":
-    for i in range(1, 7):
-        process_reviewer(i)
+    process_reviewer()